@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of the analysis hot paths.
+
+    The suite follows the conventions of airspeed velocity (asv): classes
+    with a `setup` method, `time_*` methods and `params`. It runs with
+    `asv run` (see `asv.conf.json`) or, without asv, with
+    `python benchmarks/run.py`.
+
+    The datasets are synthetic and seeded: a ring of the size of BESSY II
+    (112 BPMs, 64 correctors, 150 Hz) and rings 4 times bigger.
+"""
+
+from __future__ import division, print_function
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import search_kicks.core as skcore
+import search_kicks.tools as sktools
+from search_kicks.tools import matlab
+
+SEED = 42
+SAMPLING_FREQUENCY = 150.
+RINGS = [(112, 64), (448, 256)]
+
+
+def make_ring(bpm_nb, cm_nb, seed=SEED):
+    """ Phases, tune and response matrix of a synthetic ring. """
+    rng = np.random.RandomState(seed)
+    tune = 17.85*bpm_nb/112
+    phase = np.sort(rng.uniform(0, 2*np.pi*tune, bpm_nb))
+    cm_phase = np.sort(rng.uniform(0, 2*np.pi*tune, cm_nb))
+    beta = rng.uniform(1, 10, bpm_nb)
+    cm_beta = rng.uniform(1, 10, cm_nb)
+    Smat = (np.sqrt(np.outer(beta, cm_beta)) *
+            np.cos(np.pi*tune - abs(phase[:, np.newaxis] -
+                                    cm_phase[np.newaxis, :])) /
+            (2*np.sin(np.pi*tune)))
+    return phase, tune, Smat
+
+
+def make_orbit(bpm_nb, cm_nb, sample_nb, frequency=10., seed=SEED):
+    """ BPM and CM signals of a sine kick at one corrector, plus noise. """
+    rng = np.random.RandomState(seed)
+    phase, tune, Smat = make_ring(bpm_nb, cm_nb, seed)
+    t = np.arange(sample_nb)/SAMPLING_FREQUENCY
+    CMx = 1e-3*rng.normal(size=(cm_nb, sample_nb))
+    CMx[cm_nb//3] += np.sin(2*np.pi*frequency*t + rng.uniform(0, 2*np.pi))
+    BPMx = Smat.dot(CMx) + 1e-3*rng.normal(size=(bpm_nb, sample_nb))
+    BPMy = 0.1*BPMx[::-1].copy()
+    return sktools.io.OrbitData(
+        BPMx=BPMx, BPMy=BPMy, CMx=CMx, CMy=CMx[::-1].copy(),
+        sampling_frequency=SAMPLING_FREQUENCY,
+        measure_date=datetime(2016, 5, 30, 16, 30, 30))
+
+
+class _Ring(object):
+    params = RINGS
+    param_names = ['bpm_nb, cm_nb']
+    sample_nb = 1500
+
+    def setup(self, ring):
+        bpm_nb, cm_nb = ring
+        self.phase, self.tune, self.Smat = make_ring(bpm_nb, cm_nb)
+        self.orbit = make_orbit(bpm_nb, cm_nb, self.sample_nb)
+        self.acos, self.asin = sktools.maths.extract_sin_cos(
+            self.orbit.BPMx, SAMPLING_FREQUENCY, 10., verbose=False)
+
+
+class TimeKick(_Ring):
+    def time_get_kick(self, ring):
+        skcore.get_kick(self.acos, self.phase, self.tune)
+
+    def time_get_kicks_32(self, ring):
+        skcore.get_kicks(np.tile(self.acos, (32, 1)), self.phase, self.tune)
+
+
+class TimeMaths(_Ring):
+    def time_fit_sin_cos(self, ring):
+        sktools.maths.fit_sin_cos(self.acos, self.phase)
+
+    def time_extract_sin_cos(self, ring):
+        sktools.maths.extract_sin_cos(self.orbit.BPMx, SAMPLING_FREQUENCY,
+                                      10., verbose=False)
+
+    def time_optimize_rotation(self, ring):
+        sktools.maths.optimize_rotation(self.acos, self.asin, 0.1)
+
+    def time_klt(self, ring):
+        sktools.maths.klt([self.acos, self.asin])
+
+    def time_inverse_with_svd(self, ring):
+        sktools.maths.inverse_with_svd(self.Smat, 32)
+
+
+class TimeIO(_Ring):
+    def setup(self, ring):
+        _Ring.setup(self, ring)
+        self.directory = tempfile.mkdtemp()
+        self.dump = os.path.join(self.directory, 'dump.mat')
+        orbit = self.orbit
+        matlab.save_timeanalys(self.dump, orbit.BPMx, orbit.BPMy, orbit.CMx,
+                               orbit.CMy)
+        self.hdf5 = os.path.join(self.directory, 'orbit.hdf5')
+        self.npy = os.path.join(self.directory, 'orbit.npy')
+
+    def teardown(self, ring):
+        shutil.rmtree(self.directory)
+
+    def time_load_orbit_dump(self, ring):
+        sktools.io.load_orbit_dump(self.dump)
+
+    def time_hdf5_round_trip(self, ring):
+        sktools.io.save_orbit_hdf5(self.hdf5, self.orbit)
+        sktools.io.load_orbit_hdf5(self.hdf5)
+
+    def time_npy_round_trip(self, ring):
+        sktools.io.save_orbit_npy(self.npy, self.orbit)
+        sktools.io.load_orbit_npy(self.npy)
+
+
+class TimeArchiver(object):
+    params = [100, 10000]
+    param_names = ['sample_nb']
+
+    def setup(self, sample_nb):
+        t0 = datetime(2016, 5, 30, 16, 30, 30)
+        pvs = ['BPMZ{}D1R:rdX'.format(i) for i in range(10)]
+        lines = []
+        for i in range(sample_nb):
+            t = t0 + timedelta(seconds=i)
+            lines.append("{} {} {}\t\n".format(
+                pvs[i % len(pvs)], t.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                0.001*i))
+        self.data = ''.join(lines).encode('utf8')
+        self.archiver = sktools.io.Archiver('http://localhost/')
+
+    def time_filter_camonitor(self, sample_nb):
+        self.archiver.filter_camonitor(self.data)
+
+
+class TimeSynthetic(object):
+    params = RINGS
+    param_names = ['bpm_nb, cm_nb']
+
+    def setup(self, ring):
+        bpm_nb, cm_nb = ring
+        _, _, Smat = make_ring(bpm_nb, cm_nb)
+        self.generator = sktools.synthetic.HarmonicDisturbance(
+            Smat, [3, 10, 30], [10., 8.5, 50.], amplitudes=[1., 0.5, 0.1],
+            noise=1e-3, cm_noise=1e-4, seed=SEED)
+
+    def time_generate_10_minutes(self, ring):
+        for _ in self.generator.chunks(90000, chunk=15000):
+            pass
+
+
+class TimeMatch(_Ring):
+    def setup(self, ring):
+        _Ring.setup(self, ring)
+        self.matcher = skcore.ResponseMatcher(self.Smat)
+        self.orbits = np.tile(self.acos + 1j*self.asin, (1000, 1))
+
+    def time_locate(self, ring):
+        self.matcher.locate(self.acos + 1j*self.asin)
+
+    def time_locate_many_1000(self, ring):
+        self.matcher.locate_many(self.orbits)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+""" Run the benchmarks without asv and keep the results per commit.
+
+    $ python benchmarks/run.py                 # all the benchmarks
+    $ python benchmarks/run.py -b klt -b io    # those matching a pattern
+
+    The timings are written to `benchmarks/results/<commit>.json` and
+    compared with the results of another commit (by default the last one
+    run before): a benchmark slower by more than `--threshold` is reported
+    and the exit status is 1.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+from datetime import datetime
+import glob
+import inspect
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(HERE, 'results')
+
+# the checkout, not an installed version (asv installs the package itself)
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+import benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-b', '--bench', action='append', default=[],
+                        help="run the benchmarks matching this regular "
+                             "expression (repeatable)")
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="minimal duration of one repeat in s")
+    parser.add_argument('--compare', metavar='COMMIT',
+                        help="results to compare with, default to the "
+                             "previous run")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="ratio reported as a regression")
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    results = {'commit': commit, 'date': datetime.now().isoformat(),
+               'machine': machine_info(), 'timings': dict()}
+    for name, cls, method, param in find_benchmarks(args.bench):
+        best = time_benchmark(cls, method, param, args.repeat, args.min_time)
+        results['timings'][name] = best
+        print("{:60s} {:>10s}".format(name, format_time(best)))
+
+    previous = load_results(args.compare, exclude=commit)
+    regressions = 0
+    if previous is not None:
+        print("\nCompared with {}:".format(previous['commit']))
+        for name, best in sorted(results['timings'].items()):
+            before = previous['timings'].get(name)
+            if before is None:
+                continue
+            ratio = best/before
+            flag = ''
+            if ratio > args.threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            elif ratio < 1/args.threshold:
+                flag = '  improved'
+            print("{:60s} {:>10s} -> {:>10s} ({:.2f}x){}".format(
+                name, format_time(before), format_time(best), ratio, flag))
+
+    if not args.no_save:
+        if not os.path.isdir(RESULTS):
+            os.makedirs(RESULTS)
+        filename = os.path.join(RESULTS, '{}.json'.format(commit))
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("\nResults written to {}".format(filename))
+    return 1 if regressions else 0
+
+
+def find_benchmarks(patterns):
+    """ Yield `(name, class, method name, parameter)` of the benchmarks. """
+    for cls_name, cls in sorted(inspect.getmembers(benchmarks,
+                                                   inspect.isclass)):
+        if cls.__module__ != benchmarks.__name__ or cls_name.startswith('_'):
+            continue
+        params = getattr(cls, 'params', [None])
+        for method in sorted(m for m in dir(cls) if m.startswith('time_')):
+            for param in params:
+                name = '{}.{}'.format(cls_name, method)
+                if param is not None:
+                    name += '({})'.format(param)
+                if patterns and not any(re.search(p, name)
+                                        for p in patterns):
+                    continue
+                yield name, cls, method, param
+
+
+def time_benchmark(cls, method, param, repeat, min_time):
+    """ Best time of one call in seconds. """
+    args = () if param is None else (param,)
+    bench = cls()
+    if hasattr(bench, 'setup'):
+        bench.setup(*args)
+    try:
+        func = getattr(bench, method)
+        timer = timeit.Timer(lambda: func(*args))
+        number, duration = timer.autorange()
+        number = max(1, int(number*min_time/max(duration, 0.2)))
+        return min(timer.repeat(repeat, number))/number
+    finally:
+        if hasattr(bench, 'teardown'):
+            bench.teardown(*args)
+
+
+def load_results(commit, exclude=None):
+    """ Results of `commit`, or the most recent ones if `commit` is None. """
+    if commit is not None:
+        filenames = glob.glob(os.path.join(RESULTS, commit + '*.json'))
+    else:
+        filenames = [f for f in glob.glob(os.path.join(RESULTS, '*.json'))
+                     if os.path.basename(f) != '{}.json'.format(exclude)]
+    if not filenames:
+        return None
+    with open(max(filenames, key=os.path.getmtime)) as f:
+        return json.load(f)
+
+
+def git_commit():
+    """ Short hash of HEAD, with '+' if the tree is modified. """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE).decode().strip()
+        dirty = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=HERE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+' if dirty else '')
+
+
+def machine_info():
+    return {'node': platform.node(), 'processor': platform.processor(),
+            'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def format_time(t):
+    for unit, scale in [('s', 1), ('ms', 1e-3), ('us', 1e-6)]:
+        if t >= scale:
+            return '{:.3f} {}'.format(t/scale, unit)
+    return '{:.1f} ns'.format(t*1e9)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
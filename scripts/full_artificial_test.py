@@ -11,8 +11,7 @@ import matplotlib.pyplot as plt
 import PyML
 import search_kicks.core as skcore
 import search_kicks.tools as sktools
-
-import time
+from search_kicks.tools import instrument
 
 
 DEFAULT_DATA = '../search_kicks/default_data/'
@@ -49,116 +48,104 @@ def do_get_kick(A, B, phase, tune, pos):
 
     return kik1, kik2
 
-def toc(t1, title):
-    t_old = t1
-    t1 = time.time()
-    dt =  t1 - t_old
-    print("{}: {} s".format(title, dt))
-    return t1
-
 if __name__=='__main__':
-    t0 = time.time()
+    instrument.enable()
+    with instrument.timer('GLOBAL'):
 ##### INIT #######
-    plt.close('all')
-    mml = PyML.PyML()
-    mml.setao(mml.loadFromExtern('../external/bessyIIinit.py', 'ao'))
-
-    active_bpms = mml.getActiveIdx('BPMx')
+        with instrument.timer('Init'):
+            plt.close('all')
+            mml = PyML.PyML()
+            mml.setao(mml.loadFromExtern(sktools.machine.INIT_FILE, 'ao'))
 
-    sx = mml.getfamilydata('BPMx', 'Pos')[active_bpms]
-    sy = mml.getfamilydata('BPMy', 'Pos')[active_bpms]
+            active_bpms = mml.getActiveIdx('BPMx')
 
-    namesCMx = mml.getfamilydata('HCM', 'CommonNames')
-    ids = []
-    for i in range(namesCMx.size):
-        if namesCMx[i][0:2] == 'HS':
-            ids.append(i)
+            sx = mml.getfamilydata('BPMx', 'Pos')[active_bpms]
+            sy = mml.getfamilydata('BPMy', 'Pos')[active_bpms]
 
-    cx = mml.getfamilydata('HCM', 'Pos')[ids]
-    cy = mml.getfamilydata('VCM', 'Pos')
+            namesCMx = mml.getfamilydata('HCM', 'CommonNames')
+            ids = []
+            for i in range(namesCMx.size):
+                if namesCMx[i][0:2] == 'HS':
+                    ids.append(i)
 
-    namesX = mml.getfamilydata('BPMx', 'CommonNames')
-    namesY = mml.getfamilydata('BPMx', 'CommonNames')
+            cx = mml.getfamilydata('HCM', 'Pos')[ids]
+            cy = mml.getfamilydata('VCM', 'Pos')
 
-    Smat_xx, Smat_yy = sktools.io.load_Smat(SMAT_FILE)
-    Smat_xx = Smat_xx[active_bpms, :]
-    Smat_yy = Smat_yy[active_bpms, :]
+            namesX = mml.getfamilydata('BPMx', 'CommonNames')
+            namesY = mml.getfamilydata('BPMx', 'CommonNames')
 
-    nb_CMx = Smat_xx.shape[1]
-    nb_CMy = Smat_yy.shape[1]
+            Smat_xx, Smat_yy = sktools.io.load_Smat(SMAT_FILE)
+            Smat_xx = Smat_xx[active_bpms, :]
+            Smat_yy = Smat_yy[active_bpms, :]
 
-    CMx = np.zeros(nb_CMx)
-    CMx[SOURCE_DISTURB] = 1
+            nb_CMx = Smat_xx.shape[1]
+            nb_CMy = Smat_yy.shape[1]
 
-    phases_mat = scipy.io.loadmat(PHASE_FILE)
-    phaseX = phases_mat['PhaseX'][:, 0]
-    phaseY = phases_mat['PhaseZ'][:, 0]
+            CMx = np.zeros(nb_CMx)
+            CMx[SOURCE_DISTURB] = 1
 
-    t1 = toc(t0, "Init")
+            phases_mat = scipy.io.loadmat(PHASE_FILE)
+            phaseX = phases_mat['PhaseX'][:, 0]
+            phaseY = phases_mat['PhaseZ'][:, 0]
 
 ##### CONSTANT DISTURB #######
-    BPMx = np.dot(Smat_xx, CMx)
+        with instrument.timer('Cst disturb'):
+            BPMx = np.dot(Smat_xx, CMx)
 
-    kick, coeff = skcore.get_kick(BPMx, phaseX, tuneX, False)
-    idkick = np.argmin(abs(phaseX-kick))
+            kick, coeff = skcore.get_kick(BPMx, phaseX, tuneX, False)
+            idkick = np.argmin(abs(phaseX-kick))
 
-    print(sx[idkick], cx[SOURCE_DISTURB])
+            print(sx[idkick], cx[SOURCE_DISTURB])
 
-    t1 = toc(t1, "Cst disturb")
 ##### HARMONIC DISTURB #######
-    BPMx_t = np.zeros((BPMx.size, NB_SP))
-    t = np.arange(NB_SP)/FS
+        with instrument.timer('Harmonic disturb'):
+            disturbance = sktools.synthetic.HarmonicDisturbance(
+                Smat_xx, SOURCE_DISTURB, F, phases=PHASE, fs=FS)
+            BPMx_t = disturbance.generate(int(NB_SP))
 
-    for i in range(BPMx.size):
-        BPMx_t[i,:] = BPMx[i]*np.sin(F*2*np.pi*t+PHASE)
-    t2 = toc(t1, "Harmonic disturb init")
+            A = sktools.maths.extract_sin_cos(BPMx_t, FS, F, 'complex')
 
-    A = sktools.maths.extract_sin_cos(BPMx_t, FS, F, 'complex')
-    t2 = toc(t2, "Harmonic disturb, sum")
+            plt.figure("cos/sin")
+            plt.plot(sx, A.real)
+            plt.plot(sx, A.imag)
+            plt.legend(['cos','sin'])
 
-    plt.figure("cos/sin")
-    plt.plot(sx, A.real)
-    plt.plot(sx, A.imag)
-    plt.legend(['cos','sin'])
+            phase = phases_mat['PhaseX'][:, 0]
 
-    phase = phases_mat['PhaseX'][:, 0]
+            kick1b, kick2b = do_get_kick(A.real, A.imag, phase, tuneX, sx)
+            idkick = np.argmin(abs(phaseX-kick1b))
 
-    kick1b, kick2b = do_get_kick(A.real, A.imag, phase, tuneX, sx)
-    idkick = np.argmin(abs(phaseX-kick1b))
+            print(sx[idkick], cx[SOURCE_DISTURB])
 
-    print(sx[idkick], cx[SOURCE_DISTURB])
-
-    t1 = toc(t1, "Harmonic disturb")
 ##### KLT VS ROTATION #######
-    a = np.array([A.real, A.imag])
+        with instrument.timer('KLT/Rotat'):
+            a = np.array([A.real, A.imag])
 
-    [A_klt, B_klt] = sktools.maths.klt(a)
+            [A_klt, B_klt] = sktools.maths.klt(a)
 
-    step_size = 0.1
-    A_opt, B_opt, _ = sktools.maths.optimize_rotation(A.real, A.imag, step_size)
+            step_size = 0.1
+            A_opt, B_opt, _ = sktools.maths.optimize_rotation(A.real, A.imag, step_size)
 
-    plt.figure("Optimization")
-    plt.subplot(2,1,1)
-    plt.plot(sx, A_klt)
-    plt.plot(sx, B_klt)
-    plt.legend(['cos','sin'])
-    plt.title('KLT')
+            plt.figure("Optimization")
+            plt.subplot(2,1,1)
+            plt.plot(sx, A_klt)
+            plt.plot(sx, B_klt)
+            plt.legend(['cos','sin'])
+            plt.title('KLT')
 
-    plt.subplot(2,1,2)
-    plt.plot(sx, A_opt)
-    plt.plot(sx, B_opt)
-    plt.legend(['cos','sin'])
-    plt.title('Rotations')
+            plt.subplot(2,1,2)
+            plt.plot(sx, A_opt)
+            plt.plot(sx, B_opt)
+            plt.legend(['cos','sin'])
+            plt.title('Rotations')
 
-    t1 = toc(t1, "KLT/Rotat")
 ##### CORRECTION #######
-    S_inv = sktools.maths.inverse_with_svd(Smat_xx, 10)
-    r1 = np.dot(S_inv, A_klt)
-
-    plt.figure('CMs')
-    plt.plot(cx, r1)
-    plt.title('Correctors')
+        with instrument.timer('Correction'):
+            S_inv = sktools.maths.inverse_with_svd(Smat_xx, 10)
+            r1 = np.dot(S_inv, A_klt)
 
-    t1 = toc(t1, "Correction")
+            plt.figure('CMs')
+            plt.plot(cx, r1)
+            plt.title('Correctors')
 
-    _ = toc(t0, "GLOBAL")
+    print(instrument.report())
@@ -31,18 +31,12 @@ fs = 150 #Hz
 SAMPLE_NB = 1000
 
 def parse_frames(messages):
-    sample_nb = len(messages)
-    bpm_nb = np.fromstring(messages[0][2], dtype='double').size
+    bpm_nb = np.frombuffer(messages[0][2], dtype='double').size
 
-    valuesX = np.zeros((bpm_nb, sample_nb))
-    valuesY = np.zeros((bpm_nb, sample_nb))
+    frames = sktools.acquisition.RingBuffer(bpm_nb, len(messages))
+    frames.extend(messages)
 
-    # parse frames in values X
-    for count, message in enumerate(messages):
-        valuesX[:, count] = np.fromstring(message[2], dtype='double')
-        valuesY[:, count] = np.fromstring(message[3], dtype='double')
-
-    return valuesX, valuesY
+    return frames.window()
 
 if __name__=='__main__':
     if len(sys.argv) > 1:
@@ -50,7 +44,7 @@ if __name__=='__main__':
 
     plt.close('all')
     pml = PyML.PyML()
-    pml.setao(pml.loadFromExtern('search_kicks/external/bessyIIinit.py', 'ao'))
+    pml.setao(pml.loadFromExtern(sktools.machine.INIT_FILE, 'ao'))
     pml.loadBPMOffsets('/opt/OPI/MapperApplications/conf/Orbit/SR/RefOrbit.Dat')
 
     active_bpmsx = pml.getActiveIdx('BPMx')
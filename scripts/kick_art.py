@@ -37,7 +37,7 @@ def art_main(cidx, plotopt=True):
     print('I set cidx to {}'.format(cidx))
     plt.close('all')
     pml = PyML.PyML()
-    pml.setao(pml.loadFromExtern('../../PyML/config/bessyIIinit.py', 'ao'))
+    pml.setao(pml.loadFromExtern(sktools.machine.INIT_FILE, 'ao'))
 
     active_bpmsx = pml.getActiveIdx('BPMx')
     active_bpmsy = pml.getActiveIdx('BPMy')
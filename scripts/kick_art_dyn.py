@@ -39,7 +39,7 @@ def art_main(cidx, ref_freq, plotopt=True):
     print('I set cidx to {}'.format(cidx))
     plt.close('all')
     pml = PyML.PyML()
-    pml.setao(pml.loadFromExtern('../../PyML/config/bessyIIinit.py', 'ao'))
+    pml.setao(pml.loadFromExtern(sktools.machine.INIT_FILE, 'ao'))
 
     active_bpmsx = pml.getActiveIdx('BPMx')
     active_bpmsy = pml.getActiveIdx('BPMy')
@@ -78,10 +78,9 @@ def art_main(cidx, ref_freq, plotopt=True):
 
     S_inv = sktools.maths.inverse_with_svd(Smat, 32)
 
-    t = np.arange(Fs*tmax)/Fs
-    corr = np.zeros((Smat.shape[1], t.size))
-    corr[cidx, :] = np.sin(2*np.pi*ref_freq*t + np.random.random()*2*np.pi)
-    values = Smat.dot(corr)
+    disturbance = sktools.synthetic.HarmonicDisturbance(
+        Smat, cidx, ref_freq, phases=np.random.random()*2*np.pi, fs=Fs)
+    values = disturbance.generate(Fs*tmax)
 
     acos, asin = sktools.maths.extract_sin_cos(values, Fs, ref_freq)
 
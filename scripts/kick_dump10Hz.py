@@ -24,17 +24,11 @@ import PyML
 import search_kicks.core as skcore
 import search_kicks.tools as sktools
 
-DEFAULT_DATA = '../search_kicks/default_data/'
-PHASE_FILE = DEFAULT_DATA + 'phases.mat'
-SMAT_FILE = DEFAULT_DATA + 'Smat-CM-Standard_HMI.mat'
 DATA_FILE = '../../_data/translated_FastBPMData_2015-10-26_06-57-56_vert10Hz.mat'
 
 #AXIS = 'x'
 AXIS = 'y'
 
-# Hardcoded constants
-tuneX = 17.8509864542659
-tuneY = 6.74232980750181
 ref_freq = 10#9.979248046875
 fs = 150 #Hz
 
@@ -44,60 +38,29 @@ if __name__ == '__main__':
 
     plt.close('all')
     pml = PyML.PyML()
-    pml.setao(pml.loadFromExtern('../external/bessyIIinit.py', 'ao'))
+    pml.setao(pml.loadFromExtern(sktools.machine.INIT_FILE, 'ao'))
 #    pml.loadBPMOffsets('/opt/OPI/MapperApplications/conf/Orbit/SR/RefOrbit.Dat')
 
-    active_bpmsx = pml.getActiveIdx('BPMx')
-    active_bpmsy = pml.getActiveIdx('BPMy')
-    active_cmsx = pml.getActiveIdx('HCM')
-    active_cmsy = pml.getActiveIdx('VCM')
-    sx = pml.getfamilydata('BPMx', 'Pos')
-    sy = pml.getfamilydata('BPMy', 'Pos')
-    cx = pml.getfamilydata('HCM', 'Pos')
-    cy = pml.getfamilydata('VCM', 'Pos')
-
-    namesX = pml.getfamilydata('BPMx', 'CommonNames')
-    namesY = pml.getfamilydata('BPMy', 'CommonNames')
-
-    Smat_xx, Smat_yy = sktools.io.load_Smat(SMAT_FILE)
-    Smat_xx = Smat_xx[active_bpmsx, :]
-    Smat_yy = Smat_yy[active_bpmsy, :]
-
-    #idx = pml.family2idx('BPMx')
-    #idy = pml.family2idx('BPMy')
-
-    #offsetx = pml.getfamilydata('BPMx','Offset',None,idx)
-    #offsety = pml.getfamilydata('BPMy','Offset',None,idy)
+    lattice = sktools.lattice.LatticeModel.from_pyml(pml)
 
     orbit = sktools.io.load_orbit_dump(DATA_FILE)
-    valuesX, valuesY, names, fs = [orbit.BPMx, orbit.BPMy, orbit.names, orbit.sampling_frequency]
-    phases_mat = scipy.io.loadmat(PHASE_FILE)
-    phaseX = phases_mat['PhaseX'][:, 0]
-    phaseY = phases_mat['PhaseZ'][:, 0]
+    fs = orbit.sampling_frequency
 
     if AXIS == 'y':
-        poscor = cy[active_cmsy]
-        pos = sy[active_bpmsy]
-        Smat = Smat_yy
-        phase = phaseY
-        tune = tuneY
-        values = valuesY[active_bpmsy, :]
-        names = namesY
+        plane = lattice.y
+        values = orbit.BPMy[plane.bpm_idx, :]
     elif AXIS == 'x':
-        poscor = cx[active_cmsx]
-        pos = sx[active_bpmsx]
-        Smat = Smat_xx
-        phase = phaseX
-        tune = tuneX
-        values = valuesX[active_bpmsx, :]
-        names = namesX
+        plane = lattice.x
+        values = orbit.BPMx[plane.bpm_idx, :]
+
+    poscor = plane.cm_positions
+    pos = plane.bpm_positions
+    names = plane.bpm_names
 
     sample_nb = values.shape[1]
     Nmax = sample_nb
 
     t = np.arange(sample_nb)/fs
-    p0 = np.random.random() * 2*np.pi
-    tenHz = np.sin(2*np.pi*10*t + p0)
     acos, asin = sktools.maths.extract_sin_cos(values, fs, ref_freq)
 
     plt.figure()
@@ -105,14 +68,11 @@ if __name__ == '__main__':
 #    plt.plot(t[100:Nmax],values[idx,100:Nmax]-np.mean(values[idx,100:Nmax]))
 #    plt.plot(t[100:Nmax],values_f[idx,100:Nmax]-np.mean(values_f[idx,100:Nmax]))
 
-    print('optimize')
-    # Optimize
-    step_size = 0.1
-    acos_opt, asin_opt, _ = sktools.maths.optimize_rotation(acos,
-                                                            asin,
-                                                            step_size)
-    A = [acos, asin]
-    klt = sktools.maths.klt(A)
+    print('analyze')
+    result = skcore.analyze_orbit(orbit, lattice, ref_freq, planes=AXIS,
+                                  step_size=0.1, svd_values=32)
+    acos_opt, asin_opt = result[AXIS]['components']
+    klt = sktools.maths.klt([acos, asin])
 
     plt.figure("optimisaton")
     plt.subplot(211)
@@ -125,21 +85,11 @@ if __name__ == '__main__':
     plt.plot(pos, klt[0])
     plt.plot(pos, klt[1])
 
-    # Correction fft
-    S_inv = sktools.maths.inverse_with_svd(Smat, 32)
-
-    print('get_kick')
-    # Kick sin
-    phase_kick_sin, coeff = skcore.get_kick(np.array(asin_opt), phase, tune,
-                                            True, False)
-    kick_idx_sin = np.argmin(abs(phase-phase_kick_sin))
-    corr_sin = np.dot(S_inv, asin_opt)
-
-    # Kick cos
-    phase_kick_cos, coeff = skcore.get_kick(np.array(acos_opt), phase, tune,
-                                            True, True)
-    kick_idx_cos = np.argmin(abs(phase-phase_kick_cos))
-    corr_cos = np.dot(S_inv, acos_opt)
+    kick_idx_sin = result[AXIS]['sin']['index']
+    corr_sin = result[AXIS]['sin']['correction']
+    kick_idx_cos = result[AXIS]['cos']['index']
+    corr_cos = result[AXIS]['cos']['correction']
+    print("timing: {}".format(result['timing']))
 
     plt.figure('CMs, kick cos')
     plt.subplot(211)
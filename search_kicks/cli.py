@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+""" Command line interface, installed as `search-kicks`.
+
+    $ search-kicks batch "dumps/*.mat" -f 10 -f 8.5 -o results.h5
+
+    analyzes every dump on a process pool and writes one table of results
+    (one row per file, frequency, plane and quadrature) to HDF5 or CSV.
+
+    $ search-kicks monitor tcp://gofbz12c.ctl.bessy.de:5563 -f 10 -o kicks.log
+
+    follows the BPM stream and writes the kick found every second.
+
+    $ search-kicks campaign -f 10 --noise 0 --noise 1 --dropout 5 -n 50
+
+    runs a Monte Carlo campaign on simulated kicks and reports how often
+    they are localized.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import glob
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+from search_kicks.core.analysis import analyze_orbit, QUADRATURES
+from search_kicks.core.campaign import run_campaign
+from search_kicks.core.monitor import KickMonitor, FileSink, UdpSink
+from search_kicks.tools.acquisition import ZmqSubscriber
+from search_kicks.tools.io import load_orbit, DATETIME_ISO
+from search_kicks.tools.lattice import LatticeModel
+from search_kicks.tools.machine import MachineConfig, INIT_FILE
+
+COLUMNS = ['file', 'measure_date', 'frequency', 'plane', 'quadrature',
+           'kick_index', 'kick_name', 'kick_position', 'kick_phase',
+           'amplitude', 'phase', 'rms', 'angle',
+           'time_load', 'time_decorrelate', 'time_kick', 'time_correction']
+
+# lattice model of a worker process, built once (see `_analyze_file`)
+_lattice = dict()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='search-kicks',
+                                     description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    batch = commands.add_parser('batch', help="analyze many files")
+    batch.add_argument('files', nargs='+',
+                       help="files or glob patterns")
+    batch.add_argument('-f', '--frequency', type=float, action='append',
+                       required=True, dest='frequencies',
+                       help="frequency to analyze in Hz (repeatable)")
+    batch.add_argument('-p', '--planes', default='xy',
+                       choices=['x', 'y', 'xy'])
+    batch.add_argument('-o', '--output', required=True,
+                       help="results table (.h5/.hdf5 or .csv)")
+    batch.add_argument('--format', choices=['hdf5', 'csv'],
+                       help="default to the extension of the output")
+    batch.add_argument('-j', '--jobs', type=int, default=None,
+                       help="number of processes, default to all the cores")
+    batch.add_argument('--method', default='rotation',
+                       choices=['rotation', 'klt'])
+    batch.add_argument('--svd-values', type=int, default=32)
+    batch.add_argument('--config', default=INIT_FILE,
+                       help="PyML configuration of the machine, default "
+                            "to the BESSY II one shipped with the package")
+
+    monitor = commands.add_parser('monitor', help="follow the BPM stream")
+    monitor.add_argument('address', help="address of the BPM publisher")
+    monitor.add_argument('-f', '--frequency', type=float, required=True,
+                         help="frequency to watch in Hz")
+    monitor.add_argument('-p', '--planes', default='xy',
+                         choices=['x', 'y', 'xy'])
+    monitor.add_argument('-w', '--window', type=int, default=300,
+                         help="frames per analysis")
+    monitor.add_argument('--period', type=int, default=150,
+                         help="frames between two analyses")
+    monitor.add_argument('-o', '--output',
+                         help="file the results are appended to (JSON lines)")
+    monitor.add_argument('--udp', metavar='HOST:PORT',
+                         help="send the results as UDP datagrams")
+    monitor.add_argument('--topic', default='FOFB-BPM-DATA')
+    monitor.add_argument('--config', default=INIT_FILE,
+                         help="PyML configuration of the machine, default "
+                              "to the BESSY II one shipped with the package")
+
+    campaign = commands.add_parser('campaign',
+                                   help="measure the localization accuracy")
+    campaign.add_argument('-f', '--frequency', type=float, action='append',
+                          dest='frequencies',
+                          help="kick frequency in Hz (repeatable), default "
+                               "to 10 Hz")
+    campaign.add_argument('--noise', type=float, action='append',
+                          help="BPM noise (repeatable), default to 0")
+    campaign.add_argument('--dropout', type=int, action='append',
+                          help="BPMs dropped (repeatable), default to 0")
+    campaign.add_argument('-c', '--corrector', type=int, action='append',
+                          dest='correctors',
+                          help="kicking corrector (repeatable), default to "
+                               "all")
+    campaign.add_argument('-p', '--plane', default='x', choices=['x', 'y'])
+    campaign.add_argument('-n', '--repeats', type=int, default=10,
+                          help="trials per condition")
+    campaign.add_argument('--method', default='rotation',
+                          choices=['rotation', 'klt'])
+    campaign.add_argument('--tolerance', type=float, default=5.,
+                          help="largest error of a success, in m")
+    campaign.add_argument('--seed', type=int, default=0)
+    campaign.add_argument('-j', '--jobs', type=int, default=None,
+                          help="number of processes, default to all the cores")
+    campaign.add_argument('-o', '--output',
+                          help="HDF5 file for the trials and statistics")
+    campaign.add_argument('--config', default=INIT_FILE,
+                          help="PyML configuration of the machine, default "
+                               "to the BESSY II one shipped with the package")
+
+    args = parser.parse_args(argv)
+    if args.command == 'batch':
+        return batch_command(args)
+    if args.command == 'monitor':
+        return monitor_command(args)
+    if args.command == 'campaign':
+        return campaign_command(args)
+    parser.print_help()
+    return 2
+
+
+def batch_command(args):
+    filenames = []
+    for path in args.files:
+        matches = sorted(glob.glob(path))
+        filenames.extend(matches if matches else [path])
+
+    fmt = args.format
+    if fmt is None:
+        ext = os.path.splitext(args.output)[1].lower()
+        fmt = 'csv' if ext == '.csv' else 'hdf5'
+
+    options = {'frequencies': args.frequencies, 'planes': args.planes,
+               'method': args.method, 'svd_values': args.svd_values,
+               'config': args.config}
+
+    start = time.time()
+    rows = []
+    errors = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(_analyze_file, filename, options)
+                   for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                rows.extend(future.result())
+            except Exception as e:
+                errors += 1
+                print("{}: {}".format(filename, e), file=sys.stderr)
+
+    table = dict((c, [row[c] for row in rows]) for c in COLUMNS)
+    if fmt == 'csv':
+        write_csv(args.output, table)
+    else:
+        write_hdf5(args.output, table)
+
+    print("{} files analyzed ({} failed) in {:.1f} s, {} rows written to {}"
+          .format(len(filenames) - errors, errors, time.time() - start,
+                  len(rows), args.output))
+    return 1 if errors else 0
+
+
+def monitor_command(args):
+    sinks = []
+    if args.output is not None:
+        sinks.append(FileSink(args.output))
+    if args.udp is not None:
+        host, port = args.udp.rsplit(':', 1)
+        sinks.append(UdpSink(host, int(port)))
+
+    def publish(result):
+        for sink in sinks:
+            sink(result)
+        print("{date} {x}/{y} latency {latency:.3f} s, {dropped} dropped"
+              .format(date=result['date'],
+                      x=result.get('x', {}).get('cos', {}).get('name'),
+                      y=result.get('y', {}).get('cos', {}).get('name'),
+                      latency=result['latency'], dropped=result['dropped']))
+
+    client = ZmqSubscriber()
+    client.connect(args.address)
+    client.subscribe([args.topic])
+    lattice = LatticeModel.from_config(MachineConfig(args.config))
+    monitor = KickMonitor(client, lattice, args.frequency, args.window,
+                          args.period, args.planes, sink=publish)
+    try:
+        monitor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+        for sink in sinks:
+            sink.close()
+    print(monitor.stats)
+    return 0
+
+
+def campaign_command(args):
+    lattice = LatticeModel.from_config(MachineConfig(args.config))
+    result = run_campaign(lattice, args.plane, correctors=args.correctors,
+                          frequencies=args.frequencies or [10.],
+                          noise_levels=args.noise or [0.],
+                          dropouts=args.dropout or [0],
+                          repeats=args.repeats, method=args.method,
+                          tolerance=args.tolerance, seed=args.seed,
+                          max_workers=args.jobs)
+
+    print("{:>10s} {:>10s} {:>8s} {:>7s} {:>8s} {:>10s} {:>10s}".format(
+        'frequency', 'noise', 'dropout', 'trials', 'success', 'median (m)',
+        'p95 (m)'))
+    for row in result['per_condition']:
+        print("{frequency:10.2f} {noise:10.3g} {dropout:8d} {trials:7d} "
+              "{success_rate:8.1%} {median_error:10.2f} {p95_error:10.2f}"
+              .format(**row))
+    per_corrector = result['per_corrector']
+    worst = np.argsort(per_corrector['success_rate'])[:5]
+    print("{} trials in {:.1f} s, {:.1%} localized within {} m; worst "
+          "correctors: {}".format(
+              result['trials']['error'].size, result['time'],
+              result['success_rate'], args.tolerance,
+              ', '.join('{} ({:.0%})'.format(per_corrector['corrector'][k],
+                                             per_corrector['success_rate'][k])
+                        for k in worst)))
+    if args.output is not None:
+        write_campaign(args.output, result)
+    return 0
+
+
+def _analyze_file(filename, options):
+    config = options['config']
+    if config not in _lattice:
+        _lattice[config] = LatticeModel.from_config(MachineConfig(config))
+    lattice = _lattice[config]
+
+    start = time.time()
+    orbit = load_orbit(filename)
+    time_load = time.time() - start
+    measure_date = ('' if orbit.measure_date is None
+                    else orbit.measure_date.strftime(DATETIME_ISO))
+
+    rows = []
+    for frequency in options['frequencies']:
+        # the files are already spread over the processes: no pool in each
+        result = analyze_orbit(orbit, lattice, frequency, options['planes'],
+                               method=options['method'],
+                               svd_values=options['svd_values'],
+                               executor=None)
+        timing = result['timing']
+        for axis in options['planes']:
+            plane = result[axis]
+            for i, quadrature in enumerate(QUADRATURES):
+                kick = plane[quadrature]
+                component = plane['components'][i]
+                rows.append({
+                    'file': filename,
+                    'measure_date': measure_date,
+                    'frequency': frequency,
+                    'plane': axis,
+                    'quadrature': quadrature,
+                    'kick_index': kick['index'],
+                    'kick_name': '' if kick['name'] is None
+                                 else str(kick['name']),
+                    'kick_position': np.nan if kick['position'] is None
+                                     else kick['position'],
+                    'kick_phase': kick['phase'],
+                    'amplitude': kick['coefficients'][0],
+                    'phase': kick['coefficients'][1],
+                    'rms': np.sqrt(np.mean(component**2)),
+                    'angle': np.nan if plane['angle'] is None
+                             else plane['angle'],
+                    'time_load': time_load,
+                    'time_decorrelate': timing['decorrelate'],
+                    'time_kick': timing['kick'],
+                    'time_correction': timing['correction'],
+                    })
+    return rows
+
+
+def write_csv(filename, table):
+    """ Write a `{column: list}` table to CSV. """
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(zip(*[table[c] for c in COLUMNS]))
+
+
+def write_hdf5(filename, table):
+    """ Write a `{column: list}` table to HDF5, one dataset per column. """
+    with h5py.File(filename, 'w') as f:
+        for c in COLUMNS:
+            values = table[c]
+            if values and isinstance(values[0], str):
+                values = np.array([v.encode('utf8') for v in values])
+            f.create_dataset('results/' + c, data=np.asarray(values))
+        f.attrs['columns'] = ','.join(COLUMNS)
+
+
+def write_campaign(filename, result):
+    """ Write the result of `run_campaign` to HDF5. """
+    with h5py.File(filename, 'w') as f:
+        for group in ['trials', 'per_corrector']:
+            for key, values in result[group].items():
+                f.create_dataset('{}/{}'.format(group, key), data=values)
+        for key in result['per_condition'][0]:
+            f.create_dataset('per_condition/' + key,
+                             data=[row[key] for row in
+                                   result['per_condition']])
+        f.create_dataset('bins', data=result['bins'])
+        f.attrs['seed'] = result['seed']
+        f.attrs['success_rate'] = result['success_rate']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
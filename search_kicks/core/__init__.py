@@ -13,4 +13,7 @@ __status__ = "Developpement"
 
 
 from .build_sine import build_sine
-from .get_kick import get_kick
+from .get_kick import get_kick, get_kicks
+from .analysis import analyze_orbit
+from .campaign import run_campaign
+from .match import ResponseMatcher
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+""" End-to-end analysis of a measured orbit.
+
+    The chain of the scripts (sine/cosine extraction -> rotation or KLT ->
+    kick localization -> correction through the pseudo-inverse of the
+    response matrix) is run for both planes and both quadratures, concurrently
+    on an executor if one is given.
+"""
+
+from __future__ import division, print_function
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+import time
+import weakref
+
+import numpy as np
+
+from search_kicks.tools.instrument import timed
+from search_kicks.tools.maths import extract_sin_cos, optimize_rotation, \
+    klt, inverse_with_svd
+from .get_kick import get_kick
+from .match import ResponseMatcher
+
+QUADRATURES = ['cos', 'sin']
+
+# pseudo-inverses of each lattice plane by number of singular values, with
+# the response matrix they were computed from (see `_inverse`)
+_inverses = weakref.WeakKeyDictionary()
+
+
+@timed()
+def analyze_orbit(orbit, lattice, frequency, planes='xy', method='rotation',
+                  step_size=0.1, svd_values=32, max_workers=None,
+                  executor=None):
+    """ Find the kick at `frequency` in both planes and quadratures.
+
+        The planes are extracted and decorrelated, then the four kick
+        searches run, concurrently if an executor is given. The
+        pseudo-inverse of each response matrix is computed once.
+
+        Parameters
+        ----------
+        orbit : tools.io.OrbitData
+            Measured orbit. Its BPM arrays are either for all the BPMs of the
+            machine (they are then sliced on the active ones) or already for
+            the active BPMs of the lattice model.
+        lattice : tools.lattice.LatticeModel
+            Phases, tunes and response matrices.
+        frequency : float
+            Frequency to analyze, in Hz.
+        planes : 'x', 'y' or 'xy', optional.
+            Default to 'xy'.
+        method : 'rotation' or 'klt', optional.
+            How the sine/cosine components are decorrelated. Default to
+            'rotation'.
+        step_size : float, optional.
+            Step of the rotation search in degrees. Default to 0.1.
+        svd_values : int, optional.
+            Singular values kept in the pseudo-inverse. Default to 32.
+        max_workers : int, optional.
+            Number of workers of a 'thread' or 'process' pool. Default to one
+            per kick search.
+        executor : None, 'thread', 'process' or concurrent.futures.Executor,
+            optional.
+            Pool the stages are run in. An `Executor` is reused and not shut
+            down: pass one to analyze many orbits. 'thread' and 'process'
+            start a pool for this call only. Default to None, the stages run
+            one after the other in the calling thread.
+
+        Returns
+        -------
+        dict
+            `{'frequency': f, 'x': result, 'y': result, 'timing': dict}` with
+            for each plane `result = {'cos': kick, 'sin': kick, 'angle':
+            rotation angle (None with the KLT), 'components': (2, bpm_nb)
+            array}` and for each quadrature `kick = {'phase', 'index',
+            'name', 'position', 'coefficients', 'correction'}`. `timing`
+            gives the wall time of each stage in seconds.
+
+            Each plane also has 'match': the 5 correctors that best explain
+            the orbit according to the response matrix (see
+            `match.ResponseMatcher.locate`), a cross-check of the kicks.
+    """
+    if planes not in ['x', 'y', 'xy']:
+        raise ValueError("planes must be 'x', 'y' or 'xy'.")
+    if method not in ['rotation', 'klt']:
+        raise ValueError("method must be 'rotation' or 'klt'.")
+
+    if executor is None:
+        executor = _InlineExecutor()
+    if isinstance(executor, Executor):
+        return _analyze(executor, orbit, lattice, frequency, planes, method,
+                        step_size, svd_values)
+
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=max_workers or 2*len(planes))
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=max_workers or 2*len(planes))
+    else:
+        raise ValueError("executor must be None, 'thread', 'process' or an "
+                         "Executor.")
+    with pool:
+        return _analyze(pool, orbit, lattice, frequency, planes, method,
+                        step_size, svd_values)
+
+
+def _analyze(pool, orbit, lattice, frequency, planes, method, step_size,
+             svd_values):
+    timing = dict()
+
+    start = time.time()
+    futures = dict()
+    for axis in planes:
+        plane = lattice.plane(axis)
+        values = orbit.BPMx if axis == 'x' else orbit.BPMy
+        if values.shape[0] != plane.phase.size:
+            values = values[plane.bpm_idx, :]
+        futures[axis] = pool.submit(decorrelate, values,
+                                    orbit.sampling_frequency, frequency,
+                                    method, step_size)
+    components = dict()
+    angles = dict()
+    for axis in planes:
+        components[axis], angles[axis] = futures[axis].result()
+    timing['decorrelate'] = time.time() - start
+
+    start = time.time()
+    futures = dict()
+    for axis in planes:
+        plane = lattice.plane(axis)
+        for i in range(2):
+            futures[axis, i] = pool.submit(get_kick, components[axis][i],
+                                           plane.phase, plane.tune)
+    kicks = dict((job, future.result()) for job, future in futures.items())
+    timing['kick'] = time.time() - start
+
+    start = time.time()
+    result = {'frequency': frequency}
+    for axis in planes:
+        plane = lattice.plane(axis)
+        S_inv = _inverse(plane, svd_values)
+        corrections = np.dot(S_inv, components[axis].T).T
+        matcher = ResponseMatcher.from_lattice(lattice, axis)
+        result[axis] = {'angle': angles[axis],
+                        'components': components[axis],
+                        'match': matcher.locate(components[axis][0] +
+                                                1j*components[axis][1])}
+        for i, quadrature in enumerate(QUADRATURES):
+            kick_phase, coefficients = kicks[axis, i]
+            idx = int(np.argmin(abs(plane.phase - kick_phase)))
+            result[axis][quadrature] = {
+                'phase': kick_phase,
+                'index': idx,
+                'name': _item(plane.bpm_names, idx),
+                'position': _item(plane.bpm_positions, idx),
+                'coefficients': coefficients,
+                'correction': corrections[i],
+                }
+    timing['correction'] = time.time() - start
+    result['timing'] = timing
+    return result
+
+
+@timed()
+def decorrelate(values, fs, frequency, method='rotation', step_size=0.1):
+    """ Cosine and sine components of the BPM signals at `frequency`,
+        decorrelated by rotation or KLT.
+
+        Returns
+        -------
+        components : np.array (2 x bpm_nb)
+            Decorrelated cosine and sine components.
+        angle : float or None
+            Rotation angle in degrees (None with the KLT).
+    """
+    acos, asin = extract_sin_cos(values, fs, frequency, verbose=False)
+    if method == 'rotation':
+        acos, asin, angle = optimize_rotation(acos, asin, step_size)
+        return np.array([acos, asin]), angle
+    return np.real(klt([acos, asin])), None
+
+
+class _InlineExecutor(Executor):
+    """ Runs each call when it is submitted, in the calling thread. """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def _inverse(plane, svd_values):
+    """ Pseudo-inverse of the response matrix of `plane`, computed again
+        only if `plane.Smat` was replaced.
+    """
+    inverses = _inverses.setdefault(plane, dict())
+    Smat, S_inv = inverses.get(svd_values, (None, None))
+    if Smat is not plane.Smat:
+        S_inv = inverse_with_svd(plane.Smat, svd_values)
+        inverses[svd_values] = plane.Smat, S_inv
+    return S_inv
+
+
+def _item(array, idx):
+    return None if array is None else array[idx]
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+""" Monte Carlo campaigns measuring the accuracy of the kick localization.
+
+    A campaign is a grid of conditions (kicking corrector, frequency, BPM
+    noise, number of BPMs dropped) with `repeats` trials each. Every trial
+    simulates an orbit through the response matrix with a random kick phase,
+    noise and set of dropped BPMs, localizes the kick and measures the
+    distance between the BPM found and the corrector.
+
+    Trial `i` is seeded by the `i`-th child of `np.random.SeedSequence(seed)`:
+    the results do not depend on the number of workers nor on the order the
+    trials are run in. The lattice data is sent once to each worker process.
+
+    >>> result = run_campaign(lattice, 'x', frequencies=[10.],
+    ...                       noise_levels=[0., 1e-3], dropouts=[0, 5],
+    ...                       repeats=20)
+    >>> result['success_rate'], result['per_corrector']['success_rate']
+"""
+
+from __future__ import division, print_function
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import itertools
+import time
+
+import numpy as np
+
+from search_kicks.tools.maths import optimize_rotation, klt
+from search_kicks.tools.synthetic import HarmonicDisturbance
+from .get_kick import get_kicks
+from .tracking import stft_phasors
+
+CIRCUMFERENCE = 240.  # BESSY II, in m
+
+# lattice plane of a worker, set once by `_init_worker`
+_plane = dict()
+
+
+def run_campaign(lattice, axis='x', correctors=None, frequencies=(10.,),
+                 noise_levels=(0.,), dropouts=(0,), repeats=10,
+                 sample_nb=1500, fs=150., amplitude=1., method='rotation',
+                 step_size=0.1, tolerance=5., circumference=CIRCUMFERENCE,
+                 bins=None, seed=0, max_workers=None, executor='process',
+                 batch=64):
+    """ Run `repeats` trials for every condition of the grid.
+
+        Parameters
+        ----------
+        lattice : tools.lattice.LatticeModel
+            Must know the positions of the BPMs and correctors.
+        axis : 'x' or 'y', optional.
+            Default to 'x'.
+        correctors : list of int, optional.
+            Kicking correctors (columns of the response matrix). Default to
+            all of them.
+        frequencies : list of float, optional.
+            Kick frequencies in Hz. Default to [10.].
+        noise_levels : list of float, optional.
+            Standard deviations of the white BPM noise, in the unit of the
+            orbit (`amplitude` times the response matrix). Default to [0.].
+        dropouts : list of int, optional.
+            Numbers of BPMs removed at random from each trial. Default to [0].
+        repeats : int, optional.
+            Trials per condition. Default to 10.
+        sample_nb : int, optional.
+            Samples per trial. Default to 1500 (10 s at 150 Hz).
+        fs : float, optional.
+            Sampling frequency. Default to 150 Hz.
+        amplitude : float, optional.
+            Kick amplitude. Default to 1.
+        method : 'rotation' or 'klt', optional.
+            Decorrelation of the sine/cosine components. Default to
+            'rotation'.
+        step_size : float, optional.
+            Step of the rotation search in degrees. Default to 0.1.
+        tolerance : float, optional.
+            A trial succeeds if the BPM found is at most `tolerance` m from
+            the corrector. Default to 5 m.
+        circumference : float, optional.
+            Of the ring, in m, to measure the distances. Default to 240 m.
+        bins : np.array, optional.
+            Edges of the error histograms in m. Default to 1 m bins up to
+            half the circumference.
+        seed : int, optional.
+            Seed of the campaign. Default to 0.
+        max_workers : int, optional.
+            Default to the number of cores.
+        executor : 'process' or 'thread', optional.
+            Default to 'process'.
+        batch : int, optional.
+            Trials per task sent to the workers. Default to 64.
+
+        Returns
+        -------
+        dict
+            `{'trials': {column: array}, 'success_rate': float,
+            'per_corrector': {...}, 'per_condition': [...], 'bins': edges,
+            'seed': seed, 'time': wall time in s}`.
+
+            The trial columns are 'corrector', 'frequency', 'noise',
+            'dropout', 'kick_index' (among the active BPMs), 'error' (m) and
+            'success'. `per_corrector` has 'corrector', 'trials',
+            'success_rate', 'mean_error' and 'histogram' (corrector_nb x
+            bin_nb), `per_condition` one dict per (frequency, noise,
+            dropout) with 'trials', 'success_rate', 'mean_error',
+            'median_error' and 'p95_error'.
+    """
+    if method not in ['rotation', 'klt']:
+        raise ValueError("method must be 'rotation' or 'klt'.")
+    plane = lattice.plane(axis)
+    if plane.bpm_positions is None or plane.cm_positions is None:
+        raise ValueError("The lattice model must know the positions of the "
+                         "BPMs and correctors.")
+    if correctors is None:
+        correctors = range(plane.Smat.shape[1])
+    if max(dropouts) > plane.phase.size - 3:
+        raise ValueError("Too many BPMs dropped, {} are active."
+                         .format(plane.phase.size))
+    if bins is None:
+        bins = np.arange(0, circumference/2 + 1)
+
+    conditions = list(itertools.product(correctors, frequencies, noise_levels,
+                                        dropouts))
+    trials = dict((name, np.repeat(np.asarray(column), repeats))
+                  for name, column in zip(['corrector', 'frequency', 'noise',
+                                           'dropout'], zip(*conditions)))
+    trial_nb = len(conditions)*repeats
+    seeds = np.random.SeedSequence(seed).spawn(trial_nb)
+
+    options = {'sample_nb': sample_nb, 'fs': fs, 'amplitude': amplitude,
+               'method': method, 'step_size': step_size,
+               'circumference': circumference}
+    plane_data = {'phase': plane.phase, 'tune': plane.tune,
+                  'Smat': plane.Smat, 'bpm_positions': plane.bpm_positions,
+                  'cm_positions': plane.cm_positions}
+
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                   initargs=(plane_data,))
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers, initializer=_init_worker,
+                                  initargs=(plane_data,))
+    else:
+        raise ValueError("executor must be 'process' or 'thread'.")
+
+    start = time.time()
+    kick_index = np.empty(trial_nb, dtype=int)
+    error = np.empty(trial_nb)
+    with pool:
+        futures = []
+        for i0 in range(0, trial_nb, batch):
+            jobs = [(trials['corrector'][i], trials['frequency'][i],
+                     trials['noise'][i], trials['dropout'][i], seeds[i])
+                    for i in range(i0, min(i0 + batch, trial_nb))]
+            futures.append((i0, pool.submit(_run_trials, jobs, options)))
+        for i0, future in futures:
+            idx, err = future.result()
+            kick_index[i0:i0+len(idx)] = idx
+            error[i0:i0+len(idx)] = err
+
+    trials['kick_index'] = kick_index
+    trials['error'] = error
+    trials['success'] = error <= tolerance
+    result = summarize(trials, bins)
+    result['seed'] = seed
+    result['time'] = time.time() - start
+    return result
+
+
+def summarize(trials, bins):
+    """ Success rates and error histograms of a table of trials (see
+        `run_campaign`).
+    """
+    error = trials['error']
+    success = trials['success']
+
+    correctors = np.unique(trials['corrector'])
+    per_corrector = {'corrector': correctors,
+                     'trials': np.empty(correctors.size, dtype=int),
+                     'success_rate': np.empty(correctors.size),
+                     'mean_error': np.empty(correctors.size),
+                     'histogram': np.empty((correctors.size, len(bins) - 1),
+                                           dtype=int)}
+    for k, cm in enumerate(correctors):
+        mask = trials['corrector'] == cm
+        per_corrector['trials'][k] = np.count_nonzero(mask)
+        per_corrector['success_rate'][k] = np.mean(success[mask])
+        per_corrector['mean_error'][k] = np.mean(error[mask])
+        per_corrector['histogram'][k] = np.histogram(error[mask], bins)[0]
+
+    per_condition = []
+    keys = np.stack([trials['frequency'], trials['noise'],
+                     trials['dropout']], axis=1)
+    for frequency, noise, dropout in np.unique(keys, axis=0):
+        mask = np.all(keys == [frequency, noise, dropout], axis=1)
+        per_condition.append({
+            'frequency': frequency, 'noise': noise, 'dropout': int(dropout),
+            'trials': int(np.count_nonzero(mask)),
+            'success_rate': np.mean(success[mask]),
+            'mean_error': np.mean(error[mask]),
+            'median_error': np.median(error[mask]),
+            'p95_error': np.percentile(error[mask], 95),
+            })
+
+    return {'trials': trials, 'success_rate': np.mean(success),
+            'per_corrector': per_corrector, 'per_condition': per_condition,
+            'bins': np.asarray(bins)}
+
+
+def _init_worker(plane_data):
+    _plane.clear()
+    _plane.update(plane_data)
+
+
+def _run_trials(jobs, options):
+    """ Kick index and error of each `(corrector, frequency, noise, dropout,
+        seed_sequence)` job, run with the plane of the worker.
+    """
+    phase = _plane['phase']
+    Smat = _plane['Smat']
+    bpm_positions = _plane['bpm_positions']
+    cm_positions = _plane['cm_positions']
+    circumference = options['circumference']
+    sample_nb = options['sample_nb']
+
+    kick_index = []
+    errors = []
+    for corrector, frequency, noise, dropout, seed in jobs:
+        rng = np.random.default_rng(seed)
+        kept = np.sort(rng.permutation(phase.size)[dropout:])
+        generator = HarmonicDisturbance(
+            Smat[kept], corrector, frequency, options['amplitude'],
+            rng.uniform(0, 2*np.pi), options['fs'], noise=noise,
+            seed=rng.integers(2**63))
+        values = generator.generate(sample_nb)
+
+        _, phasors, _ = stft_phasors(values, options['fs'], frequency,
+                                     sample_nb, sample_nb)
+        acos, asin = phasors[0].real, phasors[0].imag
+        if options['method'] == 'rotation':
+            acos, _, _ = optimize_rotation(acos, asin, options['step_size'])
+        else:
+            acos = np.real(klt([acos, asin]))[0]
+
+        kick_phase, _ = get_kicks(acos, phase[kept], _plane['tune'])
+        idx = kept[np.argmin(abs(phase[kept] - kick_phase[0]))]
+        distance = abs(bpm_positions[idx] - cm_positions[corrector]) \
+            % circumference
+        kick_index.append(idx)
+        errors.append(min(distance, circumference - distance))
+    return kick_index, errors
@@ -6,9 +6,11 @@ import numpy as np
 from numpy import cos, pi
 import matplotlib.pyplot as plt
 
+from search_kicks.tools.instrument import timed, count
 from search_kicks.tools.maths import fit_sine
 from search_kicks.core import build_sine
 
+@timed()
 def get_kick(orbit, phase, tune, plot=False, error_curves=False):
     """ Find the kick in the orbit.
 
@@ -130,3 +132,75 @@ def get_kick(orbit, phase, tune, plot=False, error_curves=False):
         plt.xlabel(r'phase / $2 \pi$')
         plt.legend(fancybox=True, frameon=True)
     return kick_phase, cos_coefficients[i_best % bpm_nb]
+
+
+@timed()
+def get_kicks(orbits, phase, tune, chunk=256):
+    """ Find the kick in many orbits at once (same as `get_kick` on each).
+
+        For each shift of the sine along the duplicated orbit, the fit matrix
+        only depends on the phases: its pseudo-inverse is computed once and
+        applied to all the orbits, so that the search is a few matrix
+        products instead of a loop of least-square fits.
+
+        Parameters
+        ----------
+        orbits : np.array (orbit_nb x bpm_nb)
+            One orbit per row.
+        phase : np.array
+            Phase.
+        tune : float
+            The orbit tune.
+        chunk : int, optional.
+            Number of orbits processed at once, which bounds the memory used
+            (`chunk*bpm_nb**2` floats). Default to 256.
+
+        Returns
+        -------
+        kick_phases : np.array (orbit_nb)
+            The phases where the kicks were found.
+        cos_coefficients : np.array (orbit_nb x 2)
+            [a, b] for each orbit so that the sine is a*cos(b+phase)
+    """
+    orbits = np.atleast_2d(np.asarray(orbits, dtype=float))
+    orbit_nb, bpm_nb = orbits.shape
+    phase = np.asarray(phase, dtype=float)
+
+    phase_exp = np.concatenate((phase, phase + tune*2*pi))
+    phase_t = _shifts(phase_exp[np.newaxis, :], bpm_nb)[0]
+    fit = np.stack((cos(phase_t), np.sin(phase_t)), axis=2)
+    fit_inv = np.linalg.pinv(fit)
+    count('get_kick.pinv', bpm_nb)
+    count('get_kick.orbits', orbit_nb)
+
+    kick_phases = np.empty(orbit_nb)
+    cos_coefficients = np.empty((orbit_nb, 2))
+    for i0 in range(0, orbit_nb, chunk):
+        block = orbits[i0:i0+chunk]
+        signal_t = _shifts(np.concatenate((block, block), axis=1), bpm_nb)
+        ab = np.einsum('skb,msb->msk', fit_inv, signal_t)
+        residual = signal_t - np.einsum('sbk,msk->msb', fit, ab)
+        i_best = np.argmin(np.sum(residual**2, axis=2), axis=1)
+
+        amp_cos, amp_sin = ab[np.arange(block.shape[0]), i_best].T
+        b = np.hypot(amp_cos, amp_sin)
+        c = -np.arctan2(amp_sin, amp_cos)
+
+        apriori_phase = phase[i_best]
+        k = np.trunc((apriori_phase + c)/pi + tune)
+        solutions = (-c - pi*tune)[:, np.newaxis] + \
+            np.stack((k, k+1), axis=1)*pi
+        idx = np.argmin(abs(solutions - apriori_phase[:, np.newaxis]), axis=1)
+        kick_phases[i0:i0+chunk] = solutions[np.arange(block.shape[0]), idx]
+        cos_coefficients[i0:i0+chunk] = np.stack((b, c), axis=1)
+
+    return kick_phases, cos_coefficients
+
+
+def _shifts(x, n):
+    """ (rows x n x n) view: the windows x[:, i:i+n] for i in range(n). """
+    x = np.ascontiguousarray(x)
+    rows, stride = x.strides
+    return np.lib.stride_tricks.as_strided(
+        x, shape=(x.shape[0], n, n), strides=(rows, stride, stride),
+        writeable=False)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+""" Kick localization by matching the orbit with the response matrix.
+
+    A kick on corrector `k` gives an orbit proportional to the column `k` of
+    the response matrix. The columns are normalized once; the score of `k`
+    for an orbit `z` is then
+
+        score_k = |u_k . z|**2 / |z|**2,    u_k = Smat[:, k]/|Smat[:, k]|
+
+    the part of the orbit explained by this corrector alone (1 for a perfect
+    match, 0 for an orbit orthogonal to the column). All the correctors are
+    scored with one matrix-vector product, many orbits with one matrix
+    product. Complex orbits (`amp_cos + 1j*amp_sin`) are scored whatever
+    their rotation, so the sine/cosine components need not be decorrelated.
+
+    This does not use the phases: it is an independent cross-check of
+    `get_kick`, which also gives the corrector directly.
+
+    >>> matcher = ResponseMatcher.from_lattice(lattice, 'x')
+    >>> acos, asin = extract_sin_cos(values, 150., 10.)
+    >>> matcher.locate(acos + 1j*asin)[0]
+    {'corrector': 20, 'score': 0.99, 'amplitude': (0.7+0.1j), ...}
+"""
+
+from __future__ import division, print_function
+
+import weakref
+
+import numpy as np
+
+from search_kicks.tools.instrument import timed
+
+# matcher of each lattice plane with the response matrix it was built from
+# (see `from_lattice`)
+_matchers = weakref.WeakKeyDictionary()
+
+
+class ResponseMatcher(object):
+    """ Scores orbits against the columns of a response matrix.
+
+        Parameters
+        ----------
+        Smat : np.array (bpm_nb x cm_nb)
+            Response matrix.
+        names, positions : np.array (cm_nb), optional.
+            Names and positions of the correctors, given with the candidates.
+    """
+
+    def __init__(self, Smat, names=None, positions=None):
+        self.Smat = np.asarray(Smat, dtype=float)
+        self.names = names
+        self.positions = positions
+        self.norms = np.linalg.norm(self.Smat, axis=0)
+        norms = np.where(self.norms > 0, self.norms, 1)
+        # (cm_nb x bpm_nb): one normalized column per row
+        self._columns = np.ascontiguousarray((self.Smat/norms).T)
+
+    @classmethod
+    def from_lattice(cls, lattice, axis):
+        """ Matcher of a plane of a `tools.lattice.LatticeModel` (active BPMs
+            and correctors).
+
+            It is built once per plane, the next calls return the same
+            matcher until `plane.Smat` is replaced.
+        """
+        plane = lattice.plane(axis)
+        Smat, matcher = _matchers.get(plane, (None, None))
+        if Smat is not plane.Smat or type(matcher) is not cls:
+            matcher = cls(plane.Smat, plane.cm_names, plane.cm_positions)
+            _matchers[plane] = plane.Smat, matcher
+        return matcher
+
+    @property
+    def bpm_nb(self):
+        return self.Smat.shape[0]
+
+    @property
+    def cm_nb(self):
+        return self.Smat.shape[1]
+
+    def scores(self, orbits, valid=None):
+        """ Score of every corrector for every orbit.
+
+            Parameters
+            ----------
+            orbits : np.array (bpm_nb) or (orbit_nb x bpm_nb)
+                Real or complex orbits.
+            valid : np.array of bool (bpm_nb), optional.
+                BPMs to use, e.g. to leave out broken ones. The columns are
+                then normalized on these BPMs only. Default to all of them.
+
+            Returns
+            -------
+            scores : np.array (cm_nb) or (orbit_nb x cm_nb)
+                In [0, 1].
+            amplitudes : np.array, same shape
+                Kick of each corrector that best fits each orbit (complex
+                for complex orbits).
+        """
+        orbits = np.asarray(orbits)
+        single = orbits.ndim == 1
+        orbits = np.atleast_2d(orbits)
+        if orbits.shape[1] != self.bpm_nb:
+            raise ValueError("The orbits have {} BPMs, the response matrix "
+                             "{}.".format(orbits.shape[1], self.bpm_nb))
+
+        columns = self._columns
+        norms = self.norms
+        if valid is not None:
+            valid = np.asarray(valid, dtype=bool)
+            orbits = orbits[:, valid]
+            norms = np.linalg.norm(self.Smat[valid], axis=0)
+            columns = self.Smat[valid].T/np.where(norms > 0, norms, 1)[:, None]
+
+        projections = orbits.dot(columns.T)
+        energy = np.sum(np.abs(orbits)**2, axis=1)[:, np.newaxis]
+        scores = np.abs(projections)**2/np.where(energy > 0, energy, 1)
+        amplitudes = projections/np.where(norms > 0, norms, np.inf)
+        if single:
+            return scores[0], amplitudes[0]
+        return scores, amplitudes
+
+    @timed('match.locate')
+    def locate(self, orbit, count=5, valid=None):
+        """ The `count` correctors that best explain the orbit.
+
+            Parameters
+            ----------
+            orbit : np.array (bpm_nb)
+                Real or complex orbit.
+            count : int, optional.
+                Number of candidates. Default to 5.
+            valid : np.array of bool (bpm_nb), optional.
+                See `scores`.
+
+            Returns
+            -------
+            list of dict
+                `{'corrector', 'score', 'amplitude', 'name', 'position'}`,
+                best first (`name` and `position` are None if not known).
+        """
+        candidates = self.locate_many(np.atleast_2d(orbit), count, valid)
+        return [{'corrector': int(candidates['corrector'][0, i]),
+                 'score': candidates['score'][0, i],
+                 'amplitude': candidates['amplitude'][0, i],
+                 'name': _item(candidates['name'], i),
+                 'position': _item(candidates['position'], i)}
+                for i in range(candidates['corrector'].shape[1])]
+
+    @timed('match.locate_many')
+    def locate_many(self, orbits, count=5, valid=None):
+        """ The `count` best correctors of each orbit.
+
+            Parameters
+            ----------
+            orbits : np.array (orbit_nb x bpm_nb)
+            count : int, optional.
+                Default to 5.
+            valid : np.array of bool (bpm_nb), optional.
+                See `scores`.
+
+            Returns
+            -------
+            dict
+                `{'corrector', 'score', 'amplitude', 'name', 'position'}` of
+                (orbit_nb x count) arrays, best first on each row (`name`
+                and `position` are None if not known).
+        """
+        scores, amplitudes = self.scores(np.atleast_2d(orbits), valid)
+        count = min(count, self.cm_nb)
+        rows = np.arange(scores.shape[0])[:, np.newaxis]
+        best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+        best = best[rows, np.argsort(-scores[rows, best], axis=1)]
+        return {'corrector': best,
+                'score': scores[rows, best],
+                'amplitude': amplitudes[rows, best],
+                'name': None if self.names is None
+                        else np.asarray(self.names)[best],
+                'position': None if self.positions is None
+                            else np.asarray(self.positions)[best]}
+
+
+def _item(array, i):
+    return None if array is None else array[0, i]
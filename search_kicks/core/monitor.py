@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+""" Continuous kick monitoring on the BPM stream.
+
+    `KickMonitor` receives the `FOFB-BPM-DATA` frames, keeps a rolling
+    window of them and, every `period` frames, localizes the kick at the
+    watched frequency in the window. Everything that does not depend on the
+    data is prepared once (lattice planes, pseudo-inverses of the response
+    matrices, table of phasors), and the sine/cosine components of the window
+    are updated at each frame by a sliding lock-in instead of being
+    recomputed: a cycle only costs the decorrelation and the kick searches.
+
+    The results are given to a sink (JSON lines in a file or UDP datagrams)
+    with the latency of the cycle and the number of frames dropped upstream.
+
+    `kick_pipeline` builds the same analysis as a staged pipeline, with its
+    stages running concurrently.
+"""
+
+from __future__ import division, print_function
+
+from datetime import datetime
+import json
+import socket
+import time
+
+import numpy as np
+
+from search_kicks.tools.acquisition import RingBuffer, X_PART, Y_PART, \
+    FRAME_DTYPE
+from search_kicks.tools.maths import extract_sin_cos, optimize_rotation, \
+    inverse_with_svd
+from search_kicks.tools.pipeline import Pipeline, Stage
+from .analysis import QUADRATURES
+from .get_kick import get_kick
+
+
+class SlidingLockIn(object):
+    """ Sine/cosine components of a sliding window, updated frame by frame.
+
+        The frequency is rounded to the frequency grid of the window (as in
+        `extract_sin_cos`), so that the phasors are periodic and taken from a
+        table: there is no drift however long it runs.
+
+        Parameters
+        ----------
+        channel_nb : int
+        window : int
+            Number of frames in the window.
+        sampling_frequency : float
+        frequency : float
+    """
+
+    def __init__(self, channel_nb, window, sampling_frequency, frequency):
+        k = int(round(frequency*window/sampling_frequency))
+        self.frequency = k*sampling_frequency/window
+        self.window = window
+        self._phasors = np.exp(-2j*np.pi*k*np.arange(window)/window)
+        self._sum = np.zeros(channel_nb, dtype=complex)
+
+    def reset(self, frames, first):
+        """ Recompute the sum from the frames (channel_nb x window) of the
+            window, whose first frame has the number `first`.
+        """
+        idx = (first + np.arange(frames.shape[1])) % self.window
+        self._sum = np.dot(frames, self._phasors[idx])
+
+    def update(self, new, new_idx, old=None):
+        """ Add the frame number `new_idx` and remove `old`, the frame that
+            leaves the window (same phasor, a window earlier).
+        """
+        phasor = self._phasors[new_idx % self.window]
+        if old is None:
+            self._sum += phasor*new
+        else:
+            self._sum += phasor*(new - old)
+
+    def components(self, first):
+        """ (cos, sin) components of the window whose first frame has the
+            number `first`, as `extract_sin_cos`.
+        """
+        y = self._sum*np.conj(self._phasors[first % self.window])
+        y *= 2/self.window
+        return y.real, y.imag
+
+
+class KickMonitor(object):
+    """ Localize the kick at a frequency on rolling windows of the stream.
+
+        Parameters
+        ----------
+        client : object
+            Source of the frames, with a `receive(n)` method (`ZmqClient`,
+            `acquisition.LocalPublisher`...).
+        lattice : tools.lattice.LatticeModel
+        frequency : float
+            Frequency to watch, in Hz.
+        window : int, optional.
+            Number of frames analyzed. Default to 300 (2 s at 150 Hz).
+        period : int, optional.
+            Number of frames between two analyses. Default to 150.
+        planes : 'x', 'y' or 'xy', optional.
+            Default to 'xy'.
+        sink : callable, optional.
+            `sink(result)` is called after each analysis, e.g. a `FileSink`
+            or a `UdpSink`.
+        sampling_frequency : float, optional.
+            Default to 150 Hz.
+        svd_values : int, optional.
+            Singular values kept in the pseudo-inverses. Default to 32.
+        step_size : float, optional.
+            Step of the rotation search in degrees. Default to 0.1.
+        chunk : int, optional.
+            Number of frames asked to the client at once. Default to 16.
+        refresh : int, optional.
+            The lock-in sums are recomputed from the window every `refresh`
+            analyses, to get rid of the rounding errors. Default to 100.
+    """
+
+    def __init__(self, client, lattice, frequency, window=300, period=150,
+                 planes='xy', sink=None, sampling_frequency=150.,
+                 svd_values=32, step_size=0.1, chunk=16, refresh=100):
+        if planes not in ['x', 'y', 'xy']:
+            raise ValueError("planes must be 'x', 'y' or 'xy'.")
+        self.client = client
+        self.frequency = frequency
+        self.window = window
+        self.period = period
+        self.planes = planes
+        self.sink = sink
+        self.sampling_frequency = sampling_frequency
+        self.step_size = step_size
+        self.chunk = chunk
+        self.refresh = refresh
+
+        self.planes_data = dict((axis, lattice.plane(axis))
+                                for axis in planes)
+        self.S_inv = dict((axis, inverse_with_svd(plane.Smat, svd_values))
+                          for axis, plane in self.planes_data.items())
+        self.buffer = None
+        self.lockins = None
+        self.results = []
+        self.stats = {'frames': 0, 'cycles': 0, 'dropped': 0, 'overruns': 0,
+                      'latency_last': 0., 'latency_max': 0.,
+                      'latency_mean': 0.}
+
+        self._last_sequence = None
+        self._since_analysis = 0
+
+    def run(self, cycles=None, duration=None):
+        """ Receive and analyze until `cycles` analyses were made or for
+            `duration` seconds (forever by default).
+
+            Returns
+            -------
+            dict
+                The statistics `stats`.
+        """
+        start = time.time()
+        done = self.stats['cycles']
+        while True:
+            if cycles is not None and self.stats['cycles'] - done >= cycles:
+                break
+            if duration is not None and time.time() - start >= duration:
+                break
+            for message in self.client.receive(self.chunk):
+                self.push_message(message)
+        return self.stats
+
+    def push_message(self, message):
+        """ Add the frame of a `FOFB-BPM-DATA` message, analyze the window
+            if it is time to.
+        """
+        try:
+            sequence = int(message[1])
+        except (ValueError, TypeError, IndexError):
+            sequence = None
+        if sequence is not None and self._last_sequence is not None:
+            self.stats['dropped'] += max(0, sequence - self._last_sequence
+                                         - 1)
+        self._last_sequence = sequence
+
+        return self.push(np.frombuffer(message[X_PART], dtype=FRAME_DTYPE),
+                         np.frombuffer(message[Y_PART], dtype=FRAME_DTYPE))
+
+    def push(self, x, y):
+        """ Add one frame, return the result of the analysis if one was
+            made.
+        """
+        if self.buffer is None:
+            self._start(x.size)
+
+        n = self.buffer.count
+        old = None
+        if n >= self.window:
+            old_x, old_y = self.buffer.window(self.window)
+            old = {'x': old_x[:, 0], 'y': old_y[:, 0]}
+        for axis in self.planes:
+            plane = self.planes_data[axis]
+            new = (x if axis == 'x' else y)[plane.bpm_idx]
+            self.lockins[axis].update(
+                new, n, None if old is None else old[axis][plane.bpm_idx])
+        self.buffer.push(x, y)
+        self.stats['frames'] += 1
+        self._since_analysis += 1
+
+        if n + 1 >= self.window and self._since_analysis >= self.period:
+            self._since_analysis = 0
+            return self.analyze()
+        return None
+
+    def analyze(self):
+        """ Localize the kick in the current window and publish it. """
+        start = time.time()
+        cycle = self.stats['cycles']
+        first = self.buffer.count - self.window
+
+        if self.refresh and cycle % self.refresh == 0:
+            x, y = self.buffer.window(self.window)
+            for axis in self.planes:
+                frames = x if axis == 'x' else y
+                self.lockins[axis].reset(
+                    frames[self.planes_data[axis].bpm_idx], first)
+
+        result = {'frame': self.buffer.count,
+                  'date': datetime.now().isoformat(),
+                  'frequency': self.lockins[self.planes[0]].frequency}
+        for axis in self.planes:
+            acos, asin = self.lockins[axis].components(first)
+            result[axis], components = locate_kick(
+                acos, asin, self.planes_data[axis], self.step_size)
+            correct_kick(result[axis], components, self.S_inv[axis])
+
+        latency = time.time() - start
+        stats = self.stats
+        stats['cycles'] += 1
+        stats['latency_last'] = latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+        stats['latency_mean'] += (latency - stats['latency_mean'])/(cycle+1)
+        if latency > self.period/self.sampling_frequency:
+            stats['overruns'] += 1
+        result['latency'] = latency
+        result['dropped'] = stats['dropped']
+
+        self.results.append(result)
+        if self.sink is not None:
+            self.sink(result)
+        return result
+
+    def _start(self, bpm_nb):
+        self.buffer = RingBuffer(bpm_nb, self.window)
+        self.lockins = dict(
+            (axis, SlidingLockIn(plane.bpm_idx.size, self.window,
+                                 self.sampling_frequency, self.frequency))
+            for axis, plane in self.planes_data.items())
+
+
+def locate_kick(acos, asin, plane, step_size=0.1):
+    """ Kick in the cosine and sine components of one plane, after their
+        decorrelation by rotation.
+
+        Returns
+        -------
+        result : dict
+            `{'angle': rotation angle, 'cos': kick, 'sin': kick}` with
+            `kick = {'phase', 'index', 'name', 'position', 'amplitude'}`, in
+            plain Python types.
+        components : np.array (2 x bpm_nb)
+            Rotated cosine and sine components.
+    """
+    acos, asin, angle = optimize_rotation(acos, asin, step_size)
+    result = {'angle': float(angle)}
+    for quadrature, component in zip(QUADRATURES, [acos, asin]):
+        kick_phase, _ = get_kick(component, plane.phase, plane.tune)
+        idx = int(np.argmin(abs(plane.phase - kick_phase)))
+        result[quadrature] = {
+            'phase': float(kick_phase),
+            'index': idx,
+            'name': (None if plane.bpm_names is None
+                     else str(plane.bpm_names[idx])),
+            'position': (None if plane.bpm_positions is None
+                         else float(plane.bpm_positions[idx])),
+            'amplitude': float(np.sqrt(np.mean(component**2))),
+            }
+    return result, np.array([acos, asin])
+
+
+def correct_kick(result, components, S_inv):
+    """ Add the index of the strongest corrector of the correction of each
+        quadrature to the `result` of `locate_kick`.
+    """
+    corrections = np.dot(S_inv, components.T).T
+    for quadrature, correction in zip(QUADRATURES, corrections):
+        result[quadrature]['corrector'] = int(np.argmax(abs(correction)))
+    return result
+
+
+class WindowStage(object):
+    """ Acquisition stage: decode the messages and emit a copy of the last
+        `window` frames every `period` frames.
+    """
+
+    def __init__(self, window, period):
+        self.window = window
+        self.period = period
+        self.buffer = None
+        self._since = 0
+
+    def __call__(self, message):
+        x = np.frombuffer(message[X_PART], dtype=FRAME_DTYPE)
+        y = np.frombuffer(message[Y_PART], dtype=FRAME_DTYPE)
+        if self.buffer is None:
+            self.buffer = RingBuffer(x.size, self.window)
+        self.buffer.push(x, y)
+        self._since += 1
+        if self.buffer.count < self.window or self._since < self.period:
+            return None
+        self._since = 0
+        x, y = self.buffer.window(self.window)
+        return {'frame': self.buffer.count, 'x': x.copy(), 'y': y.copy()}
+
+
+class ExtractStage(object):
+    """ Lock-in stage: sine/cosine components of the active BPMs. """
+
+    def __init__(self, planes, sampling_frequency, frequency):
+        self.planes = planes
+        self.sampling_frequency = sampling_frequency
+        self.frequency = frequency
+
+    def __call__(self, item):
+        out = {'frame': item['frame']}
+        for axis, plane in self.planes.items():
+            out[axis] = extract_sin_cos(item[axis][plane.bpm_idx],
+                                        self.sampling_frequency,
+                                        self.frequency, verbose=False)
+        return out
+
+
+class LocateStage(object):
+    """ Localization stage, see `locate_kick`. """
+
+    def __init__(self, planes, step_size=0.1):
+        self.planes = planes
+        self.step_size = step_size
+
+    def __call__(self, item):
+        out = {'frame': item['frame'], 'components': dict()}
+        for axis, plane in self.planes.items():
+            acos, asin = item[axis]
+            out[axis], out['components'][axis] = locate_kick(
+                acos, asin, plane, self.step_size)
+        return out
+
+
+class CorrectStage(object):
+    """ Correction stage, see `correct_kick`. """
+
+    def __init__(self, S_inv):
+        self.S_inv = S_inv
+
+    def __call__(self, item):
+        components = item.pop('components')
+        for axis, S_inv in self.S_inv.items():
+            correct_kick(item[axis], components[axis], S_inv)
+        return item
+
+
+def kick_pipeline(lattice, frequency, sink, window=300, period=150,
+                  planes='xy', sampling_frequency=150., svd_values=32,
+                  step_size=0.1, workers=2, executor='thread'):
+    """ Kick monitoring as a staged pipeline (see `tools.pipeline`):
+        acquire -> extract -> locate -> correct -> sink.
+
+        The messages are given with `put` or `feed`. The acquisition stage
+        (which only copies the frames) blocks; the analysis stages drop their
+        oldest window when they cannot keep up, so that the intake never
+        waits for them. With several workers, the results can reach the sink
+        out of order: they carry the number of their last `frame`.
+
+        Parameters
+        ----------
+        lattice : tools.lattice.LatticeModel
+        frequency : float
+        sink : callable
+            `sink(result)`, called from the sink stage thread.
+        window, period : int, optional.
+            Frames per analysis and between two analyses. Default to 300 and
+            150.
+        planes : 'x', 'y' or 'xy', optional.
+        sampling_frequency : float, optional.
+        svd_values : int, optional.
+        step_size : float, optional.
+        workers : int, optional.
+            Workers of the extraction and localization stages. Default to 2.
+        executor : 'thread' or 'process', optional.
+            Workers of the extraction and localization stages. Default to
+            'thread'.
+
+        Returns
+        -------
+        tools.pipeline.Pipeline
+    """
+    if planes not in ['x', 'y', 'xy']:
+        raise ValueError("planes must be 'x', 'y' or 'xy'.")
+    planes_data = dict((axis, lattice.plane(axis)) for axis in planes)
+    S_inv = dict((axis, inverse_with_svd(plane.Smat, svd_values))
+                 for axis, plane in planes_data.items())
+
+    return Pipeline([
+        Stage('acquire', WindowStage(window, period), queue_size=4*window),
+        Stage('extract', ExtractStage(planes_data, sampling_frequency,
+                                      frequency),
+              workers=workers, queue_size=2, policy='drop_oldest',
+              executor=executor),
+        Stage('locate', LocateStage(planes_data, step_size),
+              workers=workers, queue_size=2, policy='drop_oldest',
+              executor=executor),
+        Stage('correct', CorrectStage(S_inv), queue_size=4),
+        Stage('sink', sink, queue_size=16),
+        ])
+
+
+class FileSink(object):
+    """ Append the results to a file, one JSON object per line. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'a')
+
+    def __call__(self, result):
+        self._file.write(json.dumps(result) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class UdpSink(object):
+    """ Send the results as JSON datagrams to `(host, port)`. """
+
+    def __init__(self, host='127.0.0.1', port=5564):
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, result):
+        self._socket.sendto(json.dumps(result).encode('utf8'), self.address)
+
+    def close(self):
+        self._socket.close()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+""" Kick tracking over long recordings.
+
+    The recording is cut into overlapping windows. The sine/cosine phasors
+    of all the windows are computed in one short-time transform, the kicks of
+    all the windows are then found with the batched `get_kicks`: the result
+    is a track of the kick location along the time.
+
+    The windows are processed by blocks, so that the time is linear in the
+    length of the recording and the memory only depends on the number of
+    windows (and on the block size).
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+from search_kicks.tools.instrument import timed
+from search_kicks.tools.maths import optimize_rotation
+from .analysis import QUADRATURES
+from .get_kick import get_kicks
+
+
+@timed()
+def stft_phasors(values, fs, frequency, window, step, block=64):
+    """ Phasors at `frequency` of overlapping windows of the signals.
+
+        For each window, this gives the same as `extract_sin_cos` on it:
+        the frequency is rounded to the frequency grid of the window and the
+        phase is relative to the start of the window.
+
+        Parameters
+        ----------
+        values : np.array (channel_nb x sample_nb)
+        fs : float
+            Sampling frequency.
+        frequency : float
+        window : int
+            Number of samples of a window.
+        step : int
+            Number of samples between the starts of two windows.
+        block : int, optional.
+            Number of windows computed at once. Default to 64.
+
+        Returns
+        -------
+        starts : np.array (window_nb)
+            Index of the first sample of each window.
+        phasors : np.array (window_nb x channel_nb) of complex
+            `amp_cos + 1j*amp_sin` of each window and channel.
+        frequency : float
+            The frequency actually used.
+    """
+    channel_nb, sample_nb = values.shape
+    if sample_nb < window:
+        raise ValueError("The signals are shorter ({}) than a window ({})."
+                         .format(sample_nb, window))
+    k = int(round(frequency*window/fs))
+    # periodic phasors: exact whatever the length of the recording
+    table = np.exp(-2j*np.pi*k*np.arange(window)/window)
+
+    starts = np.arange(0, sample_nb - window + 1, step)
+    phasors = np.empty((starts.size, channel_nb), dtype=complex)
+    for b0 in range(0, starts.size, block):
+        block_starts = starts[b0:b0+block]
+        i0 = block_starts[0]
+        i1 = block_starts[-1] + window
+        n = np.arange(i0, i1)
+        # cumulated sum of x*exp(-j*w*n) with a leading 0
+        cumsum = np.zeros((channel_nb, i1 - i0 + 1), dtype=complex)
+        np.cumsum(values[:, i0:i1]*table[n % window], axis=1,
+                  out=cumsum[:, 1:])
+        sums = (cumsum[:, block_starts - i0 + window] -
+                cumsum[:, block_starts - i0])
+        # phase relative to the start of each window
+        sums *= np.conj(table[block_starts % window])
+        phasors[b0:b0+block] = sums.T*2/window
+    return starts, phasors, k*fs/window
+
+
+@timed()
+def track_kicks(orbit, lattice, frequency, window=300, step=150,
+                planes='xy', step_size=0.1, chunk=256):
+    """ Kick location at `frequency` in each window of the orbit.
+
+        Parameters
+        ----------
+        orbit : tools.io.OrbitData
+            Recording. The BPM arrays are either for all the BPMs of the
+            machine or for the active BPMs of the lattice model.
+        lattice : tools.lattice.LatticeModel
+        frequency : float
+            In Hz.
+        window : int, optional.
+            Samples per window. Default to 300 (2 s at 150 Hz).
+        step : int, optional.
+            Samples between two windows. Default to 150.
+        planes : 'x', 'y' or 'xy', optional.
+        step_size : float, optional.
+            Step of the rotation search in degrees. Default to 0.1.
+        chunk : int, optional.
+            Orbits localized at once, see `get_kicks`. Default to 256.
+
+        Returns
+        -------
+        dict
+            `{'time': center of each window in s, 'frequency': frequency
+            used, 'x': track, 'y': track}` with
+            `track = {'angle': rotation angle, 'cos': kicks, 'sin': kicks}`
+            and `kicks = {'phase', 'index', 'position', 'name',
+            'amplitude'}`, arrays with one value per window (`position` and
+            `name` are None if not known).
+    """
+    if planes not in ['x', 'y', 'xy']:
+        raise ValueError("planes must be 'x', 'y' or 'xy'.")
+    fs = orbit.sampling_frequency
+    result = dict()
+    for axis in planes:
+        plane = lattice.plane(axis)
+        values = orbit.BPMx if axis == 'x' else orbit.BPMy
+        if values.shape[0] != plane.phase.size:
+            values = values[plane.bpm_idx, :]
+        starts, phasors, f0 = stft_phasors(values, fs, frequency, window,
+                                           step)
+        result['time'] = (starts + window/2)/fs
+        result['frequency'] = f0
+
+        components = np.empty((2, starts.size, plane.phase.size))
+        angles = np.empty(starts.size)
+        for i, z in enumerate(phasors):
+            components[0, i], components[1, i], angles[i] = \
+                optimize_rotation(z.real, z.imag, step_size)
+
+        track = {'angle': angles}
+        for q, quadrature in enumerate(QUADRATURES):
+            kick_phases, _ = get_kicks(components[q], plane.phase,
+                                       plane.tune, chunk)
+            idx = np.argmin(abs(plane.phase[np.newaxis, :] -
+                                kick_phases[:, np.newaxis]), axis=1)
+            track[quadrature] = {
+                'phase': kick_phases,
+                'index': idx,
+                'position': (None if plane.bpm_positions is None
+                             else plane.bpm_positions[idx]),
+                'name': (None if plane.bpm_names is None
+                         else plane.bpm_names[idx]),
+                'amplitude': np.sqrt(np.mean(components[q]**2, axis=1)),
+                }
+        result[axis] = track
+    return result
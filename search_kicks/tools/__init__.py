@@ -11,6 +11,9 @@ __email__ = "olivier.churlaud@helmholtz-berlin.de"
 __status__ = "Developpement"
 
 
-__all__ = ["io", "maths"]
+__all__ = ["io", "maths", "cache", "acquisition", "trigger", "lattice",
+           "machine", "shared", "pipeline", "instrument",
+           "synthetic"]
 
-from . import io, maths
+from . import io, maths, cache, acquisition, trigger, lattice, machine, shared
+from . import pipeline, instrument, synthetic
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+
+""" Acquisition of the FOFB BPM stream.
+
+    The frames published on `FOFB-BPM-DATA` are multipart messages whose
+    3rd and 4th parts are the X and Y positions of all BPMs as raw doubles.
+    They are decoded with `np.frombuffer` (no parsing, no intermediate list)
+    and written into a preallocated ring buffer, from which the last samples
+    can be read as views without any copy.
+
+    Long recordings are assembled by an `OrbitRecorder`, whose buffers grow
+    by doubling and which can be flushed to HDF5 as the samples arrive.
+"""
+
+from __future__ import division, print_function
+
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+
+from .io import OrbitData, DATETIME_ISO
+
+FRAME_DTYPE = np.dtype('double')
+X_PART = 2
+Y_PART = 3
+
+
+class RingBuffer(object):
+    """ Fixed-size circular buffer of BPM frames.
+
+        Every frame is written twice, at `i` and `i + capacity`, so that the
+        last `n <= capacity` frames can always be returned as a view. The
+        buffer is stored BPM first: each BPM of a window is a contiguous row,
+        the layout of the analyses (FFT, sine/cosine fits along the time
+        axis).
+
+        Parameters
+        ----------
+        bpm_nb : int
+            Number of BPMs in a frame.
+        capacity : int
+            Number of frames kept.
+        dtype : np.dtype, optional.
+            Type of the stored values. Default to float64.
+    """
+
+    def __init__(self, bpm_nb, capacity, dtype=np.float64):
+        if capacity <= 0:
+            raise ValueError("The capacity must be positive.")
+        self.bpm_nb = bpm_nb
+        self.capacity = capacity
+        # data[plane, bpm, frame]: the time series of a BPM is a row
+        self._data = np.zeros((2, bpm_nb, 2*capacity), dtype=dtype)
+        self._position = 0
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def push(self, x, y):
+        """ Append one frame.
+
+            Parameters
+            ----------
+            x, y : bytes-like or np.array
+                Positions of the BPMs. Bytes are decoded as doubles.
+        """
+        if not isinstance(x, np.ndarray):
+            x = np.frombuffer(x, dtype=FRAME_DTYPE)
+        if not isinstance(y, np.ndarray):
+            y = np.frombuffer(y, dtype=FRAME_DTYPE)
+        if x.size != self.bpm_nb or y.size != self.bpm_nb:
+            raise ValueError("Frames must have {} BPMs, not {} and {}."
+                             .format(self.bpm_nb, x.size, y.size))
+
+        i = self._position
+        data = self._data
+        data[0, :, i] = x
+        data[0, :, i + self.capacity] = x
+        data[1, :, i] = y
+        data[1, :, i + self.capacity] = y
+
+        self._position = (i + 1) % self.capacity
+        self.count += 1
+
+    def push_message(self, message):
+        """ Append the frame of a multipart `FOFB-BPM-DATA` message. """
+        self.push(message[X_PART], message[Y_PART])
+
+    def extend(self, messages):
+        """ Append the frames of several messages. """
+        for message in messages:
+            self.push_message(message)
+
+    def window(self, n=None):
+        """ Last `n` frames, as views of shape (bpm_nb, n).
+
+            Parameters
+            ----------
+            n : int, optional.
+                Number of frames. Default to all the frames available.
+
+            Returns
+            -------
+            x, y : np.array (bpm_nb x n)
+                Views on the buffer, each row contiguous in memory. They are
+                overwritten by the next frames, copy them to keep them.
+        """
+        available = len(self)
+        if n is None:
+            n = available
+        if n > available:
+            raise ValueError("Only {} frames are available, not {}."
+                             .format(available, n))
+
+        end = self._position + self.capacity
+        block = self._data[:, :, end-n:end]
+        return block[0], block[1]
+
+    def orbit(self, n=None, sampling_frequency=150., measure_date=None):
+        """ Last `n` frames as an `OrbitData` (views, see `window`). """
+        x, y = self.window(n)
+        return OrbitData(BPMx=x, BPMy=y,
+                         sampling_frequency=sampling_frequency,
+                         measure_date=measure_date)
+
+
+class OrbitRecorder(object):
+    """ Append-only orbit recording.
+
+        The samples of each family are stored in a (item_nb, capacity) array
+        whose capacity is doubled when it is full, so that appending is
+        amortized O(1) and the recorded samples are always contiguous: they
+        are read as an `OrbitData` of views (see `orbit`).
+
+        With `max_samples`, only the last samples are kept (bounded history):
+        the capacity is then fixed to `2*max_samples` and, when it is full,
+        the last samples are moved back to the start of the buffers.
+
+        With `filename`, the samples can be written to an HDF5 file (same
+        layout as `io.save_orbit_hdf5`) as they arrive, see `flush`. They are
+        always flushed before being dropped from a bounded history.
+
+        Parameters
+        ----------
+        sampling_frequency : float
+            In Hz.
+        names : dict, optional.
+            Names of the items, as in `OrbitData`.
+        measure_date : datetime.datetime, optional.
+            Date of the first sample. Default to the date of the first
+            `append`.
+        capacity : int, optional.
+            Initial number of samples allocated. Default to 1024.
+        max_samples : int, optional.
+            Number of samples kept. Default to all.
+        dtype : np.dtype, optional.
+            Default to float64.
+        filename : str, optional.
+            HDF5 file to write.
+    """
+
+    FAMILIES = ['BPMx', 'BPMy', 'CMx', 'CMy']
+
+    def __init__(self, sampling_frequency, names=None, measure_date=None,
+                 capacity=1024, max_samples=None, dtype=np.float64,
+                 filename=None):
+        if max_samples is not None:
+            if max_samples <= 0:
+                raise ValueError("max_samples must be positive.")
+            capacity = 2*max_samples
+        if capacity <= 0:
+            raise ValueError("The capacity must be positive.")
+        self.sampling_frequency = float(sampling_frequency)
+        self.names = names
+        self.measure_date = measure_date
+        self.max_samples = max_samples
+        self.dtype = dtype
+        self.filename = filename
+
+        self._capacity = capacity
+        self._data = None
+        self._size = 0
+        self._discarded = 0
+        self._flushed = 0
+        self._file = None
+
+    def __len__(self):
+        if self.max_samples is None:
+            return self._size
+        return min(self._size, self.max_samples)
+
+    @property
+    def count(self):
+        """ Number of samples appended since the start. """
+        return self._discarded + self._size
+
+    @property
+    def sample_number(self):
+        """ Number of samples available. """
+        return len(self)
+
+    @property
+    def time(self):
+        """ Time of the available samples, in s since `measure_date`. """
+        return np.arange(self.count - len(self), self.count
+                         )/self.sampling_frequency
+
+    def append(self, BPMx=None, BPMy=None, CMx=None, CMy=None):
+        """ Append one sample (1-D arrays) or a block of samples (2-D arrays
+            item_nb x sample_nb).
+
+            The families given in the first call must be given in all the
+            next ones.
+        """
+        arrays = {'BPMx': BPMx, 'BPMy': BPMy, 'CMx': CMx, 'CMy': CMy}
+        for key, x in arrays.items():
+            if x is not None:
+                x = np.asarray(x)
+                arrays[key] = x[:, np.newaxis] if x.ndim == 1 else x
+        if self._data is None:
+            self._allocate(arrays)
+
+        n = None
+        for key in self.FAMILIES:
+            x = arrays[key]
+            if (x is None) != (key not in self._data):
+                raise ValueError("The families appended must always be {}."
+                                 .format(sorted(self._data.keys())))
+            if x is None:
+                continue
+            if x.ndim != 2 or x.shape[0] != self._data[key].shape[0]:
+                raise ValueError("{} must have {} items, not {}."
+                                 .format(key, self._data[key].shape[0],
+                                         x.shape))
+            if n is not None and x.shape[1] != n:
+                raise ValueError("All arrays must have the same number of "
+                                 "samples.")
+            n = x.shape[1]
+
+        # a bounded history receives at most max_samples at once
+        step = n if self.max_samples is None else self.max_samples
+        for i in range(0, n, step):
+            self._write(dict((k, x[:, i:i+step]) for k, x in arrays.items()
+                             if x is not None))
+
+    def push_message(self, message):
+        """ Append the frame of a multipart `FOFB-BPM-DATA` message. """
+        self.append(BPMx=np.frombuffer(message[X_PART], dtype=FRAME_DTYPE),
+                    BPMy=np.frombuffer(message[Y_PART], dtype=FRAME_DTYPE))
+
+    def extend(self, messages):
+        """ Append the frames of several messages. """
+        for message in messages:
+            self.push_message(message)
+
+    def orbit(self):
+        """ Available samples as an `OrbitData`.
+
+            The arrays are views on the buffers: they are only valid until
+            the next `append`, copy them to keep them.
+        """
+        if self._data is None:
+            raise ValueError("Nothing was recorded.")
+        n = len(self)
+        first = self.count - n
+        arrays = dict((k, x[:, self._size-n:self._size])
+                      for k, x in self._data.items())
+        return OrbitData(names=self.names,
+                         sampling_frequency=self.sampling_frequency,
+                         measure_date=(self.measure_date +
+                                       timedelta(seconds=first /
+                                                 self.sampling_frequency)),
+                         **arrays)
+
+    def flush(self):
+        """ Write the samples not written yet to `filename`. """
+        if self.filename is None:
+            raise ValueError("No file to flush to.")
+        if self._data is None:
+            return
+        if self._file is None:
+            self._create_file()
+        f = self._file
+        start = self._flushed - self._discarded
+        for key in self.FAMILIES:
+            dataset = f['data/' + key]
+            dataset.resize(self.count, axis=1)
+            if key in self._data:
+                dataset[:, self._flushed:] = self._data[key][:, start:
+                                                             self._size]
+        f.flush()
+        self._flushed = self.count
+
+    def close(self):
+        """ Flush the last samples and close the file. """
+        if self.filename is not None:
+            self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _allocate(self, arrays):
+        if self.measure_date is None:
+            self.measure_date = datetime.now()
+        self._data = dict((k, np.empty((x.shape[0], self._capacity),
+                                       dtype=self.dtype))
+                          for k, x in arrays.items() if x is not None)
+
+    def _write(self, arrays):
+        n = next(iter(arrays.values())).shape[1]
+        if self._size + n > self._capacity:
+            if self.max_samples is None:
+                self._grow(max(2*self._capacity, self._size + n))
+            else:
+                self._discard(self._size + n - self.max_samples)
+        for k, x in arrays.items():
+            self._data[k][:, self._size:self._size+n] = x
+        self._size += n
+
+    def _grow(self, capacity):
+        for k, x in self._data.items():
+            data = np.empty((x.shape[0], capacity), dtype=self.dtype)
+            data[:, :self._size] = x[:, :self._size]
+            self._data[k] = data
+        self._capacity = capacity
+
+    def _discard(self, n):
+        """ Drop the `n` oldest samples, move the others to the start. """
+        if self.filename is not None:
+            self.flush()
+        for x in self._data.values():
+            x[:, :self._size-n] = x[:, n:self._size]
+        self._size -= n
+        self._discarded += n
+
+    def _create_file(self):
+        # created before any sample is discarded (see `_discard`)
+        f = h5py.File(self.filename, 'w')
+        for key in self.FAMILIES:
+            rows = self._data[key].shape[0] if key in self._data else 0
+            f.create_dataset('data/' + key, shape=(rows, 0),
+                             maxshape=(rows or None, None), dtype=self.dtype,
+                             chunks=(max(rows, 1), 1024))
+            names = [] if self.names is None else self.names[key]
+            f.create_dataset('names/' + key,
+                             data=[] if names is None else names)
+        f.create_dataset('sampling_frequency', data=self.sampling_frequency)
+        f.attrs['data_structure'] = "array[item, time_sample]"
+        f.attrs['measure_date'] = self.measure_date.strftime(DATETIME_ISO)
+        f.attrs['creation_date'] = datetime.now().strftime(DATETIME_ISO)
+        f.attrs['__version__'] = '1.0'
+        self._file = f
+
+
+def acquire(client, buffer, frame_nb, chunk=1):
+    """ Receive `frame_nb` frames from `client` into `buffer`.
+
+        Parameters
+        ----------
+        client : object
+            Any object with a `receive(n)` method returning a list of
+            multipart messages (`ZmqClient`, `LocalPublisher`...).
+        buffer : RingBuffer
+            Where the frames are written.
+        frame_nb : int
+            Number of frames to receive.
+        chunk : int, optional.
+            Number of messages asked to the client at once. Default to 1.
+    """
+    received = 0
+    while received < frame_nb:
+        messages = client.receive(min(chunk, frame_nb - received))
+        buffer.extend(messages)
+        received += len(messages)
+    return buffer
+
+
+class ZmqSubscriber(object):
+    """ Subscriber to the `FOFB-BPM-DATA` publisher (needs pyzmq).
+
+        It has the interface of `ZmqClient`: `connect`, `subscribe` and
+        `receive(n)`, which returns a list of multipart messages.
+    """
+
+    def __init__(self):
+        try:
+            import zmq
+        except ImportError:
+            raise ImportError("pyzmq is needed to receive the BPM stream.")
+        self._context = zmq.Context.instance()
+        self._socket = self._context.socket(zmq.SUB)
+
+    def connect(self, address):
+        self._socket.connect(address)
+
+    def subscribe(self, topics):
+        import zmq
+        for topic in topics:
+            self._socket.setsockopt(zmq.SUBSCRIBE, topic.encode('utf8'))
+
+    def receive(self, n=1):
+        return [self._socket.recv_multipart() for _ in range(n)]
+
+    def close(self):
+        self._socket.close()
+
+
+class LocalPublisher(object):
+    """ In-process stand-in for the `FOFB-BPM-DATA` publisher.
+
+        It has the interface of `ZmqClient` and cycles through the columns of
+        the given arrays, encoded like the real frames.
+
+        Parameters
+        ----------
+        BPMx, BPMy : np.array (bpm_nb x sample_nb)
+            Data to publish.
+        topic : str, optional.
+            Topic of the messages. Default to 'FOFB-BPM-DATA'.
+    """
+
+    def __init__(self, BPMx, BPMy, topic='FOFB-BPM-DATA'):
+        if BPMx.shape != BPMy.shape:
+            raise ValueError("BPMx and BPMy must have the same shape.")
+        self._x = np.ascontiguousarray(BPMx.T, dtype=FRAME_DTYPE)
+        self._y = np.ascontiguousarray(BPMy.T, dtype=FRAME_DTYPE)
+        self.topic = topic.encode('utf8')
+        self.sent = 0
+
+    def connect(self, address):
+        pass
+
+    def subscribe(self, topics):
+        pass
+
+    def receive(self, n=1):
+        messages = []
+        for _ in range(n):
+            i = self.sent % self._x.shape[0]
+            messages.append([self.topic, str(self.sent).encode('utf8'),
+                             self._x[i].tobytes(), self._y[i].tobytes()])
+            self.sent += 1
+        return messages
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+""" Persistent on-disk cache for archiver queries.
+
+    The cache sits in front of an `io.Archiver` and has the same `read`
+    interface. It stores the parsed arrays of every query as chunks keyed by
+    PV name (or pattern) and time interval. A new query is answered from the
+    cached chunks and only the missing gaps are fetched from the archiver.
+
+    The total size of the chunks is bounded; the least recently used chunks
+    are evicted first.
+"""
+
+from __future__ import division, print_function
+
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: the index is not locked between processes
+    fcntl = None
+
+from .io import Archiver, _merge_camonitor
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'search_kicks', 'archiver')
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+
+
+def _to_us(t):
+    """ datetime.datetime -> integer number of microseconds since epoch. """
+    return int(np.datetime64(t, 'us').astype(np.int64))
+
+
+def _from_us(stamps):
+    """ integer microseconds since epoch -> list of datetime.datetime. """
+    return np.asarray(stamps, dtype=np.int64).astype('datetime64[us]').tolist()
+
+
+class ArchiverCache(object):
+    """ Archiver with a local, size-limited, LRU cache.
+
+        Parameters
+        ----------
+        archiver : io.Archiver, optional.
+            Archiver used to fetch the missing data. Default to `Archiver()`.
+        directory : str, optional.
+            Where the cache is stored. Default to `~/.cache/search_kicks`.
+        max_size : int, optional.
+            Maximal size of the cache in bytes. Default to 1 GB.
+    """
+
+    def __init__(self, archiver=None, directory=DEFAULT_DIRECTORY,
+                 max_size=2**30):
+        if archiver is None:
+            archiver = Archiver()
+        self.archiver = archiver
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.RLock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load_index()
+
+    def read(self, var, t0, t1=None, **kwargs):
+        """ Same as `Archiver.read`, answered from the cache when possible.
+
+            Extra keyword arguments are given to `Archiver.read` when the
+            missing gaps are fetched.
+        """
+        if t1 is None:
+            t1 = t0
+        if type(t0) is not datetime or type(t1) is not datetime:
+            raise TypeError("2nd and 3rd arguments must be datetime.datetime"
+                            "types")
+        if t0 > t1:
+            raise ValueError("End time must be greater than endtime.")
+
+        # Each name is cached on its own, a pattern as a whole.
+        if type(var) is list:
+            keys = var
+        else:
+            keys = [var]
+
+        results = []
+        for key in keys:
+            results.append(self._read_key(key, type(var) is list, t0, t1,
+                                          kwargs))
+        return _merge_camonitor(results)
+
+    def clear(self):
+        """ Remove every chunk from the cache. """
+        with self._lock:
+            for entry in self._entries:
+                self._remove_file(entry)
+            self._entries = []
+            self._save_index()
+
+    @property
+    def size(self):
+        """ Size of the cache in bytes. """
+        return sum(entry['size'] for entry in self._entries)
+
+    def _read_key(self, key, is_name, t0, t1, kwargs):
+        start = _to_us(t0)
+        end = _to_us(t1)
+
+        with self._lock:
+            entries = [e for e in self._entries
+                       if e['key'] == key and e['end'] >= start and
+                       e['start'] <= end]
+            gaps = self._gaps(entries, start, end)
+
+        for gap_start, gap_end in gaps:
+            var = [key] if is_name else key
+            data = self.archiver.read(var, _from_us([gap_start])[0],
+                                      _from_us([gap_end])[0], **kwargs)
+            entries.append(self._store(key, gap_start, gap_end, data))
+
+        chunks = []
+        with self._lock:
+            for entry in entries:
+                self._counter += 1
+                entry['access'] = self._counter
+                chunks.append(self._load_chunk(entry))
+            self._evict()
+            self._save_index()
+
+        return self._trim(_merge_camonitor(chunks), t0, t1)
+
+    @staticmethod
+    def _gaps(entries, start, end):
+        """ Sub-intervals of [start, end] not covered by the entries. """
+        gaps = []
+        current = start
+        for entry in sorted(entries, key=lambda e: e['start']):
+            if entry['start'] > current:
+                gaps.append((current, min(entry['start'], end)))
+            current = max(current, entry['end'])
+            if current >= end:
+                break
+        if current < end or not entries:
+            gaps.append((current, end))
+        return gaps
+
+    @staticmethod
+    def _trim(data, t0, t1):
+        """ Keep the samples in [t0, t1] and the last one before t0. """
+        start = np.datetime64(t0, 'us')
+        end = np.datetime64(t1, 'us')
+        for key in list(data.keys()):
+            stamps = np.array(data[key]['time'], dtype='datetime64[us]')
+            first = max(np.searchsorted(stamps, start, side='right') - 1, 0)
+            last = np.searchsorted(stamps, end, side='right')
+            if first >= last:
+                del data[key]
+                continue
+            data[key]['values'] = data[key]['values'][first:last]
+            data[key]['time'] = data[key]['time'][first:last]
+        return data
+
+    def _store(self, key, start, end, data):
+        name = hashlib.sha1('{}|{}|{}'.format(key, start, end)
+                            .encode('utf8')).hexdigest() + '.npz'
+        filename = os.path.join(self.directory, name)
+
+        arrays = dict()
+        pvs = sorted(data.keys())
+        for i, pv in enumerate(pvs):
+            arrays['time_{}'.format(i)] = np.array(
+                data[pv]['time'], dtype='datetime64[us]').astype(np.int64)
+            arrays['values_{}'.format(i)] = np.asarray(data[pv]['values'])
+        arrays['pvs'] = np.array(pvs, dtype=str)
+        self._write(filename, lambda f: np.savez(f, **arrays), 'wb')
+
+        entry = {'key': key, 'start': start, 'end': end, 'file': name,
+                 'size': os.path.getsize(filename), 'access': 0}
+        with self._lock:
+            self._entries.append(entry)
+        return entry
+
+    def _load_chunk(self, entry):
+        data = dict()
+        with np.load(os.path.join(self.directory, entry['file'])) as f:
+            for i, pv in enumerate(f['pvs']):
+                data[str(pv)] = {
+                    'values': f['values_{}'.format(i)],
+                    'time': _from_us(f['time_{}'.format(i)]),
+                    }
+        return data
+
+    def _evict(self):
+        """ Remove the least recently used chunks above `max_size`. """
+        size = self.size
+        for entry in sorted(self._entries, key=lambda e: e['access']):
+            if size <= self.max_size:
+                break
+            size -= entry['size']
+            self._remove_file(entry)
+            self._entries.remove(entry)
+
+    def _remove_file(self, entry):
+        try:
+            os.remove(os.path.join(self.directory, entry['file']))
+        except OSError:
+            pass
+
+    def _load_index(self):
+        self._entries = []
+        self._counter = 0
+        with self._index_lock():
+            self._merge_index()
+
+    def _merge_index(self):
+        """ Add the chunks stored by other processes sharing the directory,
+            forget the chunks whose file was removed.
+        """
+        filename = os.path.join(self.directory, INDEX_FILE)
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                index = json.load(f)
+            known = set(e['file'] for e in self._entries)
+            self._entries.extend(e for e in index['entries']
+                                 if e['file'] not in known)
+            self._counter = max(self._counter, index['counter'])
+        self._entries = [e for e in self._entries
+                         if os.path.isfile(os.path.join(self.directory,
+                                                        e['file']))]
+
+    def _save_index(self):
+        index = os.path.join(self.directory, INDEX_FILE)
+        with self._index_lock():
+            self._merge_index()
+            self._write(index, lambda f: json.dump(
+                {'entries': self._entries, 'counter': self._counter}, f),
+                'w')
+
+    @contextmanager
+    def _index_lock(self):
+        """ Lock of the index between the processes sharing the directory.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write(self, filename, write, mode):
+        """ Write `filename` through a unique temporary file, replaced
+            atomically: the readers never see a partial file.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as f:
+                write(f)
+            os.replace(tmp, filename)
+        except Exception:
+            os.remove(tmp)
+            raise
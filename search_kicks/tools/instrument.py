@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+""" Timers and counters on the hot paths.
+
+    The analysis, maths and io functions are wrapped with `timed`, and
+    count the expensive operations they do (least-square solves, SVDs,
+    files read) with `count`. Nothing is measured until `enable` is called
+    (or the environment variable `SEARCH_KICKS_INSTRUMENT` is set, to `1` or
+    to `memory` to also trace the memory): a disabled timer costs one test.
+
+    >>> from search_kicks.tools import instrument
+    >>> instrument.enable()
+    >>> with instrument.timer('analysis'):
+    ...     skcore.get_kick(orbit, phase, tune)
+    >>> print(instrument.to_prometheus())
+
+    The memory peaks are measured with `tracemalloc`, which slows down every
+    allocation and is global to the process: the peaks of stages running
+    concurrently in threads are mixed.
+"""
+
+from __future__ import division, print_function
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+ENVIRONMENT_VARIABLE = 'SEARCH_KICKS_INSTRUMENT'
+PROMETHEUS_PREFIX = 'search_kicks'
+
+_enabled = False
+_memory = False
+_lock = threading.Lock()
+_timers = dict()
+_counters = dict()
+_local = threading.local()
+
+
+def enable(memory=False):
+    """ Start measuring.
+
+        Parameters
+        ----------
+        memory : bool, optional.
+            If True, also measure the memory peak of every timer with
+            `tracemalloc`. Default to False.
+    """
+    global _enabled, _memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _memory = memory
+    _enabled = True
+
+
+def disable():
+    """ Stop measuring. The values measured so far are kept. """
+    global _enabled, _memory
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+    _memory = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """ Forget all the values measured. """
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def count(name, n=1):
+    """ Add `n` to the counter `name`. """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _Timer(object):
+    __slots__ = ['name', 'start', 'memory']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.memory = _memory and tracemalloc.is_tracing()
+        if self.memory:
+            stack = _memory_stack()
+            if stack:
+                # the peak is reset: keep the one of the enclosing timer
+                stack[-1][0] = max(stack[-1][0],
+                                   tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            stack.append([0, tracemalloc.get_traced_memory()[0]])
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        peak = None
+        if self.memory:
+            stack = _memory_stack()
+            floor, base = stack.pop()
+            peak = max(floor, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1][0] = max(stack[-1][0], peak)
+            peak -= base
+        _record(self.name, elapsed, peak)
+        return False
+
+
+class _NoTimer(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(name):
+    """ Context manager measuring the time spent in its block.
+
+        >>> with timer('correction'):
+        ...     S_inv = inverse_with_svd(Smat, 32)
+    """
+    if not _enabled:
+        return _NO_TIMER
+    return _Timer(name)
+
+
+def timed(name=None):
+    """ Decorator measuring the time spent in a function.
+
+        Parameters
+        ----------
+        name : str, optional.
+            Name of the timer. Default to `<module>.<function>`, e.g.
+            'maths.klt'.
+    """
+    def decorator(func):
+        timer_name = name
+        if timer_name is None:
+            timer_name = '{}.{}'.format(func.__module__.split('.')[-1],
+                                        func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(timer_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _memory_stack():
+    try:
+        return _local.memory
+    except AttributeError:
+        _local.memory = []
+        return _local.memory
+
+
+def _record(name, elapsed, peak):
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            stats = _timers[name] = {'calls': 0, 'total': 0.,
+                                     'min': elapsed, 'max': elapsed}
+        stats['calls'] += 1
+        stats['total'] += elapsed
+        stats['min'] = min(stats['min'], elapsed)
+        stats['max'] = max(stats['max'], elapsed)
+        if peak is not None:
+            stats['memory_peak'] = max(stats.get('memory_peak', 0), peak)
+
+
+def snapshot():
+    """ Copy of the values measured.
+
+        Returns
+        -------
+        dict
+            `{'timers': {name: {'calls', 'total', 'mean', 'min', 'max'[,
+            'memory_peak']}}, 'counters': {name: value}}`. Times are in
+            seconds, memory peaks in bytes above the memory used when the
+            timer started.
+    """
+    with _lock:
+        timers = dict((name, dict(stats)) for name, stats in _timers.items())
+        counters = dict(_counters)
+    for stats in timers.values():
+        stats['mean'] = stats['total']/stats['calls']
+    return {'timers': timers, 'counters': counters}
+
+
+def report():
+    """ The snapshot as a text table, the longest stages first. """
+    values = snapshot()
+    lines = ['{:32s} {:>7s} {:>11s} {:>11s} {:>11s}'
+             .format('stage', 'calls', 'total (s)', 'mean (s)', 'peak (kB)')]
+    for name, stats in sorted(values['timers'].items(),
+                              key=lambda item: -item[1]['total']):
+        peak = stats.get('memory_peak')
+        lines.append('{:32s} {:7d} {:11.6f} {:11.6f} {:>11s}'.format(
+            name, stats['calls'], stats['total'], stats['mean'],
+            '' if peak is None else '{:.1f}'.format(peak/1024)))
+    for name, value in sorted(values['counters'].items()):
+        lines.append('{:32s} {:7d}'.format(name, value))
+    return '\n'.join(lines)
+
+
+def to_json(filename=None):
+    """ The snapshot as JSON, written to `filename` if given. """
+    text = json.dumps(snapshot(), indent=1, sort_keys=True)
+    if filename is not None:
+        with open(filename, 'w') as f:
+            f.write(text)
+    return text
+
+
+def to_prometheus(prefix=PROMETHEUS_PREFIX):
+    """ The snapshot in the Prometheus text exposition format. """
+    values = snapshot()
+    timers = sorted(values['timers'].items())
+    lines = []
+
+    name = prefix + '_stage_seconds'
+    lines.append('# HELP {} Time spent in the stage.'.format(name))
+    lines.append('# TYPE {} summary'.format(name))
+    for stage, stats in timers:
+        lines.append('{}_count{{stage="{}"}} {}'
+                     .format(name, stage, stats['calls']))
+        lines.append('{}_sum{{stage="{}"}} {!r}'
+                     .format(name, stage, stats['total']))
+
+    name = prefix + '_stage_max_seconds'
+    lines.append('# HELP {} Longest call of the stage.'.format(name))
+    lines.append('# TYPE {} gauge'.format(name))
+    for stage, stats in timers:
+        lines.append('{}{{stage="{}"}} {!r}'.format(name, stage, stats['max']))
+
+    peaks = [(stage, stats['memory_peak']) for stage, stats in timers
+             if 'memory_peak' in stats]
+    if peaks:
+        name = prefix + '_stage_memory_peak_bytes'
+        lines.append('# HELP {} Memory peak of the stage.'.format(name))
+        lines.append('# TYPE {} gauge'.format(name))
+        for stage, peak in peaks:
+            lines.append('{}{{stage="{}"}} {}'.format(name, stage, peak))
+
+    name = prefix + '_operations_total'
+    lines.append('# HELP {} Operations counted.'.format(name))
+    lines.append('# TYPE {} counter'.format(name))
+    for counter, value in sorted(values['counters'].items()):
+        lines.append('{}{{operation="{}"}} {}'.format(name, counter, value))
+    return '\n'.join(lines) + '\n'
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE, '') not in ['', '0']:
+    enable(memory=os.environ[ENVIRONMENT_VARIABLE] == 'memory')
@@ -19,10 +19,14 @@ errors whenever something goes wrong.
 @author: Olivier CHURLAUD <olivier.churlaud@helmholtz-berlin.de>
 """
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
 from datetime import datetime, timedelta
-import locale
+import glob
 import os
+import random
+import re
+import time
 
 try:
     from urllib.request import urlopen
@@ -34,15 +38,23 @@ import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.io
+import scipy.signal
+
+from .instrument import timed, count
 
 DATETIME_ISO = "%Y-%m-%dT%H:%M:%S.%f"
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 
 
+@timed()
 def load_orbit(*args):
     """ Load an orbit.
 
     This uses function only calls other functions based on the number and
-    values of its arguments.
+    values of its arguments. With one argument, the file format is detected
+    from the first bytes of the file (see `register_format`), then from its
+    extension.
 
     Raises
     -------
@@ -54,31 +66,129 @@ def load_orbit(*args):
 
     if len(args) == 1:  # can only be a file
         filename = args[0]
-        ext = os.path.splitext(filename)[1]
-        if ext == ".hdf5":
-            try:
-                return load_orbit_hdf5(filename)
-            except Exception:
-                raise
-        elif ext == ".mat":
-            try:
-                return load_orbit_dump(filename)
-            except Exception:
-                raise
-        elif ext == '.npy':
-            try:
-                return load_orbit_npy(filename)
-            except Exception:
-                raise
-        else:
-            raise ValueError("I don't know how to load this type of file '{}'."
-                             .format(filename))
+        count('io.files_read')
+        try:
+            return detect_format(filename)['loader'](filename)
+        except Exception:
+            raise
     elif len(args) == 2 or len(args) == 3:
         return load_orbit_from_archiver(*args)
     else:
         raise ValueError("This function has 1, 2 or 3 arguments.")
 
 
+FORMATS = []
+
+
+def register_format(name, loader, magic=None, extensions=(), offset=0):
+    """ Teach `load_orbit` how to load a new file format.
+
+        Parameters
+        ----------
+        name : str
+            Name of the format.
+        loader : callable
+            Function `loader(filename)` returning an `OrbitData`. It must be
+            defined at module level to be usable by `load_orbits` with
+            processes.
+        magic : bytes, optional.
+            Bytes the files of this format start with.
+        extensions : list of str, optional.
+            Extensions used when the magic bytes don't match any format.
+        offset : int, optional.
+            Position of the magic bytes in the file. Default to 0.
+
+        Note
+        ----
+        The formats live in the module-level `FORMATS` list of each process.
+        Worker processes started with the 'spawn' method (default on Windows
+        and macOS) import this module again and only know the formats
+        registered at import time: register yours in a module imported by the
+        workers, or use `load_orbits(..., executor='thread')`.
+    """
+    FORMATS.append({'name': name, 'loader': loader, 'magic': magic,
+                    'extensions': list(extensions), 'offset': offset})
+
+
+def detect_format(filename):
+    """ Find the registered format of a file, based on its first bytes, then
+        on its extension.
+
+        Raises
+        ------
+        ValueError:
+            If the format is unknown.
+    """
+    size = max([f['offset'] + len(f['magic']) for f in FORMATS
+                if f['magic']] or [0])
+    with open(filename, 'rb') as f:
+        head = f.read(size)
+
+    for fmt in FORMATS:
+        magic = fmt['magic']
+        if magic and head[fmt['offset']:fmt['offset']+len(magic)] == magic:
+            return fmt
+
+    ext = os.path.splitext(filename)[1]
+    for fmt in FORMATS:
+        if ext in fmt['extensions']:
+            return fmt
+
+    raise ValueError("I don't know how to load this type of file '{}'."
+                     .format(filename))
+
+
+def load_orbits(paths, max_workers=None, executor='process'):
+    """ Load several orbits in parallel.
+
+        Parameters
+        ----------
+        paths : str or list of str
+            Glob pattern(s) or file names.
+        max_workers : int, optional.
+            Number of workers. Default to the number of processors.
+        executor : 'process' or 'thread', optional.
+            Kind of pool. Default to 'process'.
+
+        Returns
+        -------
+        filenames : list of str
+            The file names, the glob patterns expanded and sorted.
+        orbits : list of OrbitData
+            The orbits, in the order of `filenames`. `None` when a file could
+            not be loaded.
+        errors : dict
+            `{filename: exception}` for the files that could not be loaded.
+    """
+    if type(paths) is not list:
+        paths = [paths]
+    filenames = []
+    for path in paths:
+        matches = sorted(glob.glob(path))
+        filenames.extend(matches if matches else [path])
+
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        raise ValueError("executor must be 'process' or 'thread'.")
+
+    orbits = []
+    errors = dict()
+    with pool:
+        futures = [pool.submit(load_orbit, filename)
+                   for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                orbits.append(future.result())
+            except Exception as e:
+                orbits.append(None)
+                errors[filename] = e
+
+    return filenames, orbits, errors
+
+
 class OrbitData(object):
     """ Data container class that should be used in the programs.
 
@@ -87,16 +197,27 @@ class OrbitData(object):
 
     If the object cannot be constructed, an exception is raised.
 
+    In compact mode (`compact=True`), BPMx and BPMy are copied into one
+    C-contiguous (2, N_bpm, N_sample) block (see `bpm_block`) and are views
+    on it, CMx and CMy are C-contiguous too. All of them are stored with
+    `dtype` (e.g. np.float32 to halve the memory), default to the dtype of
+    BPMx.
+
     """
 
+    __slots__ = ['BPMx', 'BPMy', 'CMx', 'CMy', 'names', 'sampling_frequency',
+                 'sample_number', 'measure_date', 'time', 'bpm_block',
+                 '_datetime64', '_spectra', '_psd', '_name_index']
+
     def __init__(self, BPMx=None, BPMy=None, CMx=None, CMy=None, names=None,
-                 sampling_frequency=None, measure_date=None):
+                 sampling_frequency=None, measure_date=None, compact=False,
+                 dtype=None):
 
         sample_nb = 0
 
         def check_single_arrays(name, item, sample_nb):
             if item is None:
-                return
+                return sample_nb
 
             if type(item) is not np.ndarray:
                 raise TypeError("{} type must be ndarrays, not {}."
@@ -118,19 +239,41 @@ class OrbitData(object):
         sample_nb = check_single_arrays('CMx', CMx, sample_nb)
         sample_nb = check_single_arrays('CMy', CMy, sample_nb)
 
+        no_names = {'BPMx': None, 'BPMy': None, 'CMx': None, 'CMy': None}
         if names is None:
-            names = {'BPMx': None, 'BPMy': None, 'CMx': None, 'CMy': None}
+            names = no_names
         elif type(names) is not dict:
             print("Names should be None or a dictionary: discarded.")
+            names = no_names
         elif ('BPMx' not in names.keys() or 'BPMy' not in names.keys() or
               'CMx' not in names.keys() or 'CMy' not in names.keys()):
             print("Names should contain BPMx, BPMy, CMx, CMy: discarded.")
-        elif (len(names['BPMx']) != BPMx.shape[0] or
-              len(names['BPMy']) != BPMy.shape[0] or
-              len(names['CMx']) != CMx.shape[0] or
-              len(names['CMy']) != CMy.shape[0]):
+            names = no_names
+        elif any(names[k] is not None and x is not None and
+                 len(names[k]) != x.shape[0]
+                 for k, x in (('BPMx', BPMx), ('BPMy', BPMy),
+                              ('CMx', CMx), ('CMy', CMy))):
             print("Names should have the same length as corresponding objects "
                   "first dimension: discarded.")
+            names = no_names
+
+        self.bpm_block = None
+        if compact:
+            if BPMx is None or BPMy is None or BPMx.shape != BPMy.shape:
+                raise ValueError("The compact mode needs BPMx and BPMy with "
+                                 "the same shape.")
+            if dtype is None:
+                dtype = BPMx.dtype
+            self.bpm_block = np.empty((2,) + BPMx.shape, dtype=dtype)
+            self.bpm_block[0] = BPMx
+            self.bpm_block[1] = BPMy
+            BPMx = self.bpm_block[0]
+            BPMy = self.bpm_block[1]
+            if CMx is not None:
+                CMx = np.ascontiguousarray(CMx, dtype=dtype)
+            if CMy is not None:
+                CMy = np.ascontiguousarray(CMy, dtype=dtype)
+
         self.BPMx = BPMx
         self.BPMy = BPMy
         self.CMx = CMx
@@ -140,13 +283,17 @@ class OrbitData(object):
         self.measure_date = measure_date
         self.time = np.arange(self.sample_number)/self.sampling_frequency
         self.names = names
-
-    def _plot_single_fft(self, x, i, title, ylabel):
-        N = x.shape[1]
-        freqs = np.fft.fftfreq(N, 1/self.sampling_frequency)[:N//2]
-        X = np.fft.fft(x[i, :])[:N//2]*2/N*10**6
+        self._datetime64 = None
+        self._spectra = None
+        self._psd = dict()
+        self._name_index = dict()
+
+    def _plot_single_fft(self, key, i, title, ylabel):
+        N = self.sample_number
+        freqs = self.frequencies[:N//2]
+        X = self.amplitude_spectrum(key)[i, :N//2]*10**6
         X[0] = 0
-        plt.plot(freqs, abs(X))
+        plt.plot(freqs, X)
         plt.title(title)
         plt.xlabel('Frequency [in Hz]')
         plt.ylabel(ylabel)
@@ -160,13 +307,9 @@ class OrbitData(object):
         plt.figure()
 
         if which == "BPM":
-            x = self.BPMx
-            y = self.BPMy
             plot_title = "BPM"
             ylabel = 'Beam motion [in nm]'
         else:
-            x = self.CMx
-            y = self.CMy
             plot_title = "CM"
             ylabel = 'Correction [in uA]'
 
@@ -174,19 +317,294 @@ class OrbitData(object):
         if 'x' in axis:
             if 'y' in axis:
                 plt.subplot(2, 1, 1)
-            self._plot_single_fft(x, i, plot_title+'x', ylabel)
+            self._plot_single_fft(plot_title+'x', i, plot_title+'x', ylabel)
         if 'y' in axis:
             if 'x' in axis:
                 i = idx[1]
                 plt.subplot(2, 1, 2)
-            self._plot_single_fft(y, i, plot_title+'y', ylabel)
+            self._plot_single_fft(plot_title+'y', i, plot_title+'y', ylabel)
 
         plt.tight_layout()
 
+    @property
+    def frequencies(self):
+        """ Frequencies of the bins of `spectrum`, in Hz. """
+        return np.fft.rfftfreq(self.sample_number, 1/self.sampling_frequency)
+
+    def spectrum(self, key):
+        """ Complex spectrum (`np.fft.rfft`) of each row of `key`.
+
+            The spectra of BPMx, BPMy, CMx and CMy are computed together, in
+            one transform, the first time one of them is asked for, and kept.
+            Call `clear_cache` after modifying the data in place.
+
+            Parameters
+            ----------
+            key : 'BPMx', 'BPMy', 'CMx' or 'CMy'
+
+            Returns
+            -------
+            np.array (nb_rows x sample_number//2 + 1)
+        """
+        if self._spectra is None:
+            keys = [k for k in ['BPMx', 'BPMy', 'CMx', 'CMy']
+                    if getattr(self, k) is not None]
+            arrays = [getattr(self, k) for k in keys]
+            spectra = np.fft.rfft(np.concatenate(arrays), axis=1)
+            bounds = np.cumsum([0] + [x.shape[0] for x in arrays])
+            self._spectra = dict((k, spectra[bounds[j]:bounds[j+1]])
+                                 for j, k in enumerate(keys))
+        if key not in self._spectra:
+            raise ValueError("There is no {} data.".format(key))
+        return self._spectra[key]
+
+    def amplitude_spectrum(self, key):
+        """ Amplitude of the sine at each frequency of `spectrum`. """
+        return np.abs(self.spectrum(key))*2/self.sample_number
+
+    def psd(self, key, nperseg=None, window='hann'):
+        """ Power spectral density of each row of `key` (Welch's method).
+
+            The result is kept for the next calls with the same arguments.
+            Call `clear_cache` after modifying the data in place.
+
+            Parameters
+            ----------
+            key : 'BPMx', 'BPMy', 'CMx' or 'CMy'
+            nperseg : int, optional.
+                Length of the averaged segments. Default to 1 s of data, and
+                at least 8 samples.
+            window : str, optional.
+                Window applied to the segments. Default to 'hann'.
+
+            Returns
+            -------
+            freqs : np.array
+                Frequencies, in Hz.
+            psd : np.array (nb_rows x freqs.size)
+                In units^2/Hz.
+        """
+        nperseg = self._nperseg(nperseg)
+        cache_key = (key, nperseg, window)
+        if cache_key not in self._psd:
+            x = getattr(self, key)
+            if x is None:
+                raise ValueError("There is no {} data.".format(key))
+            self._psd[cache_key] = scipy.signal.welch(
+                x, self.sampling_frequency, window=window, nperseg=nperseg,
+                axis=1)
+        return self._psd[cache_key]
+
+    def band_rms(self, key, f_min=0., f_max=None, nperseg=None):
+        """ RMS motion of each row of `key` in the band [f_min, f_max].
+
+            It is the square root of the PSD integrated over the band.
+        """
+        freqs, psd = self.psd(key, nperseg)
+        if f_max is None:
+            f_max = freqs[-1]
+        band = (freqs >= f_min) & (freqs <= f_max)
+        df = self.sampling_frequency/self._nperseg(nperseg)
+        return np.sqrt(np.sum(psd[:, band], axis=1)*df)
+
+    def clear_cache(self):
+        """ Forget the spectra and PSDs computed so far.
+
+            They are not updated when the data are modified in place (e.g.
+            `orbit.BPMx[:] -= offset`), call this afterwards.
+        """
+        self._spectra = None
+        self._psd = dict()
+
+    def _nperseg(self, nperseg):
+        if nperseg is None:
+            # 1 s of data, but at least 8 samples for sub-Hz data (archiver)
+            nperseg = max(8, int(round(self.sampling_frequency)))
+        return max(1, min(nperseg, self.sample_number))
+
     @property
     def datetime(self):
         return self.measure_date + timedelta(seconds=1)*self.time
 
+    @property
+    def datetime64(self):
+        """ Time axis as a `datetime64[ns]` array (computed once). """
+        if self._datetime64 is None:
+            if self.measure_date is None:
+                raise ValueError("The measure date is unknown.")
+            step = np.arange(self.sample_number)*(1e9/self.sampling_frequency)
+            self._datetime64 = (np.datetime64(self.measure_date, 'ns') +
+                                np.round(step).astype('timedelta64[ns]'))
+        return self._datetime64
+
+    def slice_time(self, start=None, end=None):
+        """ Select the samples taken in `[start, end)`.
+
+            The bounds are found by binary search on the `datetime64` axis and
+            the data of the returned object are views on the data of this one
+            (nothing is copied).
+
+            Parameters
+            ----------
+            start, end : datetime.datetime, np.datetime64 or str, optional.
+                Bounds of the window. Default to the beginning/end of the
+                capture.
+
+            Returns
+            -------
+            OrbitData
+                The selected window.
+        """
+        axis = self.datetime64
+        i0 = 0
+        i1 = self.sample_number
+        if start is not None:
+            i0 = np.searchsorted(axis, np.datetime64(start, 'ns'), 'left')
+        if end is not None:
+            i1 = np.searchsorted(axis, np.datetime64(end, 'ns'), 'left')
+        return self.slice_samples(i0, max(i0, i1))
+
+    def __getstate__(self):
+        # The caches are not sent, and the BPM views are rebuilt from the
+        # block instead of being pickled as independent copies.
+        state = dict((k, getattr(self, k)) for k in self.__slots__)
+        state['_spectra'] = None
+        state['_psd'] = dict()
+        if self.bpm_block is not None:
+            state['BPMx'] = None
+            state['BPMy'] = None
+        return state
+
+    def __setstate__(self, state):
+        for k in self.__slots__:
+            setattr(self, k, state.get(k))
+        if self.bpm_block is not None:
+            self.BPMx = self.bpm_block[0]
+            self.BPMy = self.bpm_block[1]
+
+    def name_index(self, key):
+        """ `{name: row}` of `key` ('BPMx', 'BPMy', 'CMx' or 'CMy'), built
+            once.
+        """
+        if key not in self._name_index:
+            if self.names[key] is None:
+                raise ValueError("There are no names for {}.".format(key))
+            self._name_index[key] = dict((_to_str(n), i) for i, n
+                                         in enumerate(self.names[key]))
+        return self._name_index[key]
+
+    def rows(self, key, names=None, pattern=None):
+        """ Rows of `key` of the given names and/or of the names matching the
+            regular expression `pattern`, in this order. Names that are not
+            in `key` are ignored.
+        """
+        index = self.name_index(key)
+        rows = []
+        if names is not None:
+            if isinstance(names, str):
+                names = [names]
+            rows.extend(index[n] for n in names if n in index)
+        if pattern is not None:
+            regex = re.compile(pattern)
+            found = set(rows)
+            rows.extend(i for i, n in enumerate(self.names[key])
+                        if i not in found and regex.search(_to_str(n)))
+        return rows
+
+    def select(self, names=None, pattern=None):
+        """ Sub-orbit with only the BPMs/CMs of the given names and/or whose
+            names match the regular expression `pattern`.
+
+            The names are looked up in hash tables. When the selected rows of
+            an array are evenly spaced (one element, a contiguous block...),
+            the new array is a view on this one; else only the selected rows
+            are gathered.
+
+            Returns
+            -------
+            OrbitData
+                With empty arrays for the families without any selected
+                element.
+
+            Raises
+            ------
+            KeyError:
+                If a name is in none of the families.
+        """
+        keys = [k for k in ['BPMx', 'BPMy', 'CMx', 'CMy']
+                if self.names[k] is not None]
+        if names is not None:
+            if isinstance(names, str):
+                names = [names]
+            missing = [n for n in names
+                       if not any(n in self.name_index(k) for k in keys)]
+            if missing:
+                raise KeyError("Unknown names: {}".format(missing))
+
+        arrays = dict()
+        sub_names = dict()
+        for key in ['BPMx', 'BPMy', 'CMx', 'CMy']:
+            x = getattr(self, key)
+            if x is None or key not in keys:
+                arrays[key] = None if x is None else x[:0]
+                sub_names[key] = None if x is None else []
+                continue
+            rows = self.rows(key, names, pattern)
+            rows_slice = _as_slice(rows)
+            arrays[key] = x[rows] if rows_slice is None else x[rows_slice]
+            sub_names[key] = [self.names[key][i] for i in rows]
+
+        orbit = OrbitData(names=sub_names,
+                          sampling_frequency=self.sampling_frequency,
+                          measure_date=self.measure_date, **arrays)
+        orbit._datetime64 = self._datetime64
+        return orbit
+
+    def to_compact(self, dtype=None):
+        """ Copy of this object in compact mode (see `OrbitData`). """
+        return OrbitData(BPMx=self.BPMx, BPMy=self.BPMy,
+                         CMx=self.CMx, CMy=self.CMy, names=self.names,
+                         sampling_frequency=self.sampling_frequency,
+                         measure_date=self.measure_date, compact=True,
+                         dtype=dtype)
+
+    def slice_samples(self, i0, i1):
+        """ Select the samples `i0` to `i1` (excluded), without copy.
+        """
+        def cut(x):
+            return None if x is None else x[:, i0:i1]
+
+        measure_date = self.measure_date
+        if measure_date is not None:
+            measure_date += timedelta(seconds=i0/self.sampling_frequency)
+
+        orbit = OrbitData(BPMx=cut(self.BPMx), BPMy=cut(self.BPMy),
+                          CMx=cut(self.CMx), CMy=cut(self.CMy),
+                          names=self.names,
+                          sampling_frequency=self.sampling_frequency,
+                          measure_date=measure_date)
+        if self._datetime64 is not None:
+            orbit._datetime64 = self._datetime64[i0:i1]
+        return orbit
+
+
+def _to_str(name):
+    if isinstance(name, bytes):
+        return name.decode('utf8')
+    return str(name)
+
+
+def _as_slice(rows):
+    """ slice equivalent to the list of indices `rows`, or None. """
+    if len(rows) == 0:
+        return slice(0, 0)
+    if len(rows) == 1:
+        return slice(rows[0], rows[0] + 1)
+    step = rows[1] - rows[0]
+    if step <= 0 or any(b - a != step for a, b in zip(rows[:-1], rows[1:])):
+        return None
+    return slice(rows[0], rows[-1] + 1, step)
+
 
 def load_golden_orbit(filename):
     """ This should be in PyML
@@ -208,10 +626,11 @@ def load_golden_orbit(filename):
         return np.array(orbitX), np.array(orbitY), names
 
 
+@timed()
 def load_orbit_npy(filename):
 
     try:
-        data = np.load(filename)[0]
+        data = np.load(filename, allow_pickle=True)[0]
     except Exception:
         raise
     else:
@@ -237,6 +656,7 @@ def load_orbit_npy(filename):
                                       )
 
 
+@timed()
 def save_orbit_npy(filename, obj):
     VERSION = '1.0'
     data = {
@@ -253,6 +673,7 @@ def save_orbit_npy(filename, obj):
     np.save(filename, [data])
 
 
+@timed()
 def load_orbit_hdf5(filename):
 
     try:
@@ -264,7 +685,8 @@ def load_orbit_hdf5(filename):
                         BPMx=f['data/BPMx'][:], BPMy=f['data/BPMy'][:],
                         CMx=f['data/CMx'][:], CMy=f['data/CMy'][:],
                         sampling_frequency=f['sampling_frequency'][()],
-                        measure_date=(f.attrs['measure_date'], DATETIME_ISO),
+                        measure_date=datetime.strptime(
+                            f.attrs['measure_date'], DATETIME_ISO),
                         names={'BPMx': f['names/BPMx'][:],
                                'BPMy': f['names/BPMy'][:],
                                'CMx': f['names/CMx'][:],
@@ -281,12 +703,13 @@ def load_orbit_hdf5(filename):
         raise
 
 
+@timed()
 def save_orbit_hdf5(filename, obj):
     """ Save data to hdf5
     """
     VERSION = '1.0'
 
-    if os.path.splitext(filename) != '.hdf5':
+    if os.path.splitext(filename)[1] != '.hdf5':
         filename += '.hdf5'
 
     if obj.names['BPMx'] is None:
@@ -316,8 +739,45 @@ def save_orbit_hdf5(filename, obj):
         f.attrs['__version__'] = VERSION
 
 
-def load_orbit_dump(filename):
+def parse_mat_header_date(header):
+    """ Creation date of a MAT-file from its header.
 
+        The header is written in English whatever the locale, e.g.
+        'MATLAB 5.0 MAT-file, Platform: GLNX86, Created on: Mon May 30
+        16:30:30 2016'. It is parsed without `strptime`, whose month names
+        depend on the locale: the process-wide locale is never changed and
+        the function can be used from several threads.
+
+        Raises
+        ------
+        ValueError:
+            If the header has no valid 'Created on:' date.
+    """
+    if isinstance(header, bytes):
+        header = header.decode('utf8')
+    try:
+        fields = header.split('Created on:')[1].split()
+        clock = [int(v) for v in fields[3].split(':')]
+        return datetime(int(fields[4]), MONTHS[fields[1]], int(fields[2]),
+                        *clock)
+    except (IndexError, KeyError, ValueError, TypeError):
+        raise ValueError("No creation date in the header '{}'."
+                         .format(header))
+
+
+@timed()
+def load_orbit_dump(filename, compact=False, dtype=None):
+    """ Load a `.mat` dump of the `timeanalys` format.
+
+        Parameters
+        ----------
+        filename : str
+        compact : bool, optional.
+            Store the BPMs in one block (see `OrbitData`). Default to False.
+        dtype : np.dtype, optional.
+            Type of all the arrays, in compact mode or not. Default to
+            float64.
+    """
     try:
         data = scipy.io.loadmat(filename)
     except:
@@ -343,32 +803,25 @@ def load_orbit_dump(filename):
                                  "'{}' is key missing"
                                  .format(key))
 
-        # data['header'] = 'MATLAB 5.0 MAT-file, Platform: GLNX86, Created on: Mon May 30 16:30:30 2016'
-        loc = locale.getlocale()
-        locale.setlocale(locale.LC_ALL, 'en_US.utf8')
-        creation_date = (data['__header__'].decode('utf8')
-                                           .split('Created on: ')[1])
-        creation_date = datetime.strptime(creation_date,
-                                          '%a %b %d %H:%M:%S %Y')
-        locale.setlocale(locale.LC_ALL, loc)
-
-        _, sample_nb = data['difforbitX'].shape
-
-        BPMx_nb, _ = data['difforbitX'][0, 0].shape
-        BPMy_nb, _ = data['difforbitY'][0, 0].shape
-        CMx_nb, _ = data['CMx'][0, 0].shape
-        CMy_nb, _ = data['CMy'][0, 0].shape
-
-        BPMx = np.zeros((BPMx_nb, sample_nb))
-        BPMy = np.zeros((BPMy_nb, sample_nb))
-        CMx = np.zeros((CMx_nb, sample_nb))
-        CMy = np.zeros((CMy_nb, sample_nb))
-
-        for i in range(sample_nb):
-            BPMx[:, i] = data['difforbitX'][0, i][:, 0]
-            BPMy[:, i] = data['difforbitY'][0, i][:, 0]
-            CMx[:, i] = data['CMx'][0, i][:, 0]
-            CMy[:, i] = data['CMy'][0, i][:, 0]
+        creation_date = parse_mat_header_date(data['__header__'])
+
+        # Each sample is a (nb, 1) column: join them in one C-contiguous
+        # (nb, sample_nb) array.
+        columns_x = data['difforbitX'][0]
+        columns_y = data['difforbitY'][0]
+        dtype = np.dtype(float if dtype is None else dtype)
+        if compact:
+            # joined directly into the block, without intermediate arrays
+            block = np.empty((2, columns_x[0].shape[0], len(columns_x)),
+                             dtype=dtype)
+            np.concatenate(columns_x, axis=1, out=block[0])
+            np.concatenate(columns_y, axis=1, out=block[1])
+            BPMx, BPMy = block
+        else:
+            BPMx = np.concatenate(columns_x, axis=1, dtype=dtype)
+            BPMy = np.concatenate(columns_y, axis=1, dtype=dtype)
+        CMx = np.concatenate(data['CMx'][0], axis=1, dtype=dtype)
+        CMy = np.concatenate(data['CMy'][0], axis=1, dtype=dtype)
 
         orbit_data = OrbitData(
             BPMx=BPMx, BPMy=BPMy,
@@ -376,72 +829,150 @@ def load_orbit_dump(filename):
             sampling_frequency=150.,
             measure_date=creation_date
             )
+        if compact:
+            orbit_data.bpm_block = block
 
         return orbit_data
 
 
-def load_orbit_from_archiver(t_start, t_end):
-    a = Archiver()
+def load_orbit_from_archiver(t_start, t_end, period=2., archiver=None):
+    """ Load the orbit stored in the archiver between `t_start` and `t_end`.
+
+        The archiver only stores values when they change, so every PV is
+        resampled on a regular grid of step `period` (sample and hold: each
+        grid point takes the last value known at that time).
+
+        Parameters
+        ----------
+        t_start, t_end : datetime.datetime
+            Time range to load.
+        period : float, optional.
+            Period of the resampling grid in seconds. Default to 2.
+        archiver : Archiver or cache.ArchiverCache, optional.
+            Where the data are read. Default to `Archiver()`.
+
+        Returns
+        -------
+        OrbitData
+            The resampled orbit, with a sampling frequency of `1/period`.
+    """
+    if period <= 0:
+        raise ValueError("The resampling period must be positive.")
+
+    if archiver is None:
+        archiver = Archiver()
 
     BPMs_patt = "^BPMZ[1-7].*:rd[X|Y]$"
     CMx_patt = "^HS[1-4].*:rdbkSet$"
     CMy_patt = "^VS[1-3].*:rdbkSet$"
     patterns = "({})|({})|({})".format(BPMs_patt, CMx_patt, CMy_patt)
-    data = a.read(patterns, t_start, t_end)
+    data = archiver.read(patterns, t_start, t_end)
 
     if not data:
         raise RuntimeError("No data returned...I'm confused... "
                            "This is unexpected.")
 
-    BPMx = []
-    BPMy = []
-    CMx = []
-    CMy = []
-    names = {'BPMx': [], 'BPMy': [], 'CMx': [], 'CMy': []}
-
-    sample_number = int((t_end-t_start).total_seconds()/2)
-
-    for key in data:
-        d = []
-        k = 0
-
-        for j in range(sample_number):
-            if (data[key]['time'][k] <= t_start + j*timedelta(seconds=2) and
-                    k+1 < len(data[key]['time'])):
-                k += 1
-            d.append(data[key]['values'][k])
+    keys = list(data.keys())
+    sample_number = int((t_end-t_start).total_seconds()/period)
+    values = resample_hold([data[key]['time'] for key in keys],
+                           [data[key]['values'] for key in keys],
+                           t_start, period, sample_number)
 
+    rows = {'BPMx': [], 'BPMy': [], 'CMx': [], 'CMy': []}
+    for i, key in enumerate(keys):
         if key[:2] == "HS":
-            CMx.append(d)
-            names['CMx'].append(key)
+            rows['CMx'].append(i)
         elif key[:2] == "VS":
-            CMy.append(d)
-            names['CMy'].append(key)
+            rows['CMy'].append(i)
         elif key[:3] == "BPM" and key[-1] == "X":
-            BPMx.append(d)
-            names['BPMx'].append(key)
+            rows['BPMx'].append(i)
         elif key[:3] == "BPM" and key[-1] == "Y":
-            BPMy.append(d)
-            names['BPMy'].append(key)
+            rows['BPMy'].append(i)
         else:
             raise RuntimeError("{} was not an expected name.".format(key))
 
+    names = dict((k, [keys[i] for i in rows[k]]) for k in rows)
+
     return OrbitData(
-        BPMx=np.array(BPMx), BPMy=np.array(BPMy),
-        CMx=np.array(CMx), CMy=np.array(CMy),
+        BPMx=values[rows['BPMx']], BPMy=values[rows['BPMy']],
+        CMx=values[rows['CMx']], CMy=values[rows['CMy']],
         names=names,
-        sampling_frequency=0.5,
+        sampling_frequency=1/period,
         measure_date=t_start
         )
 
 
+def resample_hold(times, values, t_start, period, sample_number):
+    """ Resample irregular time series on a regular grid (sample and hold).
+
+        All the series are processed at once: they are concatenated on a
+        single integer axis where series `i` is shifted by `i*stride`, so
+        that one `np.searchsorted` call finds, for every series and every
+        grid point, the last sample taken before that point.
+
+        Parameters
+        ----------
+        times : list of sequences of datetime.datetime (or datetime64)
+            Sorted timestamps of each series.
+        values : list of np.array
+            Values of each series, same lengths as `times`.
+        t_start : datetime.datetime
+            Time of the first grid point.
+        period : float
+            Grid step in seconds.
+        sample_number : int
+            Number of grid points.
+
+        Returns
+        -------
+        np.array (nb_series x sample_number)
+            Resampled values. Grid points before the first sample of a series
+            take its first value.
+    """
+    if len(times) != len(values):
+        raise ValueError("times and values must have the same length.")
+    if not len(times):
+        return np.zeros((0, sample_number))
+
+    t0 = np.datetime64(t_start, 'us')
+    rel = [(np.asarray(t, dtype='datetime64[us]') - t0).astype(np.int64)
+           for t in times]
+    lengths = np.array([r.size for r in rel])
+    if np.any(lengths == 0):
+        raise ValueError("Every series must have at least one sample.")
+
+    grid = np.round(np.arange(sample_number)*period*1e6).astype(np.int64)
+
+    all_rel = np.concatenate(rel)
+    low = min(all_rel.min(), 0)
+    high = max(all_rel.max(), grid[-1] if sample_number else 0)
+    stride = high - low + 1
+
+    offsets = np.arange(len(rel), dtype=np.int64)*stride
+    series_id = np.repeat(np.arange(len(rel)), lengths)
+    keys = all_rel - low + offsets[series_id]
+
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    queries = (grid - low)[np.newaxis, :] + offsets[:, np.newaxis]
+    idx = np.searchsorted(keys, queries, side='right') - 1
+    idx = np.maximum(idx, starts[:, np.newaxis])
+
+    return np.concatenate([np.asarray(v, dtype=float) for v in values])[idx]
+
+
 class Archiver(object):
     url = "http://archiver.bessy.de/archive/cgi/CGIExport.cgi"
 
+    def __init__(self, url=None):
+        if url is not None:
+            self.url = url
+
+    @timed('io.filter_camonitor')
     def filter_camonitor(self, data):
         values = dict()
 
         datalist = data.decode('utf8').split('\t\n')
+        count('io.camonitor_lines', len(datalist) - 1)
 
         # create dict of values/time
         for line in datalist[:-1]:
@@ -464,7 +995,43 @@ class Archiver(object):
 
         return values
 
-    def read(self, var, t0, t1=None):
+    def read(self, var, t0, t1=None, shard=None, group_size=None,
+             max_workers=4, retries=2, backoff=0.5):
+        """ Read the values of the PVs `var` between `t0` and `t1`.
+
+            By default, one single request is sent. If `shard` or
+            `group_size` is given, the query is split into time shards and
+            PV groups that are fetched concurrently, retried on failure,
+            and merged back in time order (the samples at the boundary of
+            two shards are kept once).
+
+            Parameters
+            ----------
+            var : str or list of str
+                Pattern (regular expression) or list of PV names.
+            t0, t1 : datetime.datetime
+                Time range. If `t1` is None, `t1 = t0`. It is widened to
+                whole seconds, the resolution of the archiver.
+            shard : float or datetime.timedelta, optional.
+                Length of the time shards (in seconds if float).
+            group_size : int, optional.
+                Number of PV names (or top-level `|` alternatives of the
+                pattern) per request.
+            max_workers : int, optional.
+                Maximal number of concurrent requests. Default to 4.
+            retries : int, optional.
+                Number of times a failed request is retried. Default to 2.
+            backoff : float, optional.
+                Wait before the first retry, in seconds. It doubles at each
+                retry and is randomized by +/-50%, so that the workers do not
+                all hit an overloaded archiver again at the same time.
+                Default to 0.5.
+
+            Returns
+            -------
+            dict
+                `{pv_name: {'values': np.array, 'time': [datetime, ...]}}`
+        """
 
         if t1 is None:
             t1 = t0
@@ -481,6 +1048,58 @@ class Archiver(object):
             raise ValueError("End time must be in the past. "
                              "I'm not Marty, Doc..")
 
+        # The archiver works with a resolution of one second: widen the
+        # range to whole seconds, so that the shards below start and end on
+        # the seconds sent in the queries
+        t0 = t0.replace(microsecond=0)
+        if t1.microsecond:
+            t1 = t1.replace(microsecond=0) + timedelta(seconds=1)
+
+        if shard is None and group_size is None:
+            return self.filter_camonitor(self._query(var, t0, t1))
+
+        if shard is None:
+            shard = t1 - t0
+        elif type(shard) is not timedelta:
+            shard = timedelta(seconds=shard)
+        if shard <= timedelta(0) and t1 > t0:
+            raise ValueError("Shards must have a positive length.")
+
+        shard = timedelta(seconds=max(1., np.ceil(shard.total_seconds())))
+        bounds = [t0]
+        while bounds[-1] + shard < t1:
+            bounds.append(bounds[-1] + shard)
+        bounds.append(t1)
+
+        if type(var) is list:
+            groups = _split_groups(var, group_size)
+        else:
+            alternatives = _split_pattern(var)
+            groups = ['|'.join(g)
+                      for g in _split_groups(alternatives, group_size)]
+
+        jobs = [(g, bounds[i], bounds[i+1])
+                for g in groups for i in range(len(bounds)-1)]
+
+        def fetch(job):
+            for attempt in range(retries+1):
+                try:
+                    return self.filter_camonitor(self._query(*job))
+                except Exception:
+                    if attempt == retries:
+                        raise
+                time.sleep(backoff*2**attempt*random.uniform(0.5, 1.5))
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            results = list(pool.map(fetch, jobs))
+
+        return _merge_camonitor(results)
+
+    @timed('io.archiver_query')
+    def _query(self, var, t0, t1):
+        """ Send one camonitor request and return the raw answer.
+        """
+        now = datetime.now()
         same_week = now.isocalendar()[1] == t0.isocalendar()[1]
 
         if same_week:
@@ -508,11 +1127,81 @@ class Archiver(object):
 
         try:
             with urlopen(full_url) as response:
-                return self.filter_camonitor(response.read())
+                return response.read()
         except Exception:
             raise
 
 
+def _split_groups(items, group_size):
+    """ Split a list in consecutive groups of `group_size` elements.
+    """
+    if not group_size:
+        return [items]
+    return [items[i:i+group_size] for i in range(0, len(items), group_size)]
+
+
+def _split_pattern(pattern):
+    """ Split a regular expression on its top-level `|` alternatives.
+
+        `|` inside parentheses or brackets are left untouched, so that
+        `"(^HS.*)|(^VS[1|2].*)"` gives `["(^HS.*)", "(^VS[1|2].*)"]`.
+    """
+    alternatives = []
+    depth = 0
+    in_brackets = False
+    escaped = False
+    current = ''
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_brackets:
+            in_brackets = c != ']'
+        elif c == '[':
+            in_brackets = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            alternatives.append(current)
+            current = ''
+            continue
+        current += c
+    alternatives.append(current)
+    return alternatives
+
+
+def _merge_camonitor(results):
+    """ Merge several outputs of `Archiver.filter_camonitor`.
+
+        Samples are sorted in time and the samples returned twice (at the
+        boundary of two time shards) are kept once.
+    """
+    merged = dict()
+    for result in results:
+        for key in result:
+            if key not in merged:
+                merged[key] = {'values': [], 'time': []}
+            merged[key]['values'].append(result[key]['values'])
+            merged[key]['time'].extend(result[key]['time'])
+
+    for key in merged:
+        values = np.concatenate(merged[key]['values'])
+        times = merged[key]['time']
+        stamps = np.array(times, dtype='datetime64[us]')
+        order = np.argsort(stamps, kind='mergesort')
+        stamps = stamps[order]
+        values = values[order]
+        keep = np.ones(order.size, dtype=bool)
+        keep[1:] = (stamps[1:] != stamps[:-1]) | (values[1:] != values[:-1])
+        merged[key]['values'] = values[keep]
+        merged[key]['time'] = [times[i] for i in order[keep]]
+
+    return merged
+
+
 def load_Smat(filename):
     try:
         smat = scipy.io.loadmat(filename)
@@ -529,6 +1218,12 @@ def load_Smat(filename):
         return Smat_xx, Smat_yy
 
 
+register_format('hdf5', load_orbit_hdf5, b'\x89HDF\r\n\x1a\n',
+                ['.hdf5', '.h5'])
+register_format('mat5', load_orbit_dump, b'MATLAB 5.0 MAT-file', ['.mat'])
+register_format('npy', load_orbit_npy, b'\x93NUMPY', ['.npy'])
+
+
 if __name__ == "__main__":
     a = Archiver()
     t0 = datetime(2016, 5, 30, 16, 30, 29)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+""" Lattice model: phases, tunes, positions and response matrices.
+
+    The `.mat` sources are parsed once; the arrays are then stored in a
+    compiled `.npz` cache next to them, so that the next startups skip
+    scipy's MAT parsing. The cache is rebuilt when a source changes.
+"""
+
+from __future__ import division, print_function
+
+import os
+import tempfile
+
+import numpy as np
+import scipy.io
+
+DEFAULT_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'default_data')
+PHASE_FILE = os.path.join(DEFAULT_DATA, 'phases.mat')
+SMAT_FILE = os.path.join(DEFAULT_DATA, 'Smat-CM-Standard_HMI.mat')
+CACHE_EXT = '.cache.npz'
+
+TUNE_X = 17.8509864542659
+TUNE_Y = 6.74232980750181
+
+
+def load_cached(sources, build, cache):
+    """ Load arrays through a compiled .npz cache.
+
+        Parameters
+        ----------
+        sources : list of str
+            Files the arrays are built from. The cache is rebuilt when the
+            modification time of one of them changes.
+        build : callable
+            `build()` returning a dict of np.array (no object arrays).
+        cache : str
+            The cache file.
+
+        Returns
+        -------
+        dict of np.array
+    """
+    mtimes = np.array([os.path.getmtime(f) for f in sources])
+
+    if os.path.isfile(cache):
+        try:
+            with np.load(cache) as f:
+                if np.array_equal(f['__mtime__'], mtimes):
+                    return dict((k, f[k]) for k in f.files
+                                if k != '__mtime__')
+        except Exception:
+            pass  # broken cache, rebuilt below
+
+    arrays = build()
+    # unique temporary file, so that concurrent builds do not write into
+    # each other's file; the cache is replaced atomically
+    try:
+        tmp = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(cache)), suffix='.npz',
+            delete=False)
+    except OSError:
+        return arrays  # read-only location: work without cache
+    try:
+        with tmp:
+            np.savez(tmp, __mtime__=mtimes, **arrays)
+        os.replace(tmp.name, cache)
+    except OSError:
+        os.remove(tmp.name)
+    return arrays
+
+
+def load_mat_cached(filename, extract):
+    """ Load arrays from a .mat file through a compiled .npz cache.
+
+        Parameters
+        ----------
+        filename : str
+            The .mat file.
+        extract : callable
+            `extract(mat_dict)` returning a dict of np.array to keep.
+
+        Returns
+        -------
+        dict of np.array
+    """
+    return load_cached([filename],
+                       lambda: extract(scipy.io.loadmat(filename)),
+                       filename + CACHE_EXT)
+
+
+def _extract_phases(mat):
+    return {'x': mat['PhaseX'][:, 0], 'y': mat['PhaseZ'][:, 0]}
+
+
+def _extract_Smat(mat):
+    if 'Rmat' not in mat:
+        raise ValueError("Cannot find Rmat structure. Check the file you "
+                         "provided.")
+    return {'x': mat['Rmat'][0, 0]['Data'], 'y': mat['Rmat'][1, 1]['Data']}
+
+
+class LatticePlane(object):
+    """ Lattice data of one plane, sliced on the active BPMs and CMs.
+
+        All the arrays are C-contiguous.
+
+        Attributes
+        ----------
+        phase : np.array (bpm_nb)
+            Betatron phase at the BPMs.
+        tune : float
+        Smat : np.array (bpm_nb x cm_nb)
+            Response matrix.
+        bpm_idx, cm_idx : np.array of int
+            Indices of the active BPMs/CMs in the full machine lists (the
+            response matrix is stored for all the BPMs but only for the
+            active CMs).
+        bpm_positions, cm_positions : np.array or None
+            Positions (in m) of the active BPMs/CMs, if known.
+        bpm_names, cm_names : np.array or None
+            Names of the active BPMs/CMs, if known.
+    """
+
+    def __init__(self, phase, tune, Smat, bpm_idx, cm_idx,
+                 bpm_positions=None, cm_positions=None,
+                 bpm_names=None, cm_names=None):
+        def contiguous(x):
+            return None if x is None else np.ascontiguousarray(x)
+
+        self.phase = contiguous(phase)
+        self.tune = tune
+        self.Smat = contiguous(Smat)
+        self.bpm_idx = contiguous(bpm_idx)
+        self.cm_idx = contiguous(cm_idx)
+        self.bpm_positions = contiguous(bpm_positions)
+        self.cm_positions = contiguous(cm_positions)
+        self.bpm_names = contiguous(bpm_names)
+        self.cm_names = contiguous(cm_names)
+
+
+class LatticeModel(object):
+    """ Phases, tunes, positions and response matrices of the machine.
+
+        Parameters
+        ----------
+        active_bpms : dict, optional.
+            `{'x': idx, 'y': idx}`: indices of the active BPMs in the rows of
+            the response matrices. Required when the response matrices have
+            more rows than there are phases.
+        active_cms : dict, optional.
+            `{'x': idx, 'y': idx}`: indices in the machine lists of the CMs
+            that are the columns of the response matrices. Default to
+            `range(cm_nb)`.
+        exclude : list of int, optional.
+            Active BPMs (indices among the active ones) to leave out, e.g.
+            a BPM known to be broken. Default to none.
+        positions, names : dict, optional.
+            `{'BPMx': array, 'BPMy': array, 'HCM': array, 'VCM': array}` for
+            all the machine elements (not only the active ones).
+        tunes : (float, float), optional.
+            Horizontal and vertical tunes.
+        phase_file, smat_file : str, optional.
+            Sources, default to the files in `default_data`.
+    """
+
+    def __init__(self, active_bpms=None, active_cms=None, exclude=(),
+                 positions=None, names=None, tunes=(TUNE_X, TUNE_Y),
+                 phase_file=PHASE_FILE, smat_file=SMAT_FILE):
+        self.phases = load_mat_cached(phase_file, _extract_phases)
+        self.Smat = load_mat_cached(smat_file, _extract_Smat)
+        self.tunes = {'x': tunes[0], 'y': tunes[1]}
+        self.positions = positions if positions is not None else {}
+        self.names = names if names is not None else {}
+
+        self.active_bpms = dict()
+        self.active_cms = dict()
+        for axis in ['x', 'y']:
+            bpm_nb, cm_nb = self.Smat[axis].shape
+            if active_bpms is not None:
+                bpm_idx = np.asarray(active_bpms[axis])
+            elif bpm_nb == self.phases[axis].size:
+                bpm_idx = np.arange(bpm_nb)
+            else:
+                raise ValueError("The response matrix has {} BPMs, there are "
+                                 "{} phases: give the active BPMs."
+                                 .format(bpm_nb, self.phases[axis].size))
+            if bpm_idx.dtype == bool:
+                bpm_idx = np.where(bpm_idx)[0]
+            if bpm_idx.size != self.phases[axis].size:
+                raise ValueError("There are {} active BPMs but {} phases."
+                                 .format(bpm_idx.size,
+                                         self.phases[axis].size))
+
+            if active_cms is not None:
+                cm_idx = np.asarray(active_cms[axis])
+                if cm_idx.dtype == bool:
+                    cm_idx = np.where(cm_idx)[0]
+                if cm_idx.size != cm_nb:
+                    raise ValueError("There are {} active CMs but {} in the "
+                                     "response matrix."
+                                     .format(cm_idx.size, cm_nb))
+            else:
+                cm_idx = np.arange(cm_nb)
+
+            self.active_bpms[axis] = np.delete(bpm_idx, exclude)
+            self.active_cms[axis] = cm_idx
+        self.exclude = list(exclude)
+        self._planes = dict()
+
+    @classmethod
+    def from_pyml(cls, pml, **kwargs):
+        """ Build the model from the active elements, positions and names of
+            a configured `PyML.PyML` instance (or of anything with the same
+            `getActiveIdx`/`getfamilydata` methods).
+        """
+        active_bpms = {'x': pml.getActiveIdx('BPMx'),
+                       'y': pml.getActiveIdx('BPMy')}
+        families = ['BPMx', 'BPMy', 'HCM', 'VCM']
+        positions = dict((f, pml.getfamilydata(f, 'Pos')) for f in families)
+        names = dict((f, pml.getfamilydata(f, 'CommonNames'))
+                     for f in families)
+        active_cms = {'x': pml.getActiveIdx('HCM'),
+                      'y': pml.getActiveIdx('VCM')}
+        return cls(active_bpms, active_cms, positions=positions, names=names,
+                   **kwargs)
+
+    @classmethod
+    def from_config(cls, config=None, **kwargs):
+        """ Build the model from a `machine.MachineConfig` (default to the
+            compiled BESSY II configuration), without PyML.
+        """
+        if config is None:
+            from .machine import MachineConfig
+            config = MachineConfig()
+        return cls.from_pyml(config, **kwargs)
+
+    def plane(self, axis):
+        """ `LatticePlane` of 'x' or 'y' (computed once). """
+        if axis not in ['x', 'y']:
+            raise ValueError("axis must be 'x' or 'y', not {}".format(axis))
+        if axis not in self._planes:
+            bpm_family, cm_family = {'x': ('BPMx', 'HCM'),
+                                     'y': ('BPMy', 'VCM')}[axis]
+            bpm_idx = self.active_bpms[axis]
+            cm_idx = self.active_cms[axis]
+
+            self._planes[axis] = LatticePlane(
+                phase=np.delete(self.phases[axis], self.exclude),
+                tune=self.tunes[axis],
+                Smat=self.Smat[axis][bpm_idx, :],
+                bpm_idx=bpm_idx, cm_idx=cm_idx,
+                bpm_positions=self._select(self.positions, bpm_family,
+                                           bpm_idx),
+                bpm_names=self._select(self.names, bpm_family, bpm_idx),
+                cm_positions=self._select(self.positions, cm_family, cm_idx),
+                cm_names=self._select(self.names, cm_family, cm_idx),
+                )
+        return self._planes[axis]
+
+    @staticmethod
+    def _select(table, family, idx):
+        if table.get(family) is None:
+            return None
+        return np.asarray(table[family])[idx]
+
+    @property
+    def x(self):
+        return self.plane('x')
+
+    @property
+    def y(self):
+        return self.plane('y')
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+""" Compiled machine configuration.
+
+    The BPM and corrector tables of `default_data/bessyIIinit.py` (the PyML
+    configuration, shipped with the package) and `default_data/BPMconf.py`
+    are turned into NumPy record arrays, cached on disk and rebuilt only when
+    a source file changes. The sources are parsed, not executed: only their
+    top-level assignments of literal tables are evaluated.
+
+    The lookups offered by PyML (`getActiveIdx`, `getfamilydata`) are then
+    available without PyML.
+"""
+
+from __future__ import division, print_function
+
+import ast
+import os
+
+import numpy as np
+
+from .lattice import DEFAULT_DATA, CACHE_EXT, load_cached
+
+INIT_FILE = os.path.join(DEFAULT_DATA, 'bessyIIinit.py')
+BPMCONF_FILE = os.path.join(DEFAULT_DATA, 'BPMconf.py')
+
+BPM_DTYPE = np.dtype([('name', 'U16'), ('channel', 'U24'), ('status', 'i1'),
+                      ('device', 'i4', (2,)), ('pos', 'f8'),
+                      ('wave_index', 'i4'), ('gain', 'f8'),
+                      ('element', 'i4')])
+CM_DTYPE = np.dtype([('name', 'U16'), ('channel', 'U24'),
+                     ('setpoint', 'U24'), ('status', 'i1'),
+                     ('device', 'i4', (2,)), ('element', 'i4'),
+                     ('pos', 'f8'), ('gofb_index', 'i4')])
+BPMCONF_DTYPE = np.dtype([('name', 'U16'), ('state_x', 'i1'),
+                          ('state_y', 'i1'), ('pos', 'f8'), ('index', 'i4'),
+                          ('scale_x', 'f8'), ('scale_y', 'f8'),
+                          ('offset_x', 'f8'), ('offset_y', 'f8')])
+
+# PyML field names -> record fields
+FIELDS = {'CommonNames': 'name',
+          'ChannelNames': 'channel',
+          'Status': 'status',
+          'DeviceList': 'device',
+          'Pos': 'pos',
+          'WaveRecordIndex': 'wave_index',
+          'MetaGain': 'gain',
+          'Element': 'element',
+          'GOFBIndex': 'gofb_index',
+          }
+
+
+def read_tables(filename):
+    """ Evaluate the top-level literal assignments of a Python file.
+
+        Assignments that are not plain literals (or that refer to something
+        else than the literals assigned before) are ignored, so that the file
+        is never executed.
+
+        Returns
+        -------
+        dict
+            `{name: value}` of the evaluated assignments.
+    """
+    with open(filename, 'r') as f:
+        tree = ast.parse(f.read(), filename)
+
+    namespace = dict()
+    for node in tree.body:
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and
+                isinstance(node.targets[0], ast.Name)):
+            continue
+        if any(isinstance(n, (ast.Call, ast.Attribute, ast.Subscript,
+                              ast.Lambda)) for n in ast.walk(node.value)):
+            continue
+        try:
+            value = eval(compile(ast.Expression(node.value), filename, 'eval'),
+                         {'__builtins__': {}}, dict(namespace))
+        except Exception:
+            continue
+        namespace[node.targets[0].id] = value
+    return namespace
+
+
+def compile_config(init_file=INIT_FILE, bpmconf_file=BPMCONF_FILE):
+    """ Build the record arrays of the BPM and corrector families.
+
+        Returns
+        -------
+        dict of np.array
+            `BPMx`, `BPMy`, `HCM`, `VCM` (from `init_file`) and `BPMconf`
+            (from `bpmconf_file`).
+    """
+    init = read_tables(init_file)
+
+    def strip(x):
+        return x.strip()
+
+    families = dict()
+    # columns: name, channel, status, gain, offset of the wave index
+    for family, cols in [('BPMx', (0, 1, 2, 9, 0)),
+                         ('BPMy', (3, 4, 5, 10, 128))]:
+        name, channel, status, gain, wave_offset = cols
+        families[family] = np.array(
+            [(strip(r[name]), strip(r[channel]), r[status], r[6], r[7],
+              r[8] + wave_offset, r[gain], r[11]) for r in init['bpm']],
+            dtype=BPM_DTYPE)
+
+    for family, table in [('HCM', init['hcm']), ('VCM', init['vcm'])]:
+        families[family] = np.array(
+            [(strip(r[0]), strip(r[1]), strip(r[2]), r[3], r[4], r[5], r[6],
+              r[10] - 1) for r in table],
+            dtype=CM_DTYPE)
+
+    conf = read_tables(bpmconf_file)
+    offsets = conf.get('bpmoffset', {})
+    families['BPMconf'] = np.array(
+        [(strip(r[0]),) + tuple(r[1:7]) + offsets.get(strip(r[0]), (0., 0.))
+         for r in conf['bpmconf']],
+        dtype=BPMCONF_DTYPE)
+
+    return families
+
+
+class MachineConfig(object):
+    """ BPM and corrector tables of the machine, without PyML.
+
+        Parameters
+        ----------
+        init_file : str, optional.
+            PyML configuration. Default to `default_data/bessyIIinit.py`.
+        bpmconf_file : str, optional.
+            Default to `default_data/BPMconf.py`.
+        cache : str, optional.
+            Compiled cache. Default to `init_file + '.cache.npz'`.
+    """
+
+    def __init__(self, init_file=INIT_FILE, bpmconf_file=BPMCONF_FILE,
+                 cache=None):
+        if cache is None:
+            cache = init_file + CACHE_EXT
+        self.families = load_cached(
+            [init_file, bpmconf_file],
+            lambda: compile_config(init_file, bpmconf_file),
+            cache)
+        self._index = dict()
+        self._active = dict()
+
+    def __getitem__(self, family):
+        return self.families[family]
+
+    def index(self, family):
+        """ `{name: index}` of the elements of a family. """
+        if family not in self._index:
+            names = self.families[family]['name']
+            self._index[family] = dict((n, i) for i, n in enumerate(names))
+        return self._index[family]
+
+    def name2idx(self, family, names):
+        """ Indices of the elements `names` of a family. """
+        index = self.index(family)
+        if isinstance(names, str):
+            return index[names]
+        return np.array([index[n] for n in names], dtype=int)
+
+    def getActiveIdx(self, family):
+        """ Indices of the active elements of a family (as PyML). """
+        if family not in self._active:
+            self._active[family] = np.where(
+                self.families[family]['status'] != 0)[0]
+        return self._active[family]
+
+    def getfamilydata(self, family, field, idx=None):
+        """ Column `field` of a family (as PyML, e.g. 'Pos', 'CommonNames').
+        """
+        data = self.families[family][FIELDS.get(field, field)]
+        if idx is not None:
+            data = data[idx]
+        return data
@@ -11,6 +11,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy.optimize as optimize
 
+from .instrument import timed, count
+
 
 def rotate(cos_amp, sin_amp, phi, deg_rad='rad'):
     if deg_rad == 'deg':
@@ -26,14 +28,16 @@ def rotate(cos_amp, sin_amp, phi, deg_rad='rad'):
     return z.real, z.imag
 
 
+@timed()
 def optimize_rotation(cos_amp, sin_amp, step_size):
-    maxval = 1e10
-    angle_opt = 0
-    for angle in np.arange(-180, 180, step_size):
-        cos_opt, sin_opt = rotate(cos_amp, sin_amp, angle, 'deg')
-        if max(abs(sin_opt)) < maxval:
-            maxval = max(abs(sin_opt))
-            angle_opt = angle
+    # All the angles at once: one (angle_nb x bpm_nb) array instead of a
+    # loop, the first angle minimizing the max of the sine is kept.
+    angles = np.arange(-180, 180, step_size)
+    z = np.asarray(cos_amp) + 1j*np.asarray(sin_amp)
+    sin_max = np.max(np.abs(
+        (z[np.newaxis, :]*np.exp(1j*angles*np.pi/180.)[:, np.newaxis]).imag),
+        axis=1)
+    angle_opt = angles[np.argmin(sin_max)]
 
     cos_opt, sin_opt = rotate(cos_amp, sin_amp, angle_opt, 'deg')
 
@@ -94,6 +98,7 @@ def fit_sine(signal, phase, offset_opt=True, plot=False):
     return offset, amplitude, phase_shift
 
 
+@timed()
 def fit_sin_cos(signal, phase, offset_opt=True, plot=False):
     """ Find a sum of sine and cosine that fits with the signal.
 
@@ -160,6 +165,7 @@ def fit_sin_cos(signal, phase, offset_opt=True, plot=False):
         )
 
     abc, residual, _, _ = np.linalg.lstsq(eq_matrix, signal)
+    count('maths.lstsq')
     offset = abc[0, 0]
     amp_cos = abc[1, 0]
     amp_sin = abc[2, 0]
@@ -176,7 +182,8 @@ def fit_sin_cos(signal, phase, offset_opt=True, plot=False):
     return offset, amp_cos, amp_sin
 
 
-def extract_sin_cos(x, fs, f, output_format='cartesian'):
+@timed()
+def extract_sin_cos(x, fs, f, output_format='cartesian', verbose=True):
     """ Approximate the time signals by a funtion of type:
         `f(t) = a*cos(f*t) + b*sin(f*t)`.
 
@@ -191,6 +198,9 @@ def extract_sin_cos(x, fs, f, output_format='cartesian'):
         output_format: string, optional, default to 'cartesian'.
             In which format the result should be output:
             'cartesian' or 'polar'
+        verbose: bool, optional, default to True.
+            Print the frequency actually extracted (the closest one of the
+            FFT).
 
         Returns
         -------
@@ -223,8 +233,9 @@ def extract_sin_cos(x, fs, f, output_format='cartesian'):
     w0 = 2*np.pi*f0
     t = (np.arange(N)/fs).reshape((1, N)).repeat(M, axis=0)
     y = np.sum(x*np.exp(-1j*w0*t), axis=1)*2/N
-    print("[search_kicks.tools.math.extract_sin_cos] I use frequency {} Hz"
-          .format(f0))
+    if verbose:
+        print("[search_kicks.tools.math.extract_sin_cos] I use frequency {} "
+              "Hz".format(f0))
     ampc = np.zeros(M) + y.real
     amps = np.zeros(M) + y.imag
 
@@ -244,6 +255,7 @@ def extract_sin_cos(x, fs, f, output_format='cartesian'):
         return np.abs(ampc +1j*amps), -np.angle(ampc + 1j*amps)
 
 
+@timed()
 def klt(inputs):
     """ Apply the KLT to the input
 
@@ -271,6 +283,7 @@ def klt(inputs):
     return output
 
 
+@timed()
 def inverse_with_svd(M, nb_values):
     """ Compute the SVD and return the pseudo inverse of M with `nb_values`
         eigenvalues.
@@ -295,6 +308,7 @@ def inverse_with_svd(M, nb_values):
         pass
 
     U, s, V = np.linalg.svd(M, full_matrices=False)
+    count('maths.svd')
     # S_mat = U * diag(s) * V
     idmax = nb_values
     Sred = np.diag(np.ones(idmax)/s[:idmax])
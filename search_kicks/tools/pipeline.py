@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+""" Staged processing with bounded queues.
+
+    A `Pipeline` is a chain of `Stage`s. Each stage has a bounded input queue
+    and its own workers (threads, or threads driving a process pool), so
+    that a slow stage does not stall the ones before it. What happens when a
+    queue is full is the policy of the stage receiving the item:
+
+    - 'block': the producer waits (back-pressure),
+    - 'drop_newest': the new item is dropped,
+    - 'drop_oldest': the oldest item of the queue is dropped for it.
+
+    Every stage counts the items received, processed and dropped, the time
+    spent working and the depth of its queue.
+
+    >>> pipeline = Pipeline([Stage('extract', extract, workers=2,
+    ...                            policy='drop_oldest'),
+    ...                      Stage('sink', print)])
+    >>> with pipeline:
+    ...     for item in items:
+    ...         pipeline.put(item)
+"""
+
+from __future__ import division, print_function
+
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+POLICIES = ['block', 'drop_newest', 'drop_oldest']
+
+_STOP = object()
+
+
+class Stage(object):
+    """ Step of a pipeline.
+
+        Parameters
+        ----------
+        name : str
+        func : callable
+            `func(item)` returns the item given to the next stage, or None to
+            give nothing. With `executor='process'` it must be picklable.
+        workers : int, optional.
+            Number of items processed at once. With more than one worker the
+            order of the items is not kept. Default to 1.
+        queue_size : int, optional.
+            Size of the input queue. Default to 16.
+        policy : 'block', 'drop_newest' or 'drop_oldest', optional.
+            What to do with a new item when the queue is full. Default to
+            'block'.
+        executor : 'thread' or 'process', optional.
+            Where `func` runs. Default to 'thread'.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=16, policy='block',
+                 executor='thread'):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of {}, not {}"
+                             .format(POLICIES, policy))
+        if executor not in ['thread', 'process']:
+            raise ValueError("executor must be 'thread' or 'process'.")
+        if workers < 1:
+            raise ValueError("A stage needs at least one worker.")
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.executor = executor
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_time = 0.
+        self.max_depth = 0
+        self.last_error = None
+
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = 0
+        self._pool = None
+        self._start_time = None
+
+    def put(self, item):
+        """ Give an item to the stage, following its policy.
+
+            Returns
+            -------
+            bool
+                False if an item (this one or an older one) was dropped.
+        """
+        with self._lock:
+            self.received += 1
+        if self.policy == 'block':
+            self.queue.put(item)
+            kept = True
+        elif self.policy == 'drop_newest':
+            try:
+                self.queue.put_nowait(item)
+                kept = True
+            except queue.Full:
+                kept = False
+        else:
+            kept = True
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        kept = False
+                    except queue.Empty:
+                        pass
+        with self._lock:
+            if not kept:
+                self.dropped += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return kept
+
+    @property
+    def depth(self):
+        """ Number of items waiting in the queue. """
+        return self.queue.qsize()
+
+    @property
+    def throughput(self):
+        """ Items processed per second since the start. """
+        if self._start_time is None:
+            return 0.
+        elapsed = time.time() - self._start_time
+        return self.processed/elapsed if elapsed > 0 else 0.
+
+    def stats(self):
+        return {'received': self.received, 'processed': self.processed,
+                'dropped': self.dropped, 'errors': self.errors,
+                'depth': self.depth, 'max_depth': self.max_depth,
+                'busy_time': self.busy_time, 'throughput': self.throughput}
+
+    def start(self):
+        self._start_time = time.time()
+        if self.executor == 'process':
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._running = self.workers
+        self._threads = [threading.Thread(target=self._work,
+                                          name='{}-{}'.format(self.name, i))
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """ Stop the workers once the items already queued are processed. """
+        for _ in range(self.workers):
+            self.queue.put(_STOP)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            start = time.time()
+            try:
+                if self._pool is None:
+                    result = self.func(item)
+                else:
+                    result = self._pool.submit(self.func, item).result()
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = e
+                continue
+            finally:
+                with self._lock:
+                    self.busy_time += time.time() - start
+            with self._lock:
+                self.processed += 1
+            if result is not None and self.next is not None:
+                self.next.put(result)
+
+        # the last worker to leave stops the next stage
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.next is not None:
+            self.next.stop()
+
+
+class Pipeline(object):
+    """ Chain of stages, the output of each one feeding the next one.
+
+        Parameters
+        ----------
+        stages : list of Stage
+    """
+
+    def __init__(self, stages):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+        for stage, next_stage in zip(stages[:-1], stages[1:]):
+            stage.next = next_stage
+        self._started = False
+
+    def __getitem__(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        self._started = True
+
+    def put(self, item):
+        """ Give an item to the first stage (see `Stage.put`). """
+        return self.stages[0].put(item)
+
+    def feed(self, source, count=None):
+        """ Put the items of the iterable `source` (`count` at most). """
+        for i, item in enumerate(source):
+            if count is not None and i >= count:
+                break
+            self.put(item)
+
+    def stop(self):
+        """ Process the items already queued, then stop every stage. """
+        if not self._started:
+            return
+        self.stages[0].stop()
+        for stage in self.stages:
+            stage.join()
+        self._started = False
+
+    def stats(self):
+        """ `{stage name: counters}`. """
+        return dict((stage.name, stage.stats()) for stage in self.stages)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
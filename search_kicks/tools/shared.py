@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+""" Orbits shared between processes without copy.
+
+    The arrays of an `OrbitData` are published once in a shared memory
+    segment (or in a memory-mapped scratch file when `shared_memory` is not
+    available). The workers only receive a small picklable handle and
+    reattach the arrays as read-only views on the same memory, so that N
+    workers analysing a large capture do not need N copies of it.
+
+    The publisher owns the memory: it is released by `SharedOrbit.close`
+    (or at the end of a `with` block), after which the handle is invalid.
+
+    >>> with SharedOrbit(orbit) as shared:
+    ...     results = shared.map(analyze, frequencies, max_workers=4)
+"""
+
+from __future__ import division, print_function
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+from .io import OrbitData
+
+FAMILIES = ['BPMx', 'BPMy', 'CMx', 'CMy']
+ALIGNMENT = 64
+
+# segments attached by a worker process, by name (see `_run_shared`)
+_attached = dict()
+
+
+class SharedOrbit(object):
+    """ Publish the arrays of an orbit for other processes.
+
+        Parameters
+        ----------
+        orbit : OrbitData
+            The orbit to publish. Its arrays are copied once in the shared
+            memory.
+        backend : 'shm' or 'file', optional.
+            `multiprocessing.shared_memory` or a memory-mapped file. Default
+            to 'shm' when available.
+        directory : str, optional.
+            Directory of the scratch file of the 'file' backend. Default to
+            the temporary directory.
+
+        Attributes
+        ----------
+        handle : dict
+            Picklable description of the published orbit, to give to
+            `attach`.
+    """
+
+    def __init__(self, orbit, backend=None, directory=None):
+        if backend is None:
+            backend = 'file' if shared_memory is None else 'shm'
+        if backend not in ['shm', 'file']:
+            raise ValueError("backend must be 'shm' or 'file', not {}"
+                             .format(backend))
+        if backend == 'shm' and shared_memory is None:
+            raise ValueError("multiprocessing.shared_memory is not available.")
+
+        layout = dict()
+        size = 0
+        for key in FAMILIES:
+            x = getattr(orbit, key)
+            if x is None:
+                continue
+            layout[key] = (size, x.shape, x.dtype.str)
+            size += -(-x.nbytes // ALIGNMENT)*ALIGNMENT
+        size = max(size, 1)
+
+        self._shm = None
+        self._mmap = None
+        if backend == 'shm':
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            name = self._shm.name
+            buf = self._shm.buf
+        else:
+            fd, name = tempfile.mkstemp(suffix='.orbit', dir=directory)
+            os.close(fd)
+            self._mmap = np.memmap(name, dtype=np.uint8, mode='w+',
+                                   shape=(size,))
+            buf = self._mmap
+
+        for key, (offset, shape, dtype) in layout.items():
+            np.ndarray(shape, dtype, buffer=buf, offset=offset)[...] = \
+                getattr(orbit, key)
+        if self._mmap is not None:
+            self._mmap.flush()
+        del buf
+
+        self.handle = {'backend': backend,
+                       'name': name,
+                       'tracker': (_tracker_id() if backend == 'shm' and
+                                   os.name == 'posix' else None),
+                       'size': size,
+                       'layout': layout,
+                       'names': orbit.names,
+                       'sampling_frequency': orbit.sampling_frequency,
+                       'measure_date': orbit.measure_date,
+                       }
+
+    @property
+    def closed(self):
+        return self._shm is None and self._mmap is None
+
+    def close(self):
+        """ Release the memory. The orbits attached elsewhere must have been
+            closed before.
+        """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        if self._mmap is not None:
+            self._mmap = None
+            os.remove(self.handle['name'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def map(self, func, items, max_workers=None):
+        """ `[func(orbit, item) for item in items]` on a process pool.
+
+            `func` must be picklable (a module-level function). Each worker
+            attaches the orbit once and keeps it until the pool is closed.
+
+            Returns
+            -------
+            list
+                The results, in the order of `items`.
+        """
+        if self.closed:
+            raise ValueError("The shared orbit is closed.")
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(_run_shared, self.handle, func, item)
+                       for item in items]
+            return [future.result() for future in futures]
+
+
+class AttachedOrbit(object):
+    """ Orbit published by a `SharedOrbit`, attached in this process.
+
+        Attributes
+        ----------
+        orbit : OrbitData
+            Read-only views on the shared memory. They must not be used after
+            `close`.
+    """
+
+    def __init__(self, handle):
+        self._shm = None
+        if handle['backend'] == 'shm':
+            if shared_memory is None:
+                raise ValueError("multiprocessing.shared_memory is not "
+                                 "available.")
+            try:
+                # the publisher is responsible for the segment
+                self._shm = shared_memory.SharedMemory(name=handle['name'],
+                                                       track=False)
+            except TypeError:  # Python < 3.13
+                self._shm = shared_memory.SharedMemory(name=handle['name'])
+                # The segment is registered with the resource tracker of
+                # this process, which unlinks it when the process exits,
+                # under the feet of the publisher. The publisher and its
+                # workers share one tracker, where the segment is already
+                # registered: unregistering it there would drop the entry of
+                # the publisher.
+                tracker = handle['tracker']
+                if tracker is not None and tracker != _tracker_id():
+                    resource_tracker.unregister(self._shm._name,
+                                                'shared_memory')
+            buf = self._shm.buf
+        else:
+            buf = np.memmap(handle['name'], dtype=np.uint8, mode='r',
+                            shape=(handle['size'],))
+
+        arrays = dict()
+        for key, (offset, shape, dtype) in handle['layout'].items():
+            x = np.ndarray(shape, dtype, buffer=buf, offset=offset)
+            x.flags.writeable = False
+            arrays[key] = x
+        del buf
+
+        self.orbit = OrbitData(names=handle['names'],
+                               sampling_frequency=handle['sampling_frequency'],
+                               measure_date=handle['measure_date'], **arrays)
+
+    def close(self):
+        """ Detach the memory. The arrays of `orbit` must not be referenced
+            anywhere else anymore.
+        """
+        self.orbit = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach(handle):
+    """ Attach the orbit described by `SharedOrbit.handle`.
+
+        Returns
+        -------
+        AttachedOrbit
+            Its `orbit` attribute is the `OrbitData`.
+    """
+    return AttachedOrbit(handle)
+
+
+def _tracker_id():
+    """ Identity of the pipe to the resource tracker of this process, the
+        same in all the processes sharing the tracker.
+    """
+    stat = os.fstat(resource_tracker.getfd())
+    return (stat.st_dev, stat.st_ino)
+
+
+def _run_shared(handle, func, item):
+    if handle['name'] not in _attached:
+        _attached[handle['name']] = AttachedOrbit(handle)
+    return func(_attached[handle['name']].orbit, item)
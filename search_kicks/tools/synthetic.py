@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+""" Synthetic BPM signals built from the response matrix.
+
+    Harmonic kicks on a few correctors are turned into BPM signals through
+    the columns of the response matrix: with `P = Smat[:, correctors] *
+    amplitudes`, the orbit is `P.dot(sin(2*pi*f*t + phi))`, one matrix
+    product per chunk of samples, without the corrector x time matrix of
+    all the correctors.
+
+    >>> generator = HarmonicDisturbance(lattice.x.Smat, correctors=[10, 30],
+    ...                                 frequencies=[10., 8.5],
+    ...                                 amplitudes=[1., 0.2], noise=1e-3,
+    ...                                 seed=0)
+    >>> values = generator.generate(15000)
+    >>> for t, values in generator.chunks(150*3600, chunk=15000):
+    ...     ...
+
+    The chunks are continuous: for the same seed, the concatenation of the
+    chunks is `generate` of the whole length.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+from .io import OrbitData
+
+NOISE_MODELS = ['white', 'random_walk']
+
+
+class HarmonicDisturbance(object):
+    """ Sine kicks on some correctors, seen by the BPMs, plus noise.
+
+        Parameters
+        ----------
+        Smat : np.array (bpm_nb x cm_nb)
+            Response matrix.
+        correctors : int or list of int
+            Index of the kicking correctors (columns of `Smat`).
+        frequencies : float or list of float
+            In Hz, one per corrector or the same for all of them.
+        amplitudes : float or list of float, optional.
+            Kick amplitudes, in the unit of the correctors. Default to 1.
+        phases : float or list of float, optional.
+            Phases at t=0 in rad, so that the kick is `a*sin(2*pi*f*t + phi)`.
+            Default to 0.
+        fs : float, optional.
+            Sampling frequency. Default to 150 Hz.
+        noise : float or np.array (bpm_nb), optional.
+            Standard deviation of the BPM noise (per BPM if an array). Default
+            to 0.
+        noise_model : 'white' or 'random_walk', optional.
+            With 'random_walk', `noise` is the standard deviation of the steps
+            (a drift). Default to 'white'.
+        cm_noise : float, optional.
+            Standard deviation of a white noise on every corrector, seen by
+            the BPMs through `Smat`. Default to 0.
+        seed : int, optional.
+            Seed of the noise, for reproducible data.
+        dtype : np.dtype, optional.
+            Type of the values generated. Default to float64.
+    """
+
+    def __init__(self, Smat, correctors, frequencies, amplitudes=1.,
+                 phases=0., fs=150., noise=0., noise_model='white',
+                 cm_noise=0., seed=None, dtype=np.float64):
+        if noise_model not in NOISE_MODELS:
+            raise ValueError("noise_model must be one of {}, not {}"
+                             .format(NOISE_MODELS, noise_model))
+        self.Smat = np.asarray(Smat, dtype=float)
+        bpm_nb, cm_nb = self.Smat.shape
+        (self.correctors, self.frequencies, self.amplitudes,
+         self.phases) = [np.array(a) for a in np.broadcast_arrays(
+             np.atleast_1d(correctors), np.atleast_1d(frequencies),
+             np.atleast_1d(amplitudes), np.atleast_1d(phases))]
+        self.correctors = self.correctors.astype(int)
+        if np.any(self.correctors < 0) or np.any(self.correctors >= cm_nb):
+            raise IndexError("Corrector indexes must be in [0, {}), not {}"
+                             .format(cm_nb, self.correctors))
+        self.fs = fs
+        self.noise = np.broadcast_to(np.asarray(noise, dtype=float),
+                                     (bpm_nb,))
+        self.noise_model = noise_model
+        self.cm_noise = cm_noise
+        self.seed = seed
+        self.dtype = dtype
+
+        # one column per source: kick amplitude times its response
+        self._response = self.Smat[:, self.correctors]*self.amplitudes
+
+    @classmethod
+    def from_lattice(cls, lattice, axis, correctors, frequencies, **kwargs):
+        """ Same as the constructor with the response matrix of a plane of a
+            `lattice.LatticeModel` (active BPMs and correctors).
+        """
+        return cls(lattice.plane(axis).Smat, correctors, frequencies,
+                   **kwargs)
+
+    @property
+    def bpm_nb(self):
+        return self.Smat.shape[0]
+
+    @property
+    def cm_nb(self):
+        return self.Smat.shape[1]
+
+    def generate(self, sample_nb, correctors=False):
+        """ The BPM signals of the first `sample_nb` samples.
+
+            Parameters
+            ----------
+            sample_nb : int
+            correctors : bool, optional.
+                If True, also return the corrector signals. Default to False.
+
+            Returns
+            -------
+            values : np.array (bpm_nb x sample_nb)
+            cm_values : np.array (cm_nb x sample_nb)
+                Only if `correctors` is True.
+        """
+        bpm = np.empty((self.bpm_nb, sample_nb), dtype=self.dtype)
+        cm = (np.empty((self.cm_nb, sample_nb), dtype=self.dtype)
+              if correctors else None)
+        for start, values, cm_values in self._chunks(sample_nb, 4096,
+                                                     correctors):
+            n = values.shape[1]
+            bpm[:, start:start+n] = values
+            if correctors:
+                cm[:, start:start+n] = cm_values
+        return (bpm, cm) if correctors else bpm
+
+    def chunks(self, sample_nb, chunk=1500, correctors=False):
+        """ Yield the signals chunk by chunk, for data bigger than memory.
+
+            Yields
+            ------
+            t : np.array (n)
+                Time of the samples of the chunk, in s.
+            values : np.array (bpm_nb x n)
+            cm_values : np.array (cm_nb x n)
+                Only if `correctors` is True.
+        """
+        for start, values, cm_values in self._chunks(sample_nb, chunk,
+                                                     correctors):
+            t = np.arange(start, start + values.shape[1])/self.fs
+            if correctors:
+                yield t, values, cm_values
+            else:
+                yield t, values
+
+    def orbit(self, sample_nb, other=None, names=None, measure_date=None):
+        """ `io.OrbitData` of `sample_nb` samples, this generator giving the
+            horizontal plane and `other` (if given) the vertical one.
+        """
+        BPMx, CMx = self.generate(sample_nb, correctors=True)
+        BPMy = CMy = None
+        if other is not None:
+            BPMy, CMy = other.generate(sample_nb, correctors=True)
+        return OrbitData(BPMx=BPMx, BPMy=BPMy, CMx=CMx, CMy=CMy, names=names,
+                         sampling_frequency=self.fs,
+                         measure_date=measure_date)
+
+    def _chunks(self, sample_nb, chunk, correctors):
+        rng = np.random.default_rng(self.seed)
+        noisy = np.any(self.noise != 0)
+        drift = np.zeros(self.bpm_nb)
+        omega = 2*np.pi*self.frequencies[:, np.newaxis]
+        for start in range(0, sample_nb, chunk):
+            n = min(chunk, sample_nb - start)
+            t = np.arange(start, start + n)/self.fs
+            kicks = np.sin(omega*t + self.phases[:, np.newaxis])
+            values = self._response.dot(kicks)
+
+            # the random numbers are drawn time first, so that they do not
+            # depend on the chunk size
+            width = ((self.cm_nb if self.cm_noise else 0) +
+                     (self.bpm_nb if noisy else 0))
+            if width:
+                draws = rng.standard_normal((n, width))
+            if self.cm_noise:
+                cm_noise = self.cm_noise*draws[:, :self.cm_nb].T
+                values += self.Smat.dot(cm_noise)
+            if noisy:
+                steps = self.noise*draws[:, width-self.bpm_nb:]
+                if self.noise_model == 'random_walk':
+                    steps = np.cumsum(steps, axis=0) + drift
+                    drift = steps[-1]
+                values += steps.T
+
+            cm_values = None
+            if correctors:
+                cm_values = np.zeros((self.cm_nb, n), dtype=self.dtype)
+                np.add.at(cm_values, self.correctors,
+                          kicks*self.amplitudes[:, np.newaxis])
+                if self.cm_noise:
+                    cm_values += cm_noise
+            yield start, values.astype(self.dtype, copy=False), cm_values
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+""" Event-triggered capture on the BPM stream.
+
+    A recursive lock-in detector follows the power of the beam motion at a
+    few chosen frequencies, frame by frame. When it crosses a threshold, the
+    frames around the trigger (pre- and post-trigger windows) are frozen
+    into an `OrbitData` and analyzed.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+import scipy.signal
+
+from .acquisition import RingBuffer, X_PART, Y_PART, FRAME_DTYPE
+from .io import OrbitData
+from .maths import extract_sin_cos
+
+
+class PowerDetector(object):
+    """ Recursive (exponentially weighted) lock-in detector.
+
+        For each frequency `f`, `z = (1-a)*z + a*(x-dc)*exp(-2j*pi*f*n/fs)` is
+        updated at each frame `x`, which costs one multiply-add per channel
+        and frequency. The band power is the mean square of the component at
+        `f`, averaged over the channels.
+
+        `dc` is the exponentially weighted mean of each channel (the static
+        orbit), started at the first frame. Without it, the orbit offsets
+        leak through the averaging window into the power at `f`.
+
+        Parameters
+        ----------
+        frequencies : list of float
+            Frequencies to watch, in Hz.
+        sampling_frequency : float
+            Sampling frequency of the frames, in Hz.
+        channel_nb : int
+            Number of values in a frame.
+        time_constant : float, optional.
+            Time constant of the averaging, in seconds. Default to 1.
+        dc_time_constant : float, optional.
+            Time constant of the mean removed from the frames, in seconds.
+            Default to `time_constant`.
+    """
+
+    def __init__(self, frequencies, sampling_frequency, channel_nb,
+                 time_constant=1., dc_time_constant=None):
+        if dc_time_constant is None:
+            dc_time_constant = time_constant
+        self.frequencies = np.atleast_1d(np.asarray(frequencies, dtype=float))
+        self.sampling_frequency = float(sampling_frequency)
+        self.alpha = 1 - np.exp(-1/(time_constant*self.sampling_frequency))
+        self.dc_alpha = 1 - np.exp(-1/(dc_time_constant *
+                                       self.sampling_frequency))
+        self._step = np.exp(-2j*np.pi*self.frequencies/self.sampling_frequency)
+        self.reset(channel_nb)
+
+    def reset(self, channel_nb=None):
+        if channel_nb is None:
+            channel_nb = self._z.shape[1]
+        self._z = np.zeros((self.frequencies.size, channel_nb), dtype=complex)
+        self.dc = np.zeros(channel_nb)
+        self._phasor = np.ones(self.frequencies.size, dtype=complex)
+        self.count = 0
+
+    def update(self, x):
+        """ Add one frame and return the power at each frequency. """
+        if self.count == 0:
+            self.dc[:] = x
+        self.dc += self.dc_alpha*(x - self.dc)
+        self._z *= 1 - self.alpha
+        self._z += (self.alpha*self._phasor[:, np.newaxis] *
+                    (x - self.dc)[np.newaxis, :])
+        self._phasor *= self._step
+        self.count += 1
+        if self.count % 1024 == 0:  # avoid the drift of the modulus
+            self._phasor /= np.abs(self._phasor)
+        return self.power
+
+    def update_block(self, X):
+        """ Add the frames `X` (channel_nb x n) at once, return the power. """
+        n = X.shape[1]
+        if self.count == 0:
+            self.dc[:] = X[:, 0]
+        # the mean after each frame, as in `update`
+        dc, _ = scipy.signal.lfilter(
+            [self.dc_alpha], [1, self.dc_alpha - 1], X, axis=1,
+            zi=(1 - self.dc_alpha)*self.dc[:, np.newaxis])
+        self.dc[:] = dc[:, -1]
+        decay = (1 - self.alpha)**np.arange(n-1, -1, -1)
+        phasors = (self._phasor[:, np.newaxis] *
+                   self._step[:, np.newaxis]**np.arange(n)[np.newaxis, :])
+        self._z *= (1 - self.alpha)**n
+        self._z += self.alpha*np.dot(phasors*decay, (X - dc).T)
+        self._phasor = phasors[:, -1]*self._step
+        self._phasor /= np.abs(self._phasor)
+        self.count += n
+        return self.power
+
+    @property
+    def power(self):
+        return 2*np.mean(np.abs(self._z)**2, axis=1)
+
+
+class Trigger(object):
+    """ Capture windows of frames when the band power crosses a threshold.
+
+        Parameters
+        ----------
+        bpm_nb : int
+            Number of BPMs in a frame.
+        frequencies : list of float
+            Frequencies to watch, in Hz.
+        threshold : float or list of float
+            Band power (mean square, in BPM units^2) above which the capture
+            is triggered, for all or for each frequency.
+        pre, post : int
+            Number of frames kept before and after the trigger.
+        sampling_frequency : float, optional.
+            Default to 150 Hz.
+        time_constant : float, optional.
+            Time constant of the detector in seconds. Default to 1.
+        plane : 'x', 'y' or 'xy', optional.
+            Plane(s) watched by the detector. Default to 'xy'.
+        holdoff : int, optional.
+            Number of frames after a capture during which the trigger is
+            disarmed. Default to `post`.
+        analyze : callable, optional.
+            `analyze(orbit, frequency)` is called on each capture. Default to
+            the extraction of the sine/cosine components in both planes.
+        dc_time_constant : float, optional.
+            Time constant of the orbit mean removed by the detector, in
+            seconds. Default to `time_constant`.
+    """
+
+    def __init__(self, bpm_nb, frequencies, threshold, pre, post,
+                 sampling_frequency=150., time_constant=1., plane='xy',
+                 holdoff=None, analyze=None, dc_time_constant=None):
+        if plane not in ['x', 'y', 'xy']:
+            raise ValueError("plane must be 'x', 'y' or 'xy'.")
+        self.buffer = RingBuffer(bpm_nb, pre + post)
+        self.detector = PowerDetector(frequencies, sampling_frequency,
+                                      bpm_nb*len(plane), time_constant,
+                                      dc_time_constant)
+        self.threshold = np.broadcast_to(np.asarray(threshold, dtype=float),
+                                         self.detector.frequencies.shape)
+        self.pre = pre
+        self.post = post
+        self.sampling_frequency = sampling_frequency
+        self.plane = plane
+        self.holdoff = post if holdoff is None else holdoff
+        self.analyze = default_analysis if analyze is None else analyze
+        self.events = []
+
+        self._pending = None
+        self._armed_at = 0
+
+    def push(self, x, y):
+        """ Add one frame. Return the event captured with it, if any. """
+        if not isinstance(x, np.ndarray):
+            x = np.frombuffer(x, dtype=FRAME_DTYPE)
+        if not isinstance(y, np.ndarray):
+            y = np.frombuffer(y, dtype=FRAME_DTYPE)
+        self.buffer.push(x, y)
+
+        if self.plane == 'x':
+            power = self.detector.update(x)
+        elif self.plane == 'y':
+            power = self.detector.update(y)
+        else:
+            power = self.detector.update(np.concatenate((x, y)))
+
+        frame = self.buffer.count
+        if self._pending is None:
+            above = power > self.threshold
+            if (frame >= self._armed_at and frame >= self.pre and
+                    np.any(above)):
+                k = np.argmax(np.where(above, power/self.threshold, 0))
+                self._pending = {'frame': frame,
+                                 'frequency': self.detector.frequencies[k],
+                                 'power': power[k]}
+        elif frame - self._pending['frame'] >= self.post:
+            return self._capture()
+        return None
+
+    def push_message(self, message):
+        return self.push(message[X_PART], message[Y_PART])
+
+    def extend(self, messages):
+        """ Add several messages, return the list of events captured. """
+        events = []
+        for message in messages:
+            event = self.push_message(message)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def run(self, client, frame_nb, chunk=16):
+        """ Receive `frame_nb` frames from `client` (see
+            `acquisition.acquire`), return the events captured.
+        """
+        events = []
+        received = 0
+        while received < frame_nb:
+            messages = client.receive(min(chunk, frame_nb - received))
+            events.extend(self.extend(messages))
+            received += len(messages)
+        return events
+
+    def _capture(self):
+        event = self._pending
+        self._pending = None
+        self._armed_at = self.buffer.count + self.holdoff
+
+        # copy: the buffer is overwritten by the next frames
+        x, y = self.buffer.window(self.pre + self.post)
+        orbit = OrbitData(BPMx=x.copy(), BPMy=y.copy(),
+                          sampling_frequency=self.sampling_frequency)
+        event['orbit'] = orbit
+        event['result'] = self.analyze(orbit, event['frequency'])
+        self.events.append(event)
+        return event
+
+
+def default_analysis(orbit, frequency):
+    """ Sine/cosine components of both planes at `frequency`. """
+    fs = orbit.sampling_frequency
+    return {'x': extract_sin_cos(orbit.BPMx, fs, frequency, verbose=False),
+            'y': extract_sin_cos(orbit.BPMy, fs, frequency, verbose=False)}
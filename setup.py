@@ -9,4 +9,9 @@ setup(name = 'search_kicks',
       url = 'https://github.com/ochurlaud/MSc_SearchKicks',
       package_dir = {'search_kicks': 'search_kicks'},
       packages=find_packages(),
+      package_data = {'search_kicks': ['default_data/*.mat',
+                                       'default_data/*.py']},
+      entry_points = {
+          'console_scripts': ['search-kicks = search_kicks.cli:main'],
+          },
     )
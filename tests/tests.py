@@ -5,6 +5,16 @@ import numpy as np
 import matplotlib.pyplot as plt
 import sys
 import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
 
 __my_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, __my_dir+"/..")
@@ -94,6 +104,1353 @@ def test_get_kick():
     print("kick set found at {}".format(kick_found/(2*np.pi)))
 
 
+class FakeArchiverHandler(BaseHTTPRequestHandler):
+    """ Local stand-in for CGIExport.cgi: one sample per second and per PV,
+        the first try of every third distinct query fails.
+    """
+    pvs = ['BPMZ1D1R:rdX', 'BPMZ1D1R:rdY', 'HS1P1D1R:rdbkSet',
+           'VS1P1D1R:rdbkSet']
+    requests_nb = 0
+    seen = set()
+
+    def do_GET(self):
+        if self.path not in FakeArchiverHandler.seen:
+            FakeArchiverHandler.seen.add(self.path)
+            FakeArchiverHandler.requests_nb += 1
+            if FakeArchiverHandler.requests_nb % 3 == 0:
+                self.send_error(500)
+                return
+
+        query = parse_qs(urlparse(self.path).query)
+        t0 = datetime.strptime(query['STARTSTR'][0], "%Y-%m-%d %H:%M:%S")
+        t1 = datetime.strptime(query['ENDSTR'][0], "%Y-%m-%d %H:%M:%S")
+        if 'NAMES' in query:
+            pvs = query['NAMES'][0].split('\n')
+        else:
+            pvs = [pv for pv in self.pvs
+                   if re.search(query['PATTERN'][0], pv)]
+
+        lines = []
+        for pv in pvs:
+            t = t0
+            while t <= t1:
+                value = (t - datetime(2016, 1, 1)).total_seconds()
+                lines.append("{} {} {}\t\n".format(
+                    pv, t.strftime("%Y-%m-%d %H:%M:%S.%f"), value))
+                t += timedelta(seconds=1)
+
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(''.join(lines).encode('utf8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def test_resample_hold():
+    print("\n==========================")
+    print("Start test for io.resample_hold")
+    print("==========================")
+
+    t0 = datetime(2016, 5, 30, 16, 30, 0)
+
+    def at(seconds):
+        return [t0 + timedelta(seconds=x) for x in seconds]
+
+    times = [at([-5, 0.3, 1.7, 4.2, 20]),  # before, inside and after
+             at([1.0, 3.0]),               # starts on a grid point
+             at([100])]                    # only after the grid
+    values = [np.array([1., 2., 3., 4., 5.]), np.array([10., 20.]),
+              np.array([7.])]
+    resampled = sktools.io.resample_hold(times, values, t0, 0.5, 8)
+
+    # last sample at or before each grid point, the first one before
+    assert np.array_equal(resampled[0], [1, 2, 2, 2, 3, 3, 3, 3])
+    assert np.array_equal(resampled[1], [10, 10, 10, 10, 10, 10, 20, 20])
+    assert np.array_equal(resampled[2], [7]*8)
+    assert sktools.io.resample_hold([], [], t0, 0.5, 8).shape == (0, 8)
+
+    class StaticArchiver(object):
+        def read(self, var, t_start, t_end):
+            return {'BPMZ1D1R:rdX': {'time': times[0], 'values': values[0]},
+                    'HS1P1D1R:rdbkSet': {'time': times[1],
+                                         'values': values[1]}}
+
+    orbit = sktools.io.load_orbit_from_archiver(
+        t0, t0 + timedelta(seconds=4), period=0.5,
+        archiver=StaticArchiver())
+    assert orbit.sampling_frequency == 2
+    assert orbit.sample_number == 8
+    assert np.array_equal(orbit.BPMx[0], resampled[0])
+    assert np.array_equal(orbit.CMx[0], resampled[1])
+    print("\tirregular series resampled every 0.5 s")
+
+
+def test_archiver_read_sharded():
+    print("\n==========================")
+    print("Start test for Archiver.read(shard=...)")
+    print("==========================")
+
+    server = HTTPServer(('127.0.0.1', 0), FakeArchiverHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        url = "http://127.0.0.1:{}/CGIExport.cgi".format(server.server_port)
+        archiver = sktools.io.Archiver(url)
+        t0 = datetime(2016, 5, 30, 16, 30, 29)
+        t1 = t0 + timedelta(minutes=2)
+        pattern = "(^BPMZ[1-7].*:rd[X|Y]$)|(^HS[1-4].*:rdbkSet$)"
+
+        FakeArchiverHandler.requests_nb = 1
+        single = archiver.read(pattern, t0, t1)
+        sharded = archiver.read(pattern, t0, t1, shard=25, group_size=1,
+                                max_workers=4, retries=2, backoff=0.01)
+
+        # sub-second bounds and shards: widened to whole seconds
+        start = t0 + timedelta(seconds=0.4)
+        fractional = archiver.read(['BPMZ1D1R:rdX'], start,
+                                   start + timedelta(seconds=60),
+                                   shard=12.5, max_workers=4, backoff=0.01)
+        whole = archiver.read(['BPMZ1D1R:rdX'], t0,
+                              t0 + timedelta(seconds=61), group_size=1,
+                              backoff=0.01)
+    finally:
+        server.shutdown()
+
+    times = fractional['BPMZ1D1R:rdX']['time']
+    assert times == whole['BPMZ1D1R:rdX']['time']
+    assert times[0] == t0 and times[-1] == t0 + timedelta(seconds=61)
+    assert len(times) == len(set(times)) == 62
+
+    assert sorted(single) == sorted(sharded) == sorted(
+        ['BPMZ1D1R:rdX', 'BPMZ1D1R:rdY', 'HS1P1D1R:rdbkSet'])
+    for key in single:
+        assert single[key]['time'] == sharded[key]['time']
+        assert np.array_equal(single[key]['values'], sharded[key]['values'])
+    print("\t{} PVs, {} samples each, identical to a single request"
+          .format(len(sharded), len(sharded['BPMZ1D1R:rdX']['time'])))
+
+    # the retries wait longer and longer, with some jitter
+    class FailingArchiver(sktools.io.Archiver):
+        def _query(self, var, t0, t1):
+            raise IOError("archiver overloaded")
+
+    delays = []
+    sleep = sktools.io.time.sleep
+    sktools.io.time.sleep = delays.append
+    try:
+        FailingArchiver().read(['BPMZ1D1R:rdX'], t0, t1, group_size=1,
+                               max_workers=1, retries=3, backoff=0.2)
+        assert False, "the last failure must be raised"
+    except IOError:
+        pass
+    finally:
+        sktools.io.time.sleep = sleep
+    assert len(delays) == 3
+    for attempt, delay in enumerate(delays):
+        assert 0.1*2**attempt <= delay <= 0.3*2**attempt
+    assert len(set(delays)) == 3
+
+
+class CountingArchiver(object):
+    """ In-process archiver: one sample per second, counts the queries. """
+    def __init__(self):
+        self.queries = []
+
+    def read(self, var, t0, t1):
+        self.queries.append((t0, t1))
+        data = dict()
+        for pv in var:
+            times = []
+            t = t0
+            while t <= t1:
+                times.append(t)
+                t += timedelta(seconds=1)
+            data[pv] = {'time': times,
+                        'values': np.array([(t - datetime(2016, 1, 1))
+                                            .total_seconds() for t in times])}
+        return data
+
+
+def test_archiver_cache():
+    import shutil
+    import tempfile
+
+    print("\n==========================")
+    print("Start test for cache.ArchiverCache")
+    print("==========================")
+
+    directory = tempfile.mkdtemp()
+    try:
+        archiver = CountingArchiver()
+        cache = sktools.cache.ArchiverCache(archiver, directory)
+        t0 = datetime(2016, 5, 30, 8, 0, 0)
+        pvs = ['BPMZ1D1R:rdX', 'BPMZ1D1R:rdY']
+
+        first = cache.read(pvs, t0, t0 + timedelta(minutes=10))
+        assert len(archiver.queries) == 2
+        again = sktools.cache.ArchiverCache(archiver, directory).read(
+            pvs, t0 + timedelta(minutes=2), t0 + timedelta(minutes=5))
+        assert len(archiver.queries) == 2
+        assert again['BPMZ1D1R:rdX']['time'] == \
+            first['BPMZ1D1R:rdX']['time'][120:301]
+
+        # Only the missing 5 minutes are fetched
+        wider = cache.read(pvs, t0 + timedelta(minutes=5),
+                           t0 + timedelta(minutes=15))
+        assert archiver.queries[-1] == (t0 + timedelta(minutes=10),
+                                        t0 + timedelta(minutes=15))
+        assert len(wider['BPMZ1D1R:rdY']['time']) == 601
+
+        cache.max_size = 0
+        cache.read(pvs, t0, t0 + timedelta(seconds=10))
+        assert cache.size == 0
+        print("\t{} archiver queries in total"
+              .format(len(archiver.queries)))
+
+        # two caches opened on the same directory keep each other's chunks
+        first = sktools.cache.ArchiverCache(archiver, directory)
+        second = sktools.cache.ArchiverCache(archiver, directory)
+        first.read(['HS1P1D1R:rdbkSet'], t0, t0 + timedelta(minutes=1))
+        second.read(['VS1P1D1R:rdbkSet'], t0, t0 + timedelta(minutes=1))
+        count = len(archiver.queries)
+        third = sktools.cache.ArchiverCache(archiver, directory)
+        third.read(['HS1P1D1R:rdbkSet', 'VS1P1D1R:rdbkSet'], t0,
+                   t0 + timedelta(minutes=1))
+        assert len(archiver.queries) == count
+        assert not [f for f in os.listdir(directory) if f.endswith('.tmp')]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_load_cached():
+    import shutil
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    print("\n==========================")
+    print("Start test for lattice.load_cached")
+    print("==========================")
+
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, 'source.txt')
+        with open(source, 'w') as f:
+            f.write('1 2 3')
+        cache = os.path.join(directory, 'source.txt.cache.npz')
+        builds = []
+
+        def build():
+            builds.append(1)
+            return {'a': np.loadtxt(source)}
+
+        def load(_):
+            return sktools.lattice.load_cached([source], build, cache)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            loaded = list(pool.map(load, range(8)))
+        assert all(np.array_equal(a['a'], [1, 2, 3]) for a in loaded)
+        # only the source and a complete cache are left
+        assert sorted(os.listdir(directory)) == ['source.txt',
+                                                 'source.txt.cache.npz']
+        count = len(builds)
+        assert np.array_equal(load(0)['a'], [1, 2, 3])
+        assert len(builds) == count
+    finally:
+        shutil.rmtree(directory)
+    print("\t8 concurrent loads, {} builds, no temporary file left"
+          .format(count))
+
+
+def test_machine_config():
+    import shutil
+    import tempfile
+
+    print("\n==========================")
+    print("Start test for machine.MachineConfig")
+    print("==========================")
+
+    init_file = sktools.machine.INIT_FILE
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, 'init.py')
+        with open(source, 'w') as f:
+            f.write("import numpy as np\n"
+                    "a = [1, 2.5, 'x']\n"
+                    "b = a + [3]\n"
+                    "c = np.array(a)\n"
+                    "d = open('/etc/passwd').read()\n")
+        assert sktools.machine.read_tables(source) == {
+            'a': [1, 2.5, 'x'], 'b': [1, 2.5, 'x', 3]}
+
+        assert os.path.dirname(init_file) == \
+            os.path.dirname(sktools.machine.BPMCONF_FILE)
+        config = sktools.machine.MachineConfig(
+            init_file, cache=os.path.join(directory, 'init.cache.npz'))
+        assert os.path.isfile(os.path.join(directory, 'init.cache.npz'))
+    finally:
+        shutil.rmtree(directory)
+
+    # rows of default_data/bessyIIinit.py
+    bpm = config['BPMx'][7]
+    assert bpm['name'] == 'BPMZ5D1R' and bpm['channel'] == 'BPMZ5D1R:rdX'
+    assert bpm['status'] == 0 and list(bpm['device']) == [1, 9]
+    assert bpm['pos'] == 2.736 and bpm['wave_index'] == 1
+    assert bpm['element'] == 7
+    bpm = config['BPMy'][8]
+    assert bpm['name'] == 'BPMZ6D1R' and bpm['channel'] == 'BPMZ6D1R:rdY'
+    assert bpm['status'] == 1 and bpm['wave_index'] == 2 + 128
+    hcm = config['HCM'][:2]
+    assert list(hcm['name']) == ['HS4M2D1R', 'HBM2D1R']
+    assert list(hcm['setpoint']) == ['HS4P2D1R:set', 'HBP2D1R:set']
+    assert list(hcm['status']) == [1, 0]
+    assert list(hcm['gofb_index']) == [0, -1]
+    vcm = config['VCM'][1]
+    assert vcm['name'] == 'VS2M2D1R' and vcm['pos'] == 6.537
+    assert vcm['gofb_index'] == 49
+
+    assert config['BPMx'].size == config['BPMy'].size == 128
+    assert config['HCM'].size == 80 and config['VCM'].size == 70
+    for family, active in [('BPMx', 108), ('BPMy', 108), ('HCM', 48),
+                           ('VCM', 64)]:
+        idx = config.getActiveIdx(family)
+        assert idx.size == active
+        assert np.all(config[family]['status'][idx] != 0)
+    assert config.getActiveIdx('BPMx')[0] == 8
+    assert np.array_equal(config.getfamilydata('BPMx', 'Pos', [7, 8]),
+                          [2.736, 3.995])
+    assert np.array_equal(config.getfamilydata('HCM', 'CommonNames')[:2],
+                          ['HS4M2D1R', 'HBM2D1R'])
+    assert config.name2idx('BPMx', 'BPMZ6D1R') == 8
+    assert list(config.name2idx('VCM', ['VS2M2D1R', 'VS3M2D1R'])) == [1, 0]
+    print("\tknown BPM and CM rows and lookups OK")
+
+
+def test_ring_buffer():
+    print("\n==========================")
+    print("Start test for acquisition.RingBuffer")
+    print("==========================")
+
+    bpm_nb = 112
+    BPMx = np.random.normal(size=(bpm_nb, 250))
+    BPMy = np.random.normal(size=(bpm_nb, 250))
+    publisher = sktools.acquisition.LocalPublisher(BPMx, BPMy)
+    frames = sktools.acquisition.RingBuffer(bpm_nb, 100)
+
+    sktools.acquisition.acquire(publisher, frames, 230, chunk=16)
+    x, y = frames.window(80)
+    assert np.array_equal(x, BPMx[:, 150:230])
+    assert np.array_equal(y, BPMy[:, 150:230])
+    assert np.shares_memory(x, frames.window()[0])
+    # the time series of each BPM is contiguous
+    assert x.strides[1] == y.strides[1] == x.itemsize
+    assert x[3].flags.c_contiguous
+
+    orbit = frames.orbit()
+    assert orbit.sample_number == 100
+    assert np.array_equal(orbit.BPMx, BPMx[:, 130:230])
+    print("\t{} frames received, window of {} read without copy"
+          .format(frames.count, x.shape[1]))
+
+
+def test_trigger():
+    print("\n==========================")
+    print("Start test for trigger.PowerDetector and trigger.Trigger")
+    print("==========================")
+
+    rng = np.random.default_rng(0)
+    fs = 150.
+    t = np.arange(3000)/fs
+    # static orbit of +-500 um, 1 um of BPM noise
+    offsets = rng.uniform(-500, 500, size=(112, 1))
+    BPMx = offsets + rng.normal(size=(112, 3000))
+    BPMy = -offsets + rng.normal(size=(112, 3000))
+
+    detector = sktools.trigger.PowerDetector([10., 8.5], fs, 112)
+    block = sktools.trigger.PowerDetector([10., 8.5], fs, 112)
+    signal = BPMx + 3*np.cos(2*np.pi*10*t + 0.3)
+    for i in range(3000):
+        power = detector.update(signal[:, i])
+    for i in range(0, 3000, 128):
+        block_power = block.update_block(signal[:, i:i+128])
+    assert np.allclose(power, block_power)
+    assert np.allclose(detector.dc, block.dc)
+    # the mean square of the 10 Hz sine, not of the offsets
+    assert abs(power[0] - 4.5) < 0.05*4.5
+    assert power[1] < 0.1
+
+    # 20 s of quiet beam
+    publisher = sktools.acquisition.LocalPublisher(BPMx, BPMy)
+    trigger = sktools.trigger.Trigger(112, [10.], 0.5, 150, 150)
+    assert trigger.run(publisher, 3000) == []
+    assert trigger.detector.power[0] < 0.05
+
+    # 10 Hz burst from 10 s
+    burst = BPMx.copy()
+    burst[:, 1500:] += 5*np.sin(2*np.pi*10*t[1500:])
+    trigger = sktools.trigger.Trigger(112, [8.5, 10.], 0.5, 150, 150)
+    publisher = sktools.acquisition.LocalPublisher(burst, BPMy)
+    events = trigger.run(publisher, 3000, chunk=64)
+    assert events == trigger.events
+    event = events[0]
+    frame = event['frame']
+    assert 1500 < frame < 1600
+    assert event['frequency'] == 10.
+    assert event['power'] > 0.5
+    assert np.array_equal(event['orbit'].BPMx, burst[:, frame-150:frame+150])
+    assert np.array_equal(event['orbit'].BPMy, BPMy[:, frame-150:frame+150])
+    assert set(event['result']) == {'x', 'y'}
+    # the burst goes on: one capture per post + holdoff frames
+    assert [e['frame'] - frame for e in events] == list(range(0, 1450, 300))
+
+    # positional arguments up to `plane`, as before dc_time_constant
+    trigger = sktools.trigger.Trigger(112, 10., 0.5, 150, 150, 150., 1., 'x',
+                                      holdoff=450)
+    assert trigger.plane == 'x'
+    assert trigger.detector.dc_alpha == trigger.detector.alpha
+    publisher = sktools.acquisition.LocalPublisher(burst, BPMy)
+    events = trigger.run(publisher, 3000)
+    assert [e['frame'] - events[0]['frame'] for e in events] == [0, 600, 1200]
+    print("\tno trigger on the static orbit, {} captures of the burst"
+          .format(len(trigger.events)))
+
+
+def test_orbit_select():
+    print("\n==========================")
+    print("Start test for OrbitData.select")
+    print("==========================")
+
+    names = {'BPMx': ['BPMZ{}D1R'.format(i) for i in range(10)],
+             'BPMy': ['BPMZ{}D1R'.format(i) for i in range(10)],
+             'CMx': ['HS{}'.format(i) if i % 2 else 'HB{}'.format(i)
+                     for i in range(6)],
+             'CMy': ['VS{}'.format(i) for i in range(4)]}
+    orbit = sktools.io.OrbitData(BPMx=np.random.normal(size=(10, 50)),
+                                 BPMy=np.random.normal(size=(10, 50)),
+                                 CMx=np.random.normal(size=(6, 50)),
+                                 CMy=np.random.normal(size=(4, 50)),
+                                 names=names, sampling_frequency=150)
+
+    sub = orbit.select(names=['BPMZ3D1R', 'BPMZ4D1R', 'BPMZ5D1R'])
+    assert np.array_equal(sub.BPMx, orbit.BPMx[3:6])
+    assert np.shares_memory(sub.BPMx, orbit.BPMx)
+    assert sub.CMx.shape == (0, 50)
+
+    sub = orbit.select(pattern='^HS')
+    assert sub.names['CMx'] == ['HS1', 'HS3', 'HS5']
+    assert np.shares_memory(sub.CMx, orbit.CMx)
+
+    sub = orbit.select(names=['BPMZ7D1R', 'BPMZ1D1R'])
+    assert np.array_equal(sub.BPMy, orbit.BPMy[[7, 1]])
+
+    try:
+        orbit.select(names=['BPMZ1D1R', 'unknown'])
+        assert False
+    except KeyError:
+        pass
+    print("\tselections by name and by pattern OK")
+
+
+def test_slice_time():
+    print("\n==========================")
+    print("Start test for OrbitData.slice_time")
+    print("==========================")
+
+    # 10 Hz from 2016-05-30 12:00:00, samples every 0.1 s
+    start = datetime(2016, 5, 30, 12)
+    orbit = sktools.io.OrbitData(BPMx=np.arange(200.).reshape(2, 100),
+                                 BPMy=-np.arange(200.).reshape(2, 100),
+                                 CMx=np.ones((3, 100)), CMy=None,
+                                 sampling_frequency=10, measure_date=start)
+    axis = orbit.datetime64
+    assert axis.dtype == np.dtype('datetime64[ns]')
+    assert axis[0] == np.datetime64('2016-05-30T12:00:00')
+    assert axis[15] == np.datetime64('2016-05-30T12:00:01.5')
+    assert orbit.datetime64 is axis
+
+    # [1 s, 2 s): samples 10 to 19, the end sample is excluded
+    for t0, t1 in [('2016-05-30T12:00:01', '2016-05-30T12:00:02'),
+                   (start + timedelta(seconds=1), start + timedelta(seconds=2)),
+                   (np.datetime64('2016-05-30T12:00:01'),
+                    np.datetime64('2016-05-30T12:00:02'))]:
+        sub = orbit.slice_time(t0, t1)
+        assert sub.sample_number == 10
+        assert np.array_equal(sub.BPMx, orbit.BPMx[:, 10:20])
+        assert np.array_equal(sub.BPMy, orbit.BPMy[:, 10:20])
+        assert sub.CMy is None
+        assert np.shares_memory(sub.BPMx, orbit.BPMx)
+        assert np.shares_memory(sub.CMx, orbit.CMx)
+        assert sub.measure_date == start + timedelta(seconds=1)
+        assert np.array_equal(sub.datetime64, axis[10:20])
+
+    # between two samples, and open bounds
+    sub = orbit.slice_time('2016-05-30T12:00:01.05')
+    assert sub.sample_number == 89
+    assert sub.measure_date == start + timedelta(seconds=1.1)
+    assert orbit.slice_time(end='2016-05-30T12:00:00.25').sample_number == 3
+    assert orbit.slice_time().sample_number == 100
+    assert orbit.slice_time('2016-05-30T12:00:05',
+                            '2016-05-30T12:00:04').sample_number == 0
+    assert orbit.slice_time('2016-05-30T13:00').sample_number == 0
+
+    orbit = sktools.io.OrbitData(BPMx=np.zeros((2, 100)), BPMy=None,
+                                 CMx=None, CMy=None, sampling_frequency=10)
+    try:
+        orbit.slice_time('2016-05-30T12:00:01')
+        assert False
+    except ValueError:
+        pass
+    print("\thalf-open windows without copy OK")
+
+
+def test_orbit_spectrum():
+    print("\n==========================")
+    print("Start test for OrbitData spectra")
+    print("==========================")
+
+    t = np.arange(1500)/150.
+    BPMx = np.vstack([2*np.sin(2*np.pi*10*t), 0.5*np.cos(2*np.pi*25*t)])
+    orbit = sktools.io.OrbitData(BPMx=BPMx, BPMy=-BPMx,
+                                 CMx=np.ones((3, 1500)), CMy=None,
+                                 sampling_frequency=150)
+
+    freqs = orbit.frequencies
+    assert np.allclose(freqs, np.arange(751)/10.)
+    amplitude = orbit.amplitude_spectrum('BPMx')
+    assert amplitude.shape == (2, 751)
+    assert np.isclose(amplitude[0, 100], 2) and np.isclose(amplitude[1, 250],
+                                                           0.5)
+    amplitude[:, [100, 250]] = 0
+    assert np.all(amplitude < 1e-10)
+    assert np.allclose(orbit.spectrum('BPMy'), -orbit.spectrum('BPMx'))
+    # one transform for all the arrays, computed once
+    spectrum = orbit.spectrum('BPMx')
+    assert orbit.spectrum('BPMx') is spectrum
+    assert spectrum.base is orbit.spectrum('CMx').base is not None
+    try:
+        orbit.spectrum('CMy')
+        assert False
+    except ValueError:
+        pass
+
+    freqs, psd = orbit.psd('BPMx')
+    assert np.allclose(freqs, np.arange(76))
+    assert np.argmax(psd[0]) == 10 and np.argmax(psd[1]) == 25
+    assert orbit.psd('BPMx') is orbit.psd('BPMx')
+    assert np.allclose(orbit.band_rms('BPMx', 5, 15), [np.sqrt(2), 0],
+                       atol=1e-6)
+    assert np.allclose(orbit.band_rms('BPMx', 20, 30), [0, np.sqrt(0.125)],
+                       atol=1e-6)
+    assert np.allclose(orbit.band_rms('BPMx'), np.std(BPMx, axis=1))
+    assert np.array_equal(orbit.band_rms('BPMx', nperseg=1), [0, 0])
+
+    # sub-Hz data, e.g. from the archiver: segments of 8 samples
+    slow = sktools.io.OrbitData(BPMx=np.random.normal(size=(5, 200)),
+                                BPMy=None, CMx=None, CMy=None,
+                                sampling_frequency=0.5)
+    freqs, psd = slow.psd('BPMx')
+    assert freqs.size == 5 and np.isclose(freqs[-1], 0.25)
+    assert psd.shape == (5, 5)
+    assert np.allclose(slow.band_rms('BPMx'), np.std(slow.BPMx, axis=1),
+                       rtol=0.3)
+
+    # the caches are kept until cleared
+    orbit.BPMx[:] = 0
+    assert np.isclose(orbit.amplitude_spectrum('BPMx')[0, 100], 2)
+    orbit.clear_cache()
+    assert np.all(orbit.amplitude_spectrum('BPMx') == 0)
+    assert np.all(orbit.band_rms('BPMx') == 0)
+    print("\tsine amplitudes and band RMS OK")
+
+
+def test_orbit_recorder():
+    import shutil
+    import tempfile
+
+    print("\n==========================")
+    print("Start test for acquisition.OrbitRecorder")
+    print("==========================")
+
+    BPMx = np.random.normal(size=(112, 3000))
+    CMx = np.random.normal(size=(48, 3000))
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'recording.hdf5')
+        recorder = sktools.acquisition.OrbitRecorder(
+            150., capacity=16, measure_date=datetime(2016, 5, 30),
+            filename=filename)
+        for i in range(0, 3000, 50):
+            recorder.append(BPMx=BPMx[:, i:i+50], BPMy=-BPMx[:, i:i+50],
+                            CMx=CMx[:, i:i+50], CMy=CMx[:10, i:i+50])
+            if i % 500 == 0:
+                recorder.flush()
+        orbit = recorder.orbit()
+        assert orbit.sample_number == 3000
+        assert np.array_equal(orbit.BPMy, -BPMx)
+        recorder.close()
+
+        orbit = sktools.io.load_orbit_hdf5(filename)
+        assert np.array_equal(orbit.BPMx, BPMx)
+        assert np.array_equal(orbit.CMy, CMx[:10])
+        assert orbit.measure_date == datetime(2016, 5, 30)
+
+        recorder = sktools.acquisition.OrbitRecorder(
+            150., max_samples=200, measure_date=datetime(2016, 5, 30))
+        for i in range(3000):
+            recorder.append(BPMx=BPMx[:, i], BPMy=BPMx[:, i])
+        orbit = recorder.orbit()
+        assert np.array_equal(orbit.BPMx, BPMx[:, -200:])
+        assert orbit.measure_date == (datetime(2016, 5, 30) +
+                                      timedelta(seconds=2800/150.))
+        print("\t{} samples recorded and flushed, bounded history of {}"
+              .format(3000, orbit.sample_number))
+    finally:
+        shutil.rmtree(directory)
+
+
+def _shared_sin_cos(orbit, f):
+    assert not orbit.BPMx.flags.writeable
+    return sktools.maths.extract_sin_cos(orbit.BPMx, orbit.sampling_frequency,
+                                         f)
+
+
+def _attach_elsewhere(handle, orbit):
+    """ Attach a shared orbit in an unrelated process, which must leave the
+        segment to the publisher when it exits.
+    """
+    import pickle
+    import subprocess
+
+    script = ("import pickle, sys\n"
+              "sys.path.insert(0, sys.argv[1])\n"
+              "from search_kicks.tools import shared\n"
+              "attached = shared.attach(pickle.load(sys.stdin.buffer))\n"
+              "print(attached.orbit.CMx.sum())\n"
+              "attached.close()\n")
+    process = subprocess.Popen([sys.executable, '-c', script, __my_dir+"/.."],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate(pickle.dumps(handle))
+    assert process.returncode == 0, err
+    assert np.isclose(float(out), orbit.CMx.sum())
+    assert b'leaked' not in err
+    with sktools.shared.attach(handle) as attached:
+        assert np.array_equal(attached.orbit.CMx, orbit.CMx)
+
+
+def test_shared_orbit():
+    print("\n==========================")
+    print("Start test for shared.SharedOrbit")
+    print("==========================")
+
+    t = np.arange(1500)/150.
+    BPMx = np.outer(np.random.normal(size=112), np.sin(2*np.pi*10*t))
+    orbit = sktools.io.OrbitData(BPMx=BPMx, BPMy=-BPMx,
+                                 CMx=np.random.normal(size=(48, 1500)),
+                                 sampling_frequency=150.)
+    frequencies = [5., 10., 20.]
+
+    for backend in ['shm', 'file']:
+        with sktools.shared.SharedOrbit(orbit, backend=backend) as shared:
+            with sktools.shared.attach(shared.handle) as attached:
+                assert np.array_equal(attached.orbit.CMx, orbit.CMx)
+                assert attached.orbit.CMy is None
+            results = shared.map(_shared_sin_cos, frequencies, max_workers=2)
+            if backend == 'shm':
+                _attach_elsewhere(shared.handle, orbit)
+        assert shared.closed
+        for f, result in zip(frequencies, results):
+            expected = sktools.maths.extract_sin_cos(BPMx, 150., f)
+            assert np.allclose(result, expected)
+        print("\t{}: {} analyses in 2 worker processes".format(
+            backend, len(results)))
+
+
+def test_load_orbit_dump_threads():
+    import shutil
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from search_kicks.tools import matlab
+
+    print("\n==========================")
+    print("Start test for io.load_orbit_dump in threads")
+    print("==========================")
+
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for i in range(8):
+            filename = os.path.join(directory, 'dump{}.mat'.format(i))
+            BPM = np.random.normal(size=(112, 150))
+            CM = np.random.normal(size=(48, 150))
+            matlab.save_timeanalys(filename, BPM, -BPM, CM, CM[:32])
+            filenames.append(filename)
+
+        expected = [sktools.io.load_orbit_dump(f) for f in filenames]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            loaded = list(pool.map(sktools.io.load_orbit_dump,
+                                   filenames*8))
+    finally:
+        shutil.rmtree(directory)
+
+    for i, orbit in enumerate(loaded):
+        reference = expected[i % len(filenames)]
+        assert orbit.measure_date == reference.measure_date
+        for key in ['BPMx', 'BPMy', 'CMx', 'CMy']:
+            assert np.array_equal(getattr(orbit, key),
+                                  getattr(reference, key))
+    print("\t{} dumps loaded in 8 threads, identical to serial loading"
+          .format(len(loaded)))
+
+
+def test_orbit_compact():
+    import pickle
+    import shutil
+    import tempfile
+    from search_kicks.tools import matlab
+
+    print("\n==========================")
+    print("Start test for the compact mode of OrbitData")
+    print("==========================")
+
+    BPM = np.random.normal(size=(128, 300))
+    CM = np.random.normal(size=(80, 300))
+    orbit = sktools.io.OrbitData(BPMx=BPM, BPMy=-BPM, CMx=CM[:, ::-1],
+                                 CMy=CM[:70], sampling_frequency=150,
+                                 measure_date=datetime(2016, 5, 30))
+    assert orbit.bpm_block is None
+
+    compact = orbit.to_compact(np.float32)
+    block = compact.bpm_block
+    assert block.shape == (2, 128, 300) and block.flags.c_contiguous
+    assert block.dtype == compact.CMx.dtype == compact.CMy.dtype == np.float32
+    assert compact.BPMx.base is block and compact.BPMy.base is block
+    assert compact.CMx.flags.c_contiguous
+    assert not np.shares_memory(block, orbit.BPMx)
+    assert np.allclose(compact.BPMy, -BPM, atol=1e-6)
+    assert np.allclose(compact.CMx, CM[:, ::-1], atol=1e-6)
+    block[0, 0, 0] = 42
+    assert compact.BPMx[0, 0] == 42
+    assert orbit.to_compact().bpm_block.dtype == np.float64
+
+    # the views are rebuilt on the block after a pickle round-trip
+    copy = pickle.loads(pickle.dumps(compact))
+    assert copy.BPMx.base is copy.bpm_block
+    assert copy.BPMy.base is copy.bpm_block
+    assert np.array_equal(copy.bpm_block, block)
+    assert copy.measure_date == compact.measure_date
+    assert copy.sample_number == 300
+
+    try:
+        sktools.io.OrbitData(BPMx=BPM, BPMy=None, CMx=None, CMy=None,
+                             sampling_frequency=150, compact=True)
+        assert False
+    except ValueError:
+        pass
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'dump.mat')
+        matlab.save_timeanalys(filename, BPM, -BPM, CM, CM[:70])
+        loaded = sktools.io.load_orbit_dump(filename, compact=True,
+                                            dtype=np.float32)
+        reference = sktools.io.load_orbit_dump(filename)
+        single = sktools.io.load_orbit_dump(filename, dtype=np.float32)
+    finally:
+        shutil.rmtree(directory)
+
+    assert reference.bpm_block is None and reference.BPMx.dtype == float
+    assert single.bpm_block is None
+    assert all(getattr(single, key).dtype == np.float32
+               for key in ['BPMx', 'BPMy', 'CMx', 'CMy'])
+    assert loaded.bpm_block.shape == (2, 128, 300)
+    assert loaded.bpm_block.dtype == np.float32
+    assert loaded.BPMx.base is loaded.bpm_block
+    assert loaded.BPMy.base is loaded.bpm_block
+    assert loaded.CMy.dtype == np.float32 and loaded.CMy.flags.c_contiguous
+    for key in ['BPMx', 'BPMy', 'CMx', 'CMy']:
+        assert np.allclose(getattr(loaded, key), getattr(reference, key),
+                           atol=1e-6)
+    print("\tBPM views share one float32 block, kept through pickle")
+
+
+def test_load_orbits():
+    import shutil
+    import tempfile
+
+    print("\n==========================")
+    print("Start test for io.detect_format and io.load_orbits")
+    print("==========================")
+
+    orbit = sktools.io.OrbitData(BPMx=np.random.normal(size=(10, 50)),
+                                 BPMy=np.random.normal(size=(10, 50)),
+                                 CMx=np.random.normal(size=(6, 50)),
+                                 CMy=np.random.normal(size=(4, 50)),
+                                 sampling_frequency=150,
+                                 measure_date=datetime(2016, 5, 30, 12))
+    directory = tempfile.mkdtemp()
+    try:
+        def path(name):
+            return os.path.join(directory, name)
+
+        # the magic bytes win over the extensions
+        sktools.io.save_orbit_hdf5(path('a.hdf5'), orbit)
+        shutil.move(path('a.hdf5'), path('a.dat'))
+        sktools.io.save_orbit_npy(path('b.npy'), orbit)
+        shutil.move(path('b.npy'), path('b.mat'))
+        # no magic bytes: the extension decides, or nothing does
+        with open(path('c.mat'), 'wb') as f:
+            f.write(b'not a MAT-file at all')
+        with open(path('d.txt'), 'wb') as f:
+            f.write(b'\x89HD')
+
+        assert sktools.io.detect_format(path('a.dat'))['name'] == 'hdf5'
+        assert sktools.io.detect_format(path('b.mat'))['name'] == 'npy'
+        assert sktools.io.detect_format(path('c.mat'))['name'] == 'mat5'
+        try:
+            sktools.io.detect_format(path('d.txt'))
+            assert False
+        except ValueError:
+            pass
+
+        for executor in ['thread', 'process']:
+            filenames, orbits, errors = sktools.io.load_orbits(
+                [path('*'), path('missing.h5')], max_workers=2,
+                executor=executor)
+            assert filenames == [path(n) for n in ['a.dat', 'b.mat', 'c.mat',
+                                                   'd.txt', 'missing.h5']]
+            assert sorted(errors) == filenames[2:]
+            assert isinstance(errors[path('d.txt')], ValueError)
+            assert isinstance(errors[path('missing.h5')], IOError)
+            assert orbits[2:] == [None]*3
+            for loaded in orbits[:2]:
+                assert loaded.measure_date == orbit.measure_date
+                for key in ['BPMx', 'BPMy', 'CMx', 'CMy']:
+                    assert np.array_equal(getattr(loaded, key),
+                                          getattr(orbit, key))
+    finally:
+        shutil.rmtree(directory)
+    print("\tformats found by magic bytes, errors reported per file")
+
+
+def test_analyze_orbit():
+    from concurrent.futures import ThreadPoolExecutor
+
+    print("\n==========================")
+    print("Start test for core.analyze_orbit")
+    print("==========================")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    t = np.arange(1500)/150.
+    noise = 1e-3*np.random.normal(size=(2, 108, 1500))
+    BPMx = np.outer(lattice.x.Smat[:, 20], np.cos(2*np.pi*10*t + 0.3))
+    BPMy = np.outer(lattice.y.Smat[:, 40], np.sin(2*np.pi*10*t))
+    orbit = sktools.io.OrbitData(BPMx=BPMx + noise[0], BPMy=BPMy + noise[1],
+                                 sampling_frequency=150.)
+
+    result = skcore.analyze_orbit(orbit, lattice, 10.)
+    for axis, cm in [('x', 20), ('y', 40)]:
+        kick = result[axis]['cos']
+        assert np.argmax(abs(kick['correction'])) == cm
+        assert abs(kick['position'] -
+                   lattice.plane(axis).cm_positions[cm]) < 5
+        print("\t{}: kick at {} ({:.1f} m)".format(axis, kick['name'],
+                                                  kick['position']))
+    assert abs(result['x']['angle'] + 0.3*180/np.pi) < 0.1
+    print("\ttiming: {}".format(result['timing']))
+
+    # same result on a pool of the caller, the pseudo-inverse is reused
+    S_inv = skcore.analysis._inverse(lattice.x, 32)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for _ in range(2):
+            other = skcore.analyze_orbit(orbit, lattice, 10., executor=pool)
+    for axis in 'xy':
+        assert np.allclose(other[axis]['components'],
+                           result[axis]['components'])
+        assert np.allclose(other[axis]['cos']['correction'],
+                           result[axis]['cos']['correction'])
+    assert skcore.analysis._inverse(lattice.x, 32) is S_inv
+    assert skcore.analysis._inverse(lattice.x, 16) is not S_inv
+    lattice.x.Smat = lattice.x.Smat.copy()
+    assert skcore.analysis._inverse(lattice.x, 32) is not S_inv
+
+
+def test_cli_batch():
+    import csv
+    import shutil
+    import tempfile
+    from search_kicks import cli
+    from search_kicks.tools import matlab
+
+    print("\n==========================")
+    print("Start test for search-kicks batch")
+    print("==========================")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    t = np.arange(600)/150.
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(3):
+            BPMx = np.zeros((128, 600))
+            BPMy = np.zeros((128, 600))
+            BPMx[lattice.x.bpm_idx] = np.outer(lattice.x.Smat[:, 10+i],
+                                               np.cos(2*np.pi*10*t))
+            BPMy[lattice.y.bpm_idx] = np.outer(lattice.y.Smat[:, 30+i],
+                                               np.sin(2*np.pi*10*t))
+            matlab.save_timeanalys(
+                os.path.join(directory, 'dump{}.mat'.format(i)), BPMx, BPMy,
+                np.zeros((80, 600)), np.zeros((70, 600)))
+
+        output = os.path.join(directory, 'results.csv')
+        status = cli.main(['batch', os.path.join(directory, '*.mat'),
+                           '-f', '10', '-f', '8', '-o', output, '-j', '2'])
+        with open(output, 'r') as f:
+            rows = list(csv.DictReader(f))
+
+        # a worker analyzes its file in its own thread
+        threads = set()
+        get_kick = skcore.analysis.get_kick
+
+        def recorded_get_kick(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return get_kick(*args, **kwargs)
+
+        skcore.analysis.get_kick = recorded_get_kick
+        try:
+            options = {'frequencies': [10.], 'planes': 'xy',
+                       'method': 'rotation', 'svd_values': 32,
+                       'config': sktools.machine.INIT_FILE}
+            worker_rows = cli._analyze_file(
+                os.path.join(directory, 'dump0.mat'), options)
+        finally:
+            skcore.analysis.get_kick = get_kick
+    finally:
+        shutil.rmtree(directory)
+
+    assert threads == set([threading.current_thread()])
+    assert len(worker_rows) == 2*2
+
+    assert status == 0
+    assert len(rows) == 3*2*2*2
+    assert len(set(r['file'] for r in rows)) == 3
+    assert all(float(r['time_kick']) > 0 for r in rows)
+    print("\t{} rows for 3 files".format(len(rows)))
+
+
+def test_cli_installed():
+    import shutil
+    import subprocess
+    import tempfile
+
+    print("\n==========================")
+    print("Start test for search-kicks from a built package")
+    print("==========================")
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    directory = tempfile.mkdtemp()
+    try:
+        # build the package and run it out of the checkout, so that the
+        # default configuration must come from the package data
+        build = os.path.join(directory, 'build')
+        subprocess.check_call([sys.executable, 'setup.py', '-q', 'build',
+                               '--build-base', build,
+                               '--build-lib', os.path.join(build, 'lib')],
+                              cwd=root, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        env = dict(os.environ, PYTHONPATH=os.path.join(build, 'lib'))
+        script = ("import sys\n"
+                  "import search_kicks\n"
+                  "from search_kicks import cli\n"
+                  "assert search_kicks.__file__.startswith(sys.argv[1])\n"
+                  "sys.exit(cli.main(['campaign', '-c', '0', '-n', '2', "
+                  "'-j', '1']))\n")
+        output = subprocess.check_output(
+            [sys.executable, '-c', script, os.path.join(build, 'lib')],
+            cwd=directory, env=env, universal_newlines=True)
+    finally:
+        shutil.rmtree(directory)
+
+    assert '2 trials' in output
+    print("\tcampaign run with the default configuration of the package")
+
+
+class LossyPublisher(sktools.acquisition.LocalPublisher):
+    """ LocalPublisher losing every 100th frame. """
+    def receive(self, n=1):
+        messages = super(LossyPublisher, self).receive(n)
+        return [m for m in messages if int(m[1]) % 100 != 99]
+
+
+def test_kick_monitor():
+    import json
+    import shutil
+    import tempfile
+    from search_kicks.core import monitor
+
+    print("\n==========================")
+    print("Start test for core.monitor.KickMonitor")
+    print("==========================")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    t = np.arange(3000)/150.
+    BPMx = 1e-3*np.random.normal(size=(128, 3000))
+    BPMy = 1e-3*np.random.normal(size=(128, 3000))
+    BPMx[lattice.x.bpm_idx] += np.outer(lattice.x.Smat[:, 20],
+                                        np.cos(2*np.pi*10*t + 0.3))
+    BPMy[lattice.y.bpm_idx] += np.outer(lattice.y.Smat[:, 40],
+                                        np.sin(2*np.pi*10*t))
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'kicks.log')
+        sink = monitor.FileSink(filename)
+        kick_monitor = monitor.KickMonitor(LossyPublisher(BPMx, BPMy),
+                                           lattice, 10., window=300,
+                                           period=150, sink=sink, refresh=4)
+        stats = kick_monitor.run(cycles=10)
+        sink.close()
+        with open(filename, 'r') as f:
+            results = [json.loads(line) for line in f]
+    finally:
+        shutil.rmtree(directory)
+
+    assert len(results) == stats['cycles'] == 10
+    assert stats['dropped'] == stats['frames'] // 99
+    assert stats['overruns'] == 0
+    assert stats['latency_max'] < 300/150.
+    assert all(r['x']['cos']['corrector'] == 20 for r in results)
+    assert all(r['y']['cos']['corrector'] == 40 for r in results)
+    print("\t{cycles} cycles, {dropped} frames dropped, latency mean "
+          "{latency_mean:.3f} s, max {latency_max:.3f} s".format(**stats))
+
+
+def test_pipeline():
+    import time
+    from search_kicks.core import monitor
+
+    print("\n==========================")
+    print("Start test for tools.pipeline")
+    print("==========================")
+
+    def slow_square(x):
+        time.sleep(0.01)
+        return x*x
+
+    # the worker holds item 0 until released: the queue of 4 is full after
+    # item 4 and every item fed after that drops one
+    for policy, kept in [('drop_oldest', [0, 17, 18, 19, 20]),
+                         ('drop_newest', [0, 1, 2, 3, 4])]:
+        busy = threading.Event()
+        release = threading.Event()
+
+        def held_square(x):
+            busy.set()
+            release.wait()
+            return x*x
+
+        results = []
+        pipeline = sktools.pipeline.Pipeline([
+            sktools.pipeline.Stage('square', held_square, queue_size=4,
+                                   policy=policy),
+            sktools.pipeline.Stage('sink', results.append)])
+        with pipeline:
+            assert pipeline.put(0)
+            busy.wait()
+            accepted = [pipeline.put(x) for x in range(1, 21)]
+            stats = pipeline.stats()['square']
+            release.set()
+        # no put waited for the stage: they all returned while it was held
+        assert accepted == [True]*4 + [False]*16
+        assert stats['received'] == 21 and stats['dropped'] == 16
+        assert stats['processed'] == 0 and stats['max_depth'] == 4
+        stats = pipeline.stats()
+        assert stats['square']['processed'] == stats['sink']['processed'] == 5
+        assert sorted(results) == [x*x for x in kept]
+
+    results = []
+    pipeline = sktools.pipeline.Pipeline([
+        sktools.pipeline.Stage('square', slow_square, workers=2),
+        sktools.pipeline.Stage('sink', results.append)])
+    with pipeline:
+        pipeline.feed(range(20))
+    assert pipeline.stats()['square']['dropped'] == 0
+    assert sorted(results) == [x*x for x in range(20)]
+    print("\tdrop_oldest/drop_newest: 16 of 21 dropped, block: all "
+          "processed")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    t = np.arange(1500)/150.
+    BPMx = 1e-3*np.random.normal(size=(128, 1500))
+    BPMy = 1e-3*np.random.normal(size=(128, 1500))
+    BPMx[lattice.x.bpm_idx] += np.outer(lattice.x.Smat[:, 20],
+                                        np.cos(2*np.pi*10*t + 0.3))
+    BPMy[lattice.y.bpm_idx] += np.outer(lattice.y.Smat[:, 40],
+                                        np.sin(2*np.pi*10*t))
+    publisher = sktools.acquisition.LocalPublisher(BPMx, BPMy)
+
+    results = []
+    pipeline = monitor.kick_pipeline(lattice, 10., results.append)
+    with pipeline:
+        pipeline.feed(publisher.receive(1500))
+    assert pipeline['acquire'].dropped == 0
+    assert results and all(r['x']['cos']['corrector'] == 20 and
+                           r['y']['cos']['corrector'] == 40 for r in results)
+    print("\tkick pipeline: {} windows analyzed".format(len(results)))
+
+
+def test_track_kicks():
+    from search_kicks.core import tracking
+
+    print("\n==========================")
+    print("Start test for core.tracking.track_kicks")
+    print("==========================")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    plane = lattice.x
+    orbits = (plane.Smat[:, :20].T*np.random.normal(size=(20, 1)) +
+              0.05*np.random.normal(size=(20, 108)))
+    kick_phases, coefficients = skcore.get_kicks(orbits, plane.phase,
+                                                 plane.tune)
+    for orbit, kick_phase, coefficient in zip(orbits, kick_phases,
+                                              coefficients):
+        expected = skcore.get_kick(orbit, plane.phase, plane.tune)
+        assert np.isclose(kick_phase, expected[0])
+        assert np.allclose(coefficient, expected[1])
+
+    # the source moves from the 20th to the 30th corrector after 30 s
+    t = np.arange(9000)/150.
+    BPMx = 1e-3*np.random.normal(size=(108, 9000))
+    BPMx[:, :4500] += np.outer(plane.Smat[:, 20],
+                               np.cos(2*np.pi*10*t[:4500] + 0.3))
+    BPMx[:, 4500:] += np.outer(plane.Smat[:, 30],
+                               np.cos(2*np.pi*10*t[4500:] + 1))
+    orbit = sktools.io.OrbitData(BPMx=BPMx, BPMy=BPMx,
+                                 sampling_frequency=150.)
+    track = tracking.track_kicks(orbit, lattice, 10., planes='x')
+
+    index = track['x']['cos']['index']
+    assert index.size == track['time'].size == 59
+    for i0 in [0, 9000-300]:
+        window = orbit.slice_samples(i0, i0+300)
+        expected = skcore.analyze_orbit(window, lattice, 10., planes='x')
+        assert index[i0//150] == expected['x']['cos']['index']
+    assert index[0] != index[-1]
+    print("\t{} windows, kick at {} then at {}".format(
+        index.size, track['x']['cos']['name'][0],
+        track['x']['cos']['name'][-1]))
+
+
+def test_instrument():
+    import json
+    from search_kicks.tools import instrument
+
+    print("\n==========================")
+    print("Start test for tools.instrument")
+    print("==========================")
+
+    phase = np.sort(np.random.uniform(0, 2*np.pi*17.85, 108))
+    orbit = np.cos(phase[30] - phase)
+
+    instrument.reset()
+    skcore.get_kick(orbit, phase, 17.85)
+    assert instrument.snapshot() == {'timers': {}, 'counters': {}}
+
+    instrument.enable(memory=True)
+    try:
+        with instrument.timer('search'):
+            skcore.get_kick(orbit, phase, 17.85)
+            skcore.get_kick(orbit, phase, 17.85)
+            big = np.ones(10**6)
+            del big
+    finally:
+        instrument.disable()
+    values = instrument.snapshot()
+    timers = values['timers']
+    assert timers['get_kick.get_kick']['calls'] == 2
+    assert timers['maths.fit_sin_cos']['calls'] == 2*108
+    assert values['counters']['maths.lstsq'] == 2*108
+    assert timers['search']['total'] >= timers['get_kick.get_kick']['total']
+    assert timers['search']['memory_peak'] >= 8*10**6
+    assert timers['get_kick.get_kick']['memory_peak'] < 8*10**6
+
+    assert json.loads(instrument.to_json()) == values
+    text = instrument.to_prometheus()
+    assert ('search_kicks_operations_total{operation="maths.lstsq"} 216'
+            in text)
+    assert 'search_kicks_stage_seconds_count{stage="search"} 1' in text
+    print(instrument.report())
+    instrument.reset()
+
+
+def test_synthetic():
+    print("\n==========================")
+    print("Start test for tools.synthetic")
+    print("==========================")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    Smat = lattice.x.Smat
+    generator = sktools.synthetic.HarmonicDisturbance(
+        Smat, [20, 5], [10., 8.5], amplitudes=[1., 0.5], phases=[0.3, 1.],
+        noise=1e-3, noise_model='random_walk', cm_noise=1e-3, seed=3)
+
+    values, cm_values = generator.generate(1000, correctors=True)
+    assert values.shape == (Smat.shape[0], 1000)
+    t = np.arange(1000)/150.
+    expected = (np.outer(Smat[:, 20], np.sin(2*np.pi*10*t + 0.3)) +
+                0.5*np.outer(Smat[:, 5], np.sin(2*np.pi*8.5*t + 1.)))
+    noise = values - expected
+    assert 1e-3 < np.std(noise) < 0.1
+    assert np.allclose(values - Smat.dot(cm_values),
+                       noise - Smat.dot(cm_values - np.dot(
+                           np.eye(Smat.shape[1])[:, [20, 5]],
+                           [np.sin(2*np.pi*10*t + 0.3),
+                            0.5*np.sin(2*np.pi*8.5*t + 1.)])))
+
+    # chunks are continuous and reproducible
+    chunks = list(generator.chunks(1000, chunk=300, correctors=True))
+    assert [c[1].shape[1] for c in chunks] == [300, 300, 300, 100]
+    assert np.allclose(np.concatenate([c[0] for c in chunks]), t)
+    assert np.allclose(np.concatenate([c[1] for c in chunks], axis=1),
+                       values)
+    assert np.allclose(np.concatenate([c[2] for c in chunks], axis=1),
+                       cm_values)
+
+    x = sktools.synthetic.HarmonicDisturbance.from_lattice(
+        lattice, 'x', 20, 10., phases=0.3, noise=1e-3, seed=1)
+    y = sktools.synthetic.HarmonicDisturbance.from_lattice(
+        lattice, 'y', 40, 10., phases=0.3)
+    orbit = x.orbit(1500, y)
+    result = skcore.analyze_orbit(orbit, lattice, 10.)
+    for axis, cm in [('x', 20), ('y', 40)]:
+        kick = result[axis]['cos']
+        assert np.argmax(abs(kick['correction'])) == cm
+        assert abs(kick['position'] -
+                   lattice.plane(axis).cm_positions[cm]) < 5
+    print("\tkicks found at {} and {}".format(result['x']['cos']['name'],
+                                              result['y']['cos']['name']))
+
+
+def test_campaign():
+    import h5py
+    import shutil
+    import tempfile
+    from search_kicks import cli
+
+    print("\n==========================")
+    print("Start test for core.campaign")
+    print("==========================")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    options = dict(correctors=[10, 20, 30], frequencies=[10., 8.5],
+                   noise_levels=[0., 2.], dropouts=[0, 8], repeats=3,
+                   seed=4)
+    result = skcore.run_campaign(lattice, 'x', max_workers=2, batch=5,
+                                 **options)
+    trials = result['trials']
+    assert trials['error'].size == 3*2*2*2*3
+    assert np.all(trials['success'] == (trials['error'] <= 5))
+    assert np.all(np.diff(result['bins']) == 1)
+
+    per_corrector = result['per_corrector']
+    assert list(per_corrector['corrector']) == [10, 20, 30]
+    assert np.all(per_corrector['histogram'].sum(axis=1) ==
+                  per_corrector['trials'])
+    assert len(result['per_condition']) == 8
+    assert np.isclose(sum(c['trials']*c['success_rate']
+                          for c in result['per_condition']),
+                      np.count_nonzero(trials['success']))
+
+    # same trials whatever the executor and the batches
+    same = skcore.run_campaign(lattice, 'x', executor='thread', batch=7,
+                               **options)
+    assert np.array_equal(same['trials']['error'], trials['error'])
+    other = skcore.run_campaign(lattice, 'x', executor='thread',
+                                **dict(options, seed=5))
+    assert not np.array_equal(other['trials']['error'], trials['error'])
+
+    directory = tempfile.mkdtemp()
+    try:
+        output = os.path.join(directory, 'campaign.h5')
+        status = cli.main(['campaign', '-c', '10', '-c', '20', '-n', '2',
+                           '--noise', '1', '-j', '2', '-o', output])
+        assert status == 0
+        with h5py.File(output, 'r') as f:
+            assert f['trials/error'].shape == (4,)
+            assert f['per_corrector/histogram'].shape == (2, 120)
+    finally:
+        shutil.rmtree(directory)
+    print("\t{} trials, {:.0%} within 5 m".format(trials['error'].size,
+                                                  result['success_rate']))
+
+
+def test_response_matcher():
+    print("\n==========================")
+    print("Start test for core.match")
+    print("==========================")
+
+    lattice = sktools.lattice.LatticeModel.from_config()
+    matcher = skcore.ResponseMatcher.from_lattice(lattice, 'y')
+    Smat = lattice.y.Smat
+
+    # complex orbits, any rotation, one kick each
+    correctors = np.arange(matcher.cm_nb)
+    kicks = np.exp(1j*np.linspace(0, 2*np.pi, correctors.size))
+    orbits = (Smat[:, correctors]*kicks).T
+    orbits += 1e-2*np.random.normal(size=orbits.shape)
+    candidates = matcher.locate_many(orbits, count=3)
+    assert candidates['corrector'].shape == (correctors.size, 3)
+    assert np.all(candidates['corrector'][:, 0] == correctors)
+    assert np.all(candidates['score'][:, 0] > 0.99)
+    assert np.all(np.diff(candidates['score'], axis=1) <= 0)
+    assert np.allclose(candidates['amplitude'][:, 0], kicks, atol=1e-2)
+    assert np.all(candidates['name'][:, 0] == lattice.y.cm_names)
+
+    ranked = matcher.locate(orbits[7].real, count=2)
+    assert [c['corrector'] for c in ranked] == \
+        list(candidates['corrector'][7, :2])
+    assert ranked[0]['name'] == lattice.y.cm_names[7]
+
+    valid = np.ones(matcher.bpm_nb, dtype=bool)
+    valid[::3] = False
+    broken = orbits[12].copy()
+    broken[~valid] = 1e3
+    assert matcher.locate(broken, valid=valid)[0]['corrector'] == 12
+
+    t = np.arange(1500)/150.
+    BPMx = 1e-3*np.random.normal(size=(128, 1500))
+    BPMy = 1e-3*np.random.normal(size=(128, 1500))
+    BPMx[lattice.x.bpm_idx] += np.outer(lattice.x.Smat[:, 20],
+                                        np.cos(2*np.pi*10*t + 0.3))
+    BPMy[lattice.y.bpm_idx] += np.outer(lattice.y.Smat[:, 40],
+                                        np.sin(2*np.pi*10*t))
+    orbit = sktools.io.OrbitData(BPMx=BPMx, BPMy=BPMy,
+                                 sampling_frequency=150.)
+    # one matcher per plane, built once
+    for _ in range(3):
+        result = skcore.analyze_orbit(orbit, lattice, 10.)
+    matcher_x = skcore.ResponseMatcher.from_lattice(lattice, 'x')
+    result = skcore.analyze_orbit(orbit, lattice, 10.)
+    assert skcore.ResponseMatcher.from_lattice(lattice, 'x') is matcher_x
+    assert skcore.ResponseMatcher.from_lattice(lattice, 'y') is matcher
+    other = sktools.lattice.LatticeModel.from_config()
+    assert skcore.ResponseMatcher.from_lattice(other, 'y') is not matcher
+    # built again when the response matrix is replaced
+    Smat = lattice.x.Smat
+    lattice.x.Smat = 2*Smat
+    rebuilt = skcore.ResponseMatcher.from_lattice(lattice, 'x')
+    assert rebuilt is not matcher_x
+    assert np.allclose(rebuilt.Smat, 2*Smat)
+    assert skcore.ResponseMatcher.from_lattice(lattice, 'x') is rebuilt
+    lattice.x.Smat = Smat
+    assert result['x']['match'][0]['corrector'] == 20
+    assert result['y']['match'][0]['corrector'] == 40
+    print("\tbest candidates: {} and {}"
+          .format(result['x']['match'][0]['name'],
+                  result['y']['match'][0]['name']))
+
+
 if __name__ == "__main__":
     plt.close('all')
     phase = 2*np.pi*np.arange(1, 41).T/10
@@ -112,4 +1469,29 @@ if __name__ == "__main__":
     test_fit_sin_cos(signal, phase)
     test_extract_fit_sin_cos(x, fs, f, a, b)
     test_get_kick()
+    test_resample_hold()
+    test_archiver_read_sharded()
+    test_archiver_cache()
+    test_load_cached()
+    test_machine_config()
+    test_ring_buffer()
+    test_trigger()
+    test_orbit_select()
+    test_slice_time()
+    test_orbit_spectrum()
+    test_orbit_recorder()
+    test_shared_orbit()
+    test_load_orbit_dump_threads()
+    test_orbit_compact()
+    test_load_orbits()
+    test_analyze_orbit()
+    test_cli_batch()
+    test_cli_installed()
+    test_kick_monitor()
+    test_pipeline()
+    test_track_kicks()
+    test_instrument()
+    test_synthetic()
+    test_campaign()
+    test_response_matcher()
     plt.show()